@@ -0,0 +1,357 @@
+#!/bin/python3
+
+# This module :
+#   1) Connects the scripts to the influxdb server with the credentials of
+#      src/credentials.txt, read only once per process
+#   2) The clients of a script (e.g. the InfluxDBClient for the queries and the
+#      DataFrameClient for the writes of clean.py) share one HTTP session, so
+#      their requests reuse the same pool of keep-alive connections
+#   3) The requests that fail on a connection error, a timeout, or a 429 / 5xx
+#      answer of the server are sent again, up to RETRIES times, waiting
+#      BACKOFF_SECONDS * 2 ** (retry - 1) between the retries (or the delay
+#      asked by the server with Retry-After). The writes are sent again too,
+#      writing the same points twice is harmless as the server overwrites them
+#   4) The bodies of the requests and of the answers are compressed with gzip,
+#      which divides the size of the points and of the query results by about 5
+#   5) The big queries can be read as columns (iter_columns, query_columns) :
+#      the answer is requested in chunks of CHUNK_SIZE points (chunked=true)
+#      with the times in epoch nanoseconds, and each chunk is decoded as soon
+#      as it arrives into one typed numpy array per column (float64 for the
+#      numbers, int64 for the times, object for the strings), instead of one
+#      python dict per point for the whole answer (ResultSet.get_points). The
+#      json of a chunk is still parsed into python lists, which takes most of
+#      the time of the decoding : the rows are copied into one 2-D object
+#      array, the fastest way to transpose them with numpy, held only for one
+#      chunk of CHUNK_SIZE points
+#   6) The jobs that only write (the upload of the spool, the open data, the
+#      metrics) use connect_writer, a minimal client sending the lines of the
+#      line protocol (see line_protocol.py) with the same session, retries and
+#      gzip. The influxdb library imports pandas, and numpy is only needed by
+#      the queries, so both are imported only when a query client is made or
+#      an answer decoded : the short jobs start without loading them
+#   Only the errors left after the retries are raised to the scripts
+#
+# e.g. client, df_client = influx_client.connect_pair()
+#      columns = influx_client.query_columns(client, 'SELECT * FROM ...')
+#      writer = influx_client.connect_writer()
+
+import os
+import json
+import gzip
+from contextlib import closing
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ------------------------------------------------------------------------------
+# Constants
+CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'credentials.txt')
+
+# Seconds to connect to the server and to wait for its answer
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+RETRIES = 5
+BACKOFF_SECONDS = 1.0
+
+# Answers of the server worth sending the request again
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+POOL_SIZE = 4
+
+# Number of points of each chunk of the answer of a chunked query
+CHUNK_SIZE = 10000
+
+# (ip, port, user name, password, database name), see read_credentials
+CREDENTIALS = None
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def read_credentials(path=None):
+    """
+    Read the credentials in the file, omit the last char that is '\n'
+    when using readline. The file is only read at the first call (or when
+    another path is given), so the functions of the scripts can be used
+    (e.g. by benchmark.py) without it
+    :param path: string, the path of the credentials file, by default
+                 src/credentials.txt
+    :return: (ip, port, user name, password, database name)
+    """
+    global CREDENTIALS
+    if path is not None:
+        with open(path, 'r') as f:
+            return tuple(f.readline()[:-1] for _ in range(5))
+    if CREDENTIALS is None:
+        CREDENTIALS = read_credentials(CREDENTIALS_FILE)
+    return CREDENTIALS
+
+
+def make_retry(retries=RETRIES, backoff=BACKOFF_SECONDS):
+    """
+    Make the retry policy of the requests
+    :param retries: int, the maximum number of retries of a request
+    :param backoff: float, the delay before the first retry in seconds,
+                    doubled at each retry
+    :return: the urllib3 Retry
+    """
+    options = {'total': retries, 'backoff_factor': backoff,
+               'status_forcelist': RETRY_STATUS, 'raise_on_status': False,
+               'respect_retry_after_header': True}
+    try:
+        # The queries and the writes are both POST requests
+        return Retry(allowed_methods=None, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=False, **options)
+
+
+def mount_retries(session, retries=RETRIES, backoff=BACKOFF_SECONDS, pool_size=POOL_SIZE):
+    """
+    Mount on the session the adapter retrying the requests, the influxdb
+    clients replace the adapter of their session by their own one when they
+    are created, so it must be called after
+    :param session: the requests Session
+    :param retries: int, the maximum number of retries of a request
+    :param backoff: float, the delay before the first retry in seconds
+    :param pool_size: int, the maximum number of connections kept alive
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=make_retry(retries, backoff))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def connect(dataframe=False, session=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            retries=RETRIES, backoff=BACKOFF_SECONDS, compress=True):
+    """
+    Connect to the influxdb server with the credentials of src/credentials.txt
+    :param dataframe: boolean, True for a DataFrameClient (queries answered
+                      and writes given as pandas dataframes)
+    :param session: the requests Session shared with other clients, or None
+                    for a new one
+    :param timeout: float or (connect, read) tuple, the timeouts in seconds
+    :param retries: int, the maximum number of retries of a request
+    :param backoff: float, the delay before the first retry in seconds
+    :param compress: boolean, True to compress the requests and the answers
+    :return: the influxdb client
+    """
+    from influxdb import InfluxDBClient, DataFrameClient
+
+    ip, port, user_name, pwd, db_name = read_credentials()
+    if session is None:
+        session = requests.Session()
+    kind = DataFrameClient if dataframe else InfluxDBClient
+    # The retries are done by the adapter of the session, the client
+    # must not retry on top of it (its retries=0 would retry forever)
+    client = kind(host=ip,
+                  port=port,
+                  username=user_name,
+                  password=pwd,
+                  database=db_name,
+                  timeout=timeout,
+                  retries=1,
+                  gzip=compress,
+                  session=session)
+    mount_retries(session, retries, backoff)
+    return client
+
+
+def connect_pair(**kwargs):
+    """
+    Connect an InfluxDBClient and a DataFrameClient sharing the same session
+    :param kwargs: the options of connect
+    :return: (client, df_client)
+    """
+    session = requests.Session()
+    return (connect(False, session, **kwargs),
+            connect(True, session, **kwargs))
+
+
+class LineWriter:
+    """
+    Minimal influxdb client that only writes lines of the line protocol, with
+    the same interface as InfluxDBClient.write, so it is used by the functions
+    of line_protocol.py as the other clients
+    """
+
+    def __init__(self, host, port, username, password, database, session,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), compress=True):
+        self._database = database
+        self._url = 'http://{}:{}/write'.format(host, port)
+        self._auth = (username, password)
+        self._session = session
+        self._timeout = timeout
+        self._compress = compress
+
+    def write(self, data, params=None, expected_response_code=204, protocol='line'):
+        """
+        Send the lines to the server
+        :param data: list of the lines (or a single line) of the line protocol
+        :param params: dict of the parameters of the request (db, precision)
+        :param expected_response_code: int, the status of a successful write
+        :param protocol: string, only 'line' is supported
+        :return: True, the errors are raised (requests.HTTPError)
+        """
+        if protocol != 'line':
+            raise ValueError('Only the line protocol can be written, not ' + protocol)
+        if isinstance(data, str):
+            data = [data]
+        body = ('\n'.join(data) + '\n').encode('utf-8')
+        headers = {'Content-Type': 'application/octet-stream'}
+        if self._compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        response = self._session.post(self._url, params=params or {'db': self._database},
+                                      data=body, headers=headers, auth=self._auth,
+                                      timeout=self._timeout)
+        if response.status_code != expected_response_code:
+            raise requests.HTTPError('Write failed with status '
+                                     + str(response.status_code) + ' : '
+                                     + response.text, response=response)
+        return True
+
+    def close(self):
+        self._session.close()
+
+
+def connect_writer(session=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                   retries=RETRIES, backoff=BACKOFF_SECONDS, compress=True):
+    """
+    Connect a LineWriter to the influxdb server with the credentials of
+    src/credentials.txt, without importing the influxdb library
+    :param session: the requests Session shared with other clients, or None
+                    for a new one
+    :param timeout: float or (connect, read) tuple, the timeouts in seconds
+    :param retries: int, the maximum number of retries of a request
+    :param backoff: float, the delay before the first retry in seconds
+    :param compress: boolean, True to compress the requests
+    :return: the LineWriter
+    """
+    ip, port, user_name, pwd, db_name = read_credentials()
+    if session is None:
+        session = requests.Session()
+    mount_retries(session, retries, backoff)
+    return LineWriter(ip, port, user_name, pwd, db_name, session, timeout, compress)
+
+
+def column_array(values):
+    """
+    Convert a column of a chunk to a typed numpy array, after its first value
+    that is not None : int64 when all the values are integers, float64 for
+    the other numbers (None becomes Nan), object for the strings and the booleans
+    :param values: object numpy array of the values of the column
+    :return: numpy array
+    """
+    import numpy as np
+
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, (str, bool)):
+        # A copy, a view would keep the values of all the columns alive
+        return values.copy()
+    if type(sample) is int and all(type(value) is int for value in values):
+        return values.astype(np.int64)
+    return values.astype(np.float64)
+
+
+def decode_chunk(line):
+    """
+    Decode a chunk of the answer of a chunked query into columns
+    :param line: bytes of the json of the chunk
+    :return: generator of (name of the measurement, dict {column: numpy array}),
+             one per series of the chunk, the time is an int64 array of
+             epoch nanoseconds
+    """
+    import numpy as np
+    from influxdb.exceptions import InfluxDBClientError
+
+    chunk = json.loads(line)
+    if 'error' in chunk:
+        raise InfluxDBClientError(chunk['error'])
+    for result in chunk.get('results', []):
+        if 'error' in result:
+            raise InfluxDBClientError(result['error'])
+        for series in result.get('series', []):
+            columns = series['columns']
+            rows = series.get('values', [])
+            # The rows as one 2-D object array, then converted column by column
+            # (faster than transposing the lists of the rows with zip)
+            values = np.empty((len(rows), len(columns)), dtype=object)
+            if len(rows) > 0:
+                values[:] = rows
+            arrays = {}
+            for i in range(len(columns)):
+                if columns[i] == 'time':
+                    arrays['time'] = values[:, i].astype(np.int64)
+                else:
+                    arrays[columns[i]] = column_array(values[:, i])
+            yield series.get('name'), arrays
+
+
+def iter_columns(client, query, chunk_size=CHUNK_SIZE):
+    """
+    Send the query with a chunked answer and decode each chunk into columns
+    as soon as it arrives, so the answer is never held as python dicts
+    :param client: the influxdb client to query to
+    :param query: string of the query (a SELECT)
+    :param chunk_size: int, the number of points of each chunk
+    :return: generator of the dicts {column: numpy array} of each chunk, the
+             time is an int64 array of epoch nanoseconds (UTC)
+    """
+    params = {'q': query, 'epoch': 'ns', 'chunked': 'true',
+              'chunk_size': chunk_size}
+    if client._database:
+        params['db'] = client._database
+    response = client.request(url='query', method='GET', params=params,
+                              stream=True, expected_response_code=200)
+    with closing(response):
+        for line in response.iter_lines(chunk_size=1024 * 1024):
+            if line:
+                for _, arrays in decode_chunk(line):
+                    yield arrays
+
+
+def query_columns(client, query, chunk_size=CHUNK_SIZE):
+    """
+    Send the query with a chunked answer (see iter_columns) and concatenate the
+    chunks (see concat_columns)
+    :param client: the influxdb client to query to
+    :param query: string of the query (a SELECT)
+    :param chunk_size: int, the number of points of each chunk
+    :return: dict {column: numpy array} of the whole answer, empty if there is
+             no point, the time is an int64 array of epoch nanoseconds (UTC)
+    """
+    return concat_columns(iter_columns(client, query, chunk_size))
+
+
+def concat_columns(chunks):
+    """
+    Concatenate the columns of the chunks of an answer, a column missing
+    from some chunks is Nan there
+    :param chunks: iterable of the dicts {column: numpy array} of the chunks
+    :return: dict {column: numpy array}, empty if there is no point
+    """
+    import numpy as np
+
+    chunks = [arrays for arrays in chunks if len(arrays.get('time', ())) > 0]
+    if len(chunks) == 0:
+        return {}
+
+    names = []
+    for arrays in chunks:
+        names.extend(name for name in arrays if name not in names)
+    result = {}
+    for name in names:
+        parts = []
+        for arrays in chunks:
+            if name in arrays:
+                parts.append(arrays[name])
+            else:
+                parts.append(np.full(len(arrays['time']), np.nan))
+        result[name] = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    return result
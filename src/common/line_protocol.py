@@ -0,0 +1,361 @@
+#!/bin/python3
+
+# This module :
+#   1) Serializes the points written to the influxdb server to the line
+#      protocol (measurement,tag=value field=value time), the format the
+#      server parses anyway, without going through the generic conversions of
+#      the influxdb clients (json dicts, DataFrameClient)
+#   2) Point is a compact point (slots, no dict per instance) for the few
+#      points built one by one (e.g. the open data, the metrics), and the dict
+#      points of the spool are encoded the same way
+#   3) encode_frame encodes a whole pandas dataframe : the values are
+#      converted to strings a column at a time (repr of the floats, as the
+#      influxdb clients), and each line is a single formatting of a template
+#      made once for the dataframe, no intermediate dataframe of strings as
+#      DataFrameClient. The Nan fields are left out of their line, and the
+#      rows without any field are not written (as DataFrameClient)
+#   4) write_lines sends the lines by batches, with the client of
+#      influx_client.py (retries, gzip), all the writers of the project go
+#      through it
+#   Only the encoding of the dataframes needs numpy, it is imported there, so
+#   the points are encoded without loading it (e.g. the upload of the spool)
+#
+# e.g. line_protocol.write_frame(client, df, 'clean_sh_data', batch_size=5000)
+#      line_protocol.write_points(client, [Point('data', {'temperature': 21.5},
+#                                                {'source': 'sensehat'}, time)])
+
+import math
+import numbers
+from datetime import datetime, timezone
+
+# ------------------------------------------------------------------------------
+# Constants
+
+# Nanoseconds per unit of each precision of the times
+PRECISIONS = {'n': 1, 'u': 10**3, 'ms': 10**6, 's': 10**9,
+              'm': 60 * 10**9, 'h': 3600 * 10**9}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+class Point:
+    """
+    A point : measurement, tags, fields and time (a datetime, a RFC3339
+    string, an int in the precision of the write, or None for the time of
+    the server)
+    """
+    __slots__ = ('measurement', 'tags', 'fields', 'time')
+
+    def __init__(self, measurement, fields, tags=None, time=None):
+        self.measurement = measurement
+        self.fields = fields
+        self.tags = tags
+        self.time = time
+
+    @classmethod
+    def from_dict(cls, point):
+        """
+        Make a point from a dict point of the influxdb client (e.g. a sample
+        of the spool)
+        :param point: dict with 'measurement', 'fields', 'tags' and 'time'
+        :return: Point
+        """
+        return cls(point['measurement'], point['fields'], point.get('tags'),
+                   point.get('time'))
+
+    def to_dict(self):
+        """
+        Returns the point as a dict point of the influxdb client
+        :return: dict
+        """
+        point = {'measurement': self.measurement, 'fields': self.fields}
+        if self.tags:
+            point['tags'] = self.tags
+        if self.time is not None:
+            point['time'] = self.time
+        return point
+
+    def to_line(self, precision='n'):
+        """
+        Encode the point to a line of the line protocol
+        :param precision: string, the precision of the time (see PRECISIONS)
+        :return: string of the line, or None if the point has no field
+        """
+        return encode_point(self.measurement, self.fields, self.tags,
+                            self.time, precision)
+
+
+def escape_measurement(name):
+    return name.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(key):
+    """
+    Escape a tag key, a tag value or a field key
+    :param key: string
+    :return: the escaped string
+    """
+    return key.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def escape_string(value):
+    """
+    Quote a string field value
+    :param value: string
+    :return: the quoted string
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def encode_value(value):
+    """
+    Encode a field value : floats as their shortest repr, integers with the
+    'i' suffix, booleans as true / false and strings quoted
+    :param value: the value of the field
+    :return: string, or None for a missing value (None, Nan or infinite)
+    """
+    if value is None:
+        return None
+    # A numpy boolean has a dtype, but is not a bool
+    if isinstance(value, bool) or getattr(value, 'dtype', None) == bool:
+        return 'true' if value else 'false'
+    # The python and the numpy integers
+    if isinstance(value, numbers.Integral):
+        return str(int(value)) + 'i'
+    if isinstance(value, str):
+        return escape_string(value)
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+    return repr(value)
+
+
+def to_timestamp(time, precision='n'):
+    """
+    Convert the time of a point to an int in the given precision
+    :param time: datetime, RFC3339 string, or int already in the precision
+    :param precision: string, the precision (see PRECISIONS)
+    :return: int
+    """
+    if isinstance(time, numbers.Integral):
+        return int(time)
+    if isinstance(time, str):
+        # fromisoformat does not take the 'Z' suffix before python 3.11
+        time = datetime.fromisoformat(time.replace('Z', '+00:00'))
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    delta = time - EPOCH
+    ns = (delta.days * 86400 + delta.seconds) * 10**9 + delta.microseconds * 1000
+    return ns // PRECISIONS[precision]
+
+
+def encode_point(measurement, fields, tags=None, time=None, precision='n'):
+    """
+    Encode a point to a line of the line protocol, the tags are sorted by key
+    (as advised by influxdb) and the missing field values are left out
+    :param measurement: string, the name of the measurement
+    :param fields: dict {field: value}
+    :param tags: dict {tag: value}, or None
+    :param time: the time of the point (see to_timestamp), or None
+    :param precision: string, the precision of the time
+    :return: string of the line, or None if the point has no field
+    """
+    line = escape_measurement(measurement)
+    for key in sorted(tags or {}):
+        if tags[key] is not None and tags[key] != '':
+            line += ',' + escape_key(key) + '=' + escape_key(str(tags[key]))
+
+    encoded = []
+    for key, value in fields.items():
+        value = encode_value(value)
+        if value is not None:
+            encoded.append(escape_key(key) + '=' + value)
+    if len(encoded) == 0:
+        return None
+
+    line += ' ' + ','.join(encoded)
+    if time is not None:
+        line += ' ' + str(to_timestamp(time, precision))
+    return line
+
+
+def encode_points(points, precision='n'):
+    """
+    Encode the points (Point or dict points) to lines of the line protocol
+    :param points: iterable of the points
+    :param precision: string, the precision of the times
+    :return: list of the lines, the points without any field are left out
+    """
+    lines = []
+    for point in points:
+        if isinstance(point, dict):
+            point = Point.from_dict(point)
+        line = point.to_line(precision)
+        if line is not None:
+            lines.append(line)
+    return lines
+
+
+def format_array(values, formatter=str):
+    """
+    Format each value of a numeric array, faster than astype(str)
+    :param values: numpy array
+    :param formatter: the function formatting a python value
+    :return: list of the strings
+    """
+    return list(map(formatter, values.tolist()))
+
+
+def column_strings(values):
+    """
+    Encode a column of field values to strings, the whole column at once
+    :param values: numpy array of the values
+    :return: (list of the encoded values, boolean numpy array True where the
+             value is not missing)
+    """
+    import numpy as np
+
+    if values.dtype.kind == 'f':
+        # repr is the shortest string giving back the same float
+        return format_array(values, repr), np.isfinite(values)
+    if values.dtype.kind in 'iu':
+        return [s + 'i' for s in format_array(values)], np.ones(len(values), bool)
+    if values.dtype.kind == 'b':
+        return ['true' if v else 'false' for v in values.tolist()], np.ones(len(values), bool)
+
+    # Object column : encoded only once per distinct value
+    cache = {}
+    encoded = []
+    for value in values.tolist():
+        if value not in cache:
+            cache[value] = encode_value(value)
+        encoded.append(cache[value])
+    return encoded, np.array([value is not None for value in encoded], dtype=bool)
+
+
+def tag_strings(key, values):
+    """
+    Encode a tag column to ',key=value' strings, '' where there is no value
+    :param key: string, the tag key
+    :param values: numpy array of the values of the tag
+    :return: list of the strings
+    """
+    prefix = ',' + escape_key(key) + '='
+    cache = {}
+    encoded = []
+    for value in values.tolist():
+        if value not in cache:
+            missing = value is None or value != value or value == ''
+            cache[value] = '' if missing else prefix + escape_key(str(value))
+        encoded.append(cache[value])
+    return encoded
+
+
+def index_timestamps(index, precision='n'):
+    """
+    Convert a datetime index (naive datetimes are UTC) to ints in the precision
+    :param index: pandas DatetimeIndex
+    :param precision: string, the precision (see PRECISIONS)
+    :return: int64 numpy array
+    """
+    import numpy as np
+
+    if getattr(index, 'tz', None) is not None:
+        index = index.tz_convert(None)
+    ns = np.asarray(index, dtype='datetime64[ns]').view(np.int64)
+    return ns // PRECISIONS[precision]
+
+
+def encode_frame(df, measurement, tag_columns=None, precision='n'):
+    """
+    Encode a dataframe indexed by time to lines of the line protocol, all the
+    columns that are not tags are fields. The columns are converted to strings
+    one at a time, then each row with all its fields is a single formatting of
+    the same template, only the rows with missing values are assembled field
+    by field
+    :param df: pandas dataframe indexed by datetimes
+    :param measurement: string, the name of the measurement
+    :param tag_columns: list of the columns written as tags, or None
+    :param precision: string, the precision of the times
+    :return: list of the lines, the rows without any field are left out
+    """
+    import numpy as np
+
+    tag_columns = sorted(tag_columns or [])
+    field_columns = [col for col in df.columns if col not in tag_columns]
+    if len(df.index) == 0 or len(field_columns) == 0:
+        return []
+
+    heads = [escape_measurement(measurement)] * len(df.index)
+    if len(tag_columns) > 0:
+        tags = [tag_strings(col, df[col].to_numpy()) for col in tag_columns]
+        heads = list(map(''.join, zip(heads, *tags)))
+
+    keys = [escape_key(str(col)) for col in field_columns]
+    strings, valid = zip(*(column_strings(df[col].to_numpy()) for col in field_columns))
+    valid = np.column_stack(valid)
+    complete = valid.all(axis=1).tolist()
+    times = format_array(index_timestamps(df.index, precision))
+    template = '%s ' + ','.join(key.replace('%', '%%') + '=%s' for key in keys) + ' %s'
+
+    lines = []
+    for i, row in enumerate(zip(heads, *strings, times)):
+        if complete[i]:
+            lines.append(template % row)
+            continue
+        fields = [keys[j] + '=' + row[j + 1] for j in np.flatnonzero(valid[i])]
+        if len(fields) > 0:
+            lines.append(row[0] + ' ' + ','.join(fields) + ' ' + row[-1])
+    return lines
+
+
+def write_lines(client, lines, precision='n', batch_size=None):
+    """
+    Write the lines to the database of the client, by batches
+    :param client: the influxdb client (see influx_client.py)
+    :param lines: list of the lines of the line protocol
+    :param precision: string, the precision of the times of the lines
+    :param batch_size: int, maximum number of lines sent in one request,
+                       or None to send them all at once
+    :return: True once all the lines are written (the errors are raised)
+    """
+    batch_size = batch_size or max(len(lines), 1)
+    params = {'db': client._database, 'precision': precision}
+    for start in range(0, len(lines), batch_size):
+        client.write(lines[start:start + batch_size], params=params, protocol='line')
+    return True
+
+
+def write_points(client, points, precision='n', batch_size=None):
+    """
+    Encode and write the points (Point or dict points)
+    :param client: the influxdb client
+    :param points: iterable of the points
+    :param precision: string, the precision of the times
+    :param batch_size: int, maximum number of points sent in one request, or None
+    :return: True once all the points are written
+    """
+    return write_lines(client, encode_points(points, precision), precision, batch_size)
+
+
+def write_frame(client, df, measurement, tag_columns=None, batch_size=None):
+    """
+    Encode and write a dataframe indexed by time (see encode_frame), the times
+    are written in nanoseconds. Each batch is encoded just before being sent,
+    so only the lines of one batch are held in memory
+    :param client: the influxdb client
+    :param df: pandas dataframe indexed by datetimes
+    :param measurement: string, the name of the measurement
+    :param tag_columns: list of the columns written as tags, or None
+    :param batch_size: int, maximum number of points sent in one request, or None
+    :return: True once all the points are written
+    """
+    batch_size = batch_size or max(len(df.index), 1)
+    for start in range(0, len(df.index), batch_size):
+        lines = encode_frame(df.iloc[start:start + batch_size], measurement, tag_columns)
+        write_lines(client, lines, 'n')
+    return True
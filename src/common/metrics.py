@@ -0,0 +1,318 @@
+#!/bin/python3
+
+# This module :
+#   1) Instruments the runs of the pipeline scripts (collection, transfer,
+#      fetch of the open data, cleaning) : the wall time of each stage of a run
+#      (number of calls, total and longest duration) and counters of the
+#      volumes processed (rows, points, bytes), attributed to the stage running
+#   2) At the end of the run, the metrics are written as points to the
+#      measurement 'pipeline_metrics' (tags 'pipeline' and 'stage', one point
+#      per stage and one for the whole run, stage 'run', plus the tags of the
+#      run, e.g. the source cleaned), so the cost of the
+#      runs can be charted in Grafana next to the data, and / or to a Prometheus
+#      text file, read by the textfile collector of the node exporter
+#   3) With the environment variable PIPELINE_PROFILE=cprofile (or tracemalloc,
+#      or both separated by a comma), the run is also profiled : the cProfile
+#      statistics are dumped to PIPELINE_PROFILE_DIR, and with tracemalloc, the
+#      peak of memory allocated in each stage is added to its metrics
+#   Only the standard library is used, so it also runs on the Raspberry Pi.
+#   Without start_run, the stages and the counters do nothing
+#
+# e.g. metrics.start_run('clean')
+#      with metrics.stage('query'):
+#          ...
+#          metrics.count('rows', len(df.index))
+#      metrics.finish_run(client)
+
+import os
+import time
+import cProfile
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import line_protocol
+
+# ------------------------------------------------------------------------------
+# Constants
+MEASUREMENT = 'pipeline_metrics'
+
+# Stage of the points of the whole run
+RUN_STAGE = 'run'
+
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILE_DIR_ENV = 'PIPELINE_PROFILE_DIR'
+PROFILE_DIR = 'profiles'
+
+# Directory of the Prometheus text files, no text file if not set
+TEXTFILE_DIR_ENV = 'PIPELINE_METRICS_TEXTFILE_DIR'
+
+# Set to 0 to not write the metrics to the influxdb server
+INFLUX_ENV = 'PIPELINE_METRICS_INFLUX'
+
+# State of the current run, see start_run
+RUN = None
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def profile_options():
+    """
+    Returns the profilers requested by the environment variable PIPELINE_PROFILE
+    :return: set of the names of the profilers ('cprofile', 'tracemalloc')
+    """
+    value = os.environ.get(PROFILE_ENV, '')
+    return {name.strip().lower() for name in value.split(',') if name.strip()}
+
+
+def start_run(pipeline, tags=None):
+    """
+    Start recording the metrics of a run of the given pipeline script, and the
+    profilers requested by the environment
+    :param pipeline: string, the name of the pipeline script (e.g. 'clean')
+    :param tags: dict {tag: value} added to the points of the run (e.g. the
+                 source cleaned, when several runs of the pipeline run at
+                 once), or None
+    """
+    global RUN
+    options = profile_options()
+    RUN = {'pipeline': pipeline,
+           'tags': dict(tags or {}),
+           'time': datetime.now(timezone.utc),
+           'start': time.perf_counter(),
+           'stages': {},
+           'counters': {},
+           'stack': [],
+           'profiler': None,
+           'tracemalloc': False}
+
+    if 'tracemalloc' in options and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        RUN['tracemalloc'] = True
+    if 'cprofile' in options:
+        RUN['profiler'] = cProfile.Profile()
+        RUN['profiler'].enable()
+
+
+def run_name():
+    """
+    Returns the name of the current run for its files : the pipeline and the
+    values of its tags
+    :return: string
+    """
+    return '_'.join([RUN['pipeline']] + [str(RUN['tags'][tag]) for tag in sorted(RUN['tags'])])
+
+
+def stage_metrics(name):
+    """
+    Returns the metrics of the stage of the current run, created if needed
+    :param name: string, the name of the stage
+    :return: dict of the metrics of the stage
+    """
+    if name not in RUN['stages']:
+        RUN['stages'][name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                               'counters': {}}
+    return RUN['stages'][name]
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager timing the stage of the current run, the stages can be
+    nested (the inner ones are included in the time of the outer ones)
+    :param name: string, the name of the stage (e.g. 'query', 'write')
+    """
+    if RUN is None:
+        yield
+        return
+
+    entry = {'name': name, 'peak': 0}
+    if RUN['tracemalloc']:
+        if len(RUN['stack']) > 0:
+            parent = RUN['stack'][-1]
+            parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Python >= 3.9, otherwise the peak is the one of the run so far
+            tracemalloc.reset_peak()
+    RUN['stack'].append(entry)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        RUN['stack'].pop()
+        metrics = stage_metrics(name)
+        metrics['calls'] += 1
+        metrics['seconds'] += elapsed
+        metrics['max_seconds'] = max(metrics['max_seconds'], elapsed)
+        if RUN['tracemalloc']:
+            entry['peak'] = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+            metrics['peak_bytes'] = max(metrics.get('peak_bytes', 0), entry['peak'])
+            if len(RUN['stack']) > 0:
+                parent = RUN['stack'][-1]
+                parent['peak'] = max(parent['peak'], entry['peak'])
+
+
+def count(name, value=1):
+    """
+    Add the value to the counter of the stage running (or of the whole run
+    outside of any stage) and to the total of the run
+    :param name: string, the name of the counter (e.g. 'rows', 'bytes')
+    :param value: number to add
+    """
+    if RUN is None:
+        return
+    RUN['counters'][name] = RUN['counters'].get(name, 0) + value
+    if len(RUN['stack']) > 0:
+        counters = stage_metrics(RUN['stack'][-1]['name'])['counters']
+        counters[name] = counters.get(name, 0) + value
+
+
+def stop_profilers():
+    """
+    Stop the profilers of the current run, dump the cProfile statistics to
+    PIPELINE_PROFILE_DIR and returns the peak of memory of the run
+    :return: int, the peak of memory allocated in bytes, or None without tracemalloc
+    """
+    peak = None
+    if RUN['tracemalloc']:
+        peak = max([tracemalloc.get_traced_memory()[1]]
+                   + [m.get('peak_bytes', 0) for m in RUN['stages'].values()])
+        tracemalloc.stop()
+        RUN['tracemalloc'] = False
+
+    if RUN['profiler'] is not None:
+        RUN['profiler'].disable()
+        directory = os.environ.get(PROFILE_DIR_ENV, PROFILE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, run_name() + '_'
+                            + RUN['time'].strftime('%Y%m%dT%H%M%SZ') + '.prof')
+        RUN['profiler'].dump_stats(path)
+        RUN['profiler'] = None
+        print('Profile of the run written to ' + path
+              + ' (python3 -m pstats ' + path + ')')
+    return peak
+
+
+def make_points(success=True, peak=None):
+    """
+    Make the influxdb points of the metrics of the current run : one per
+    stage, and one for the whole run (stage 'run'). The counters are floats,
+    so a field has always the same type
+    :param success: boolean, True if the run succeeded
+    :param peak: int, the peak of memory allocated by the run in bytes, or None
+    :return: list of the points (dict)
+    """
+    timestamp = RUN['time'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    points = []
+    for name, metrics in RUN['stages'].items():
+        fields = {'calls': metrics['calls'],
+                  'seconds': float(metrics['seconds']),
+                  'max_seconds': float(metrics['max_seconds'])}
+        if 'peak_bytes' in metrics:
+            fields['peak_bytes'] = float(metrics['peak_bytes'])
+        for counter, value in metrics['counters'].items():
+            fields[counter] = float(value)
+        points.append({'measurement': MEASUREMENT,
+                       'tags': dict(RUN['tags'], pipeline=RUN['pipeline'], stage=name),
+                       'time': timestamp,
+                       'fields': fields})
+
+    fields = {'seconds': float(time.perf_counter() - RUN['start']),
+              'success': bool(success)}
+    if peak is not None:
+        fields['peak_bytes'] = float(peak)
+    for counter, value in RUN['counters'].items():
+        fields[counter] = float(value)
+    points.append({'measurement': MEASUREMENT,
+                   'tags': dict(RUN['tags'], pipeline=RUN['pipeline'], stage=RUN_STAGE),
+                   'time': timestamp,
+                   'fields': fields})
+    return points
+
+
+def prometheus_name(name):
+    """
+    Returns the given name with only the characters allowed in a Prometheus
+    metric name
+    :param name: string
+    :return: string
+    """
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
+
+
+def write_textfile(points, directory):
+    """
+    Write the metrics of the run to the Prometheus text file
+    <directory>/pipeline_<run name>.prom (see run_name), atomically so the
+    collector never reads half a file. Each field is a gauge pipeline_<field>
+    labelled by pipeline, stage and the tags of the run, plus the time of the
+    end of the run
+    :param points: list of the points of the run (see make_points)
+    :param directory: string, the directory of the text files
+    """
+    run_labels = ''.join(',' + prometheus_name(tag) + '="' + str(RUN['tags'][tag]) + '"'
+                         for tag in sorted(RUN['tags']))
+    gauges = {}
+    for point in points:
+        labels = ('{pipeline="' + RUN['pipeline'] + '",stage="'
+                  + point['tags']['stage'] + '"' + run_labels + '}')
+        for field, value in point['fields'].items():
+            gauges.setdefault('pipeline_' + prometheus_name(field), []).append(
+                labels + ' ' + repr(float(value)))
+    gauges['pipeline_last_run_timestamp_seconds'] = [
+        '{pipeline="' + RUN['pipeline'] + '"' + run_labels + '} ' + repr(time.time())]
+
+    lines = []
+    for name, samples in sorted(gauges.items()):
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.extend(name + sample for sample in samples)
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'pipeline_' + prometheus_name(run_name()) + '.prom')
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    # The collector only reads the *.prom files, and needs to read them
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def finish_run(client=None, success=True, textfile_dir=None):
+    """
+    Stop recording the current run, and write its metrics to the measurement
+    'pipeline_metrics' and / or to the Prometheus text file. A failure to
+    write them is only printed, the metrics must never make a run fail
+    :param client: the influxdb client to write the points to, or None
+    :param success: boolean, True if the run succeeded
+    :param textfile_dir: string, the directory of the Prometheus text files,
+                         by default the environment variable
+                         PIPELINE_METRICS_TEXTFILE_DIR, None for no text file
+    :return: list of the points of the run, or None without start_run
+    """
+    global RUN
+    if RUN is None:
+        return None
+
+    peak = stop_profilers()
+    points = make_points(success, peak)
+
+    if client is not None and os.environ.get(INFLUX_ENV, '1') != '0':
+        try:
+            line_protocol.write_points(client, points)
+        except Exception as e:
+            print('Failed to write the metrics of the run : ' + str(e))
+
+    if textfile_dir is None:
+        textfile_dir = os.environ.get(TEXTFILE_DIR_ENV)
+    if textfile_dir:
+        try:
+            write_textfile(points, textfile_dir)
+        except OSError as e:
+            print('Failed to write the Prometheus text file : ' + str(e))
+
+    RUN = None
+    return points
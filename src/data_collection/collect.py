@@ -6,79 +6,88 @@
 #   1) Collect the temperature, the pressure and the humidity
 #      from the SenseHat sensor. While it is measuring, it displays
 #      a shape on the LED matrix
-#   2) It creates a directory with the following format name 'YYYYMMDDHHmm'
-#   3) It writes the measured data into that directory
-#      as a dictionnary using json format
+#   2) It appends the measured data to the spool (see spool.py)
+#      as a dictionnary using json format, tagged with the source of the
+#      device (--source, one per SenseHat when there are several)
 
-import json
 import time
-from pathlib import Path
-from datetime import datetime
+import argparse
+from datetime import datetime, timezone
 from sense_hat import SenseHat
-
-sensor = SenseHat()
-sensor.set_rotation(270)
-
-# Display the letter 'M' (for measuring) in green on white background
-sensor.show_letter('M', [0, 255, 0])
-
-# Temperature in Celsius
-temperature = float(sensor.get_temperature())
-temperature_from_pressure = float(sensor.get_temperature_from_pressure())
-temperature_from_humidity = float(sensor.get_temperature_from_humidity())
-
-# Relative percentage of humidity
-humidity = float(sensor.get_humidity())
-
-# Pressure in Millibars
-pressure = float(sensor.get_pressure())
-
-# Get the current time of the measurement
-timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-data = {
-        'measurement': 'data',
-        'tags': {
-            'source': 'sensehat'
-        },
-        'time': timestamp,
-        'fields': {
-            'temperature': temperature,
-            'temperature_pressure': temperature_from_pressure,
-            'temperature_humidity': temperature_from_humidity,
-            'humidity': humidity,
-            'pressure': pressure
-        }
-}
-
-# Get the date and time
-cur_time = datetime.now().strftime("%Y%m%d%H%M")
-
-# Creates the directory
-Path("volume/"+cur_time).mkdir(exist_ok=True)
-
-# Writes the data in the file data.json
-with open('volume/'+cur_time+'/data.json', 'w') as write_file:
-    json.dump(data, write_file)
-
-time.sleep(5)
-
-# Check if there was an error before
-pixel = sensor.get_pixel(0, 7)
-
-# If yes, keep the error marker on the LEDs
-if pixel[0] != 0:
-    x = [255, 0, 0]
-    o = [0, 0, 0]
-    error = [
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, o, o,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x]
-    sensor.set_pixels(error)
-else:
-    sensor.clear()
+import spool
+
+# Tag source of the points, the name of the device
+SOURCE = 'sensehat'
+
+
+def main(source=SOURCE):
+    """
+    Sample the SenseHat once and append the sample to the spool
+    :param source: string, the tag source of the point
+    """
+    sensor = SenseHat()
+    sensor.set_rotation(270)
+
+    # Display the letter 'M' (for measuring) in green on white background
+    sensor.show_letter('M', [0, 255, 0])
+
+    # Temperature in Celsius
+    temperature = float(sensor.get_temperature())
+    temperature_from_pressure = float(sensor.get_temperature_from_pressure())
+    temperature_from_humidity = float(sensor.get_temperature_from_humidity())
+
+    # Relative percentage of humidity
+    humidity = float(sensor.get_humidity())
+
+    # Pressure in Millibars
+    pressure = float(sensor.get_pressure())
+
+    # Get the current time of the measurement
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    data = {
+            'measurement': 'data',
+            'tags': {
+                'source': source
+            },
+            'time': timestamp,
+            'fields': {
+                'temperature': temperature,
+                'temperature_pressure': temperature_from_pressure,
+                'temperature_humidity': temperature_from_humidity,
+                'humidity': humidity,
+                'pressure': pressure
+            }
+    }
+
+    # Appends the data to the spool
+    spool.append([data])
+
+    time.sleep(5)
+
+    # Check if there was an error before
+    pixel = sensor.get_pixel(0, 7)
+
+    # If yes, keep the error marker on the LEDs
+    if pixel[0] != 0:
+        x = [255, 0, 0]
+        o = [0, 0, 0]
+        error = [
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, o, o,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x]
+        sensor.set_pixels(error)
+    else:
+        sensor.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sample the SenseHat once')
+    parser.add_argument('--source', default=SOURCE,
+                        help='tag source of the samples, the name of the device')
+    main(parser.parse_args().source)
@@ -0,0 +1,210 @@
+#!/bin/python3
+
+# This script (resident version of collect.py) :
+#   1) Initializes the SenseHat sensor once, then samples the temperature,
+#      the pressure and the humidity every SAMPLE_PERIOD seconds into an
+#      in-memory ring buffer
+#   2) At the end of every AGGREGATE_PERIOD (aligned on the clock, e.g.
+#      **00 and **30), it appends to the spool (see spool.py) :
+#       a) a point in 'data' with the mean of each field over the interval,
+#          so it is used by clean.py as the samples of collect.py were
+#       b) a point in 'data_stats' with the min, the max and the number of
+#          samples of each field over the interval
+#   3) On SIGTERM / SIGINT, the current interval is emitted before exiting
+#   4) The buffering and the aggregation of the intervals (make_buffer,
+#      take_sample, end_interval) are shared with ingest_service.py
+#   The points are tagged with the source of the device (--source), so several
+#   SenseHat can send their data to the same database
+
+import time
+import signal
+import logging
+import argparse
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+import spool
+
+# ------------------------------------------------------------------------------
+# Constants
+SAMPLE_PERIOD = 5
+AGGREGATE_PERIOD = 30 * 60
+
+FIELDS = ['temperature', 'temperature_pressure', 'temperature_humidity',
+          'humidity', 'pressure']
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Tag source of the points, the name of the device
+SOURCE = 'sensehat'
+
+# Logger of the data collection (see transfer_db.py)
+LOGGER = logging.getLogger('data_collection')
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def read_sensor(sensor):
+    """
+    Read all the fields from the SenseHat sensor, in the order of FIELDS
+    :param sensor: the SenseHat sensor
+    :return: tuple of the values of the fields
+    """
+    return (float(sensor.get_temperature()),
+            float(sensor.get_temperature_from_pressure()),
+            float(sensor.get_temperature_from_humidity()),
+            float(sensor.get_humidity()),
+            float(sensor.get_pressure()))
+
+
+def aggregate(samples, interval_start, source=SOURCE):
+    """
+    Aggregate the samples of an interval into the points to append to the spool
+    :param samples: list of the tuples of the values of the fields (see read_sensor)
+    :param interval_start: int, the start of the interval, in seconds since the epoch
+    :param source: string, the tag source of the points
+    :return: list of the points, empty if there is no sample
+    """
+    if len(samples) == 0:
+        return []
+
+    values = np.array(samples, dtype=np.float64)
+    means = np.nanmean(values, axis=0)
+    mins = np.nanmin(values, axis=0)
+    maxs = np.nanmax(values, axis=0)
+
+    timestamp = datetime.fromtimestamp(interval_start, timezone.utc).strftime(TIME_FORMAT)
+    stats = {'count': len(samples)}
+    for i in range(len(FIELDS)):
+        stats[FIELDS[i] + '_min'] = float(mins[i])
+        stats[FIELDS[i] + '_max'] = float(maxs[i])
+
+    return [{'measurement': 'data',
+             'tags': {'source': source},
+             'time': timestamp,
+             'fields': {FIELDS[i]: float(means[i]) for i in range(len(FIELDS))}},
+            {'measurement': 'data_stats',
+             'tags': {'source': source},
+             'time': timestamp,
+             'fields': stats}]
+
+
+def make_buffer(sample_period=SAMPLE_PERIOD, aggregate_period=AGGREGATE_PERIOD):
+    """
+    Make the ring buffer of the samples of an interval, sized with some
+    margin, the oldest samples are dropped if it is ever full
+    :param sample_period: float, the period between 2 samples, in seconds
+    :param aggregate_period: int, the duration of an interval, in seconds
+    :return: the deque of the samples
+    """
+    return deque(maxlen=int(2 * aggregate_period / sample_period) + 1)
+
+
+def interval_of(now, aggregate_period=AGGREGATE_PERIOD):
+    """
+    Returns the start of the interval of the given time, aligned on the clock
+    :param now: float, the time in seconds since the epoch
+    :param aggregate_period: int, the duration of an interval, in seconds
+    :return: int, the start of the interval in seconds since the epoch
+    """
+    return int(now) // aggregate_period * aggregate_period
+
+
+def take_sample(sensor, buffer):
+    """
+    Read the sensor and add the sample to the buffer, a failed read is
+    logged and skipped
+    :param sensor: the SenseHat sensor
+    :param buffer: the deque of the samples of the interval (see make_buffer)
+    """
+    try:
+        buffer.append(read_sensor(sensor))
+    except OSError as e:
+        LOGGER.warning('Failed to read the sensor : %s', e)
+
+
+def end_interval(buffer, interval_start, now, aggregate_period=AGGREGATE_PERIOD,
+                 source=SOURCE):
+    """
+    Close the interval if it is over : its samples are aggregated and the
+    buffer is cleared for the next one
+    :param buffer: the deque of the samples of the interval (see make_buffer)
+    :param interval_start: int, the start of the interval, in seconds since the epoch
+    :param now: float, the current time in seconds since the epoch
+    :param aggregate_period: int, the duration of an interval, in seconds
+    :param source: string, the tag source of the points
+    :return: (list of the points to append to the spool, empty if the interval
+             is not over, start of the current interval)
+    """
+    if now < interval_start + aggregate_period:
+        return [], interval_start
+    points = aggregate(list(buffer), interval_start, source)
+    buffer.clear()
+    return points, interval_of(now, aggregate_period)
+
+
+def run(sample_period=SAMPLE_PERIOD, aggregate_period=AGGREGATE_PERIOD, source=SOURCE):
+    """
+    Sample the sensor and emit the aggregates until SIGTERM / SIGINT
+    :param sample_period: float, the period between 2 samples, in seconds
+    :param aggregate_period: int, the duration of an interval, in seconds
+    :param source: string, the tag source of the points
+    """
+    # Only needed by the collection, the helpers above are used without it
+    from sense_hat import SenseHat
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    sensor = SenseHat()
+    sensor.set_rotation(270)
+    sensor.clear()
+
+    buffer = make_buffer(sample_period, aggregate_period)
+    interval_start = interval_of(time.time(), aggregate_period)
+    next_sample = time.monotonic()
+
+    while not stopping:
+        points, interval_start = end_interval(buffer, interval_start, time.time(),
+                                              aggregate_period, source)
+        spool.append(points)
+        take_sample(sensor, buffer)
+
+        # Keep a regular pace, whatever the time taken to read the sensor
+        next_sample += sample_period
+        delay = next_sample - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_sample = time.monotonic()
+
+    # Emit the samples of the interval not finished yet
+    spool.append(aggregate(list(buffer), interval_start, source))
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident SenseHat collector')
+    parser.add_argument('--sample-period', type=float, default=SAMPLE_PERIOD,
+                        help='period between 2 samples, in seconds')
+    parser.add_argument('--aggregate-period', type=int, default=AGGREGATE_PERIOD,
+                        help='duration of an aggregated interval, in seconds')
+    parser.add_argument('--source', default=SOURCE,
+                        help='tag source of the points, the name of the device')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    run(args.sample_period, args.aggregate_period, args.source)
@@ -0,0 +1,240 @@
+#!/bin/python3
+
+# This script (replaces the collect.py / collect_daemon.py, transfer_db.py and
+# fetch_open_data.py cron jobs, do not use both) :
+#   1) Runs as a single resident asyncio service, so python, numpy, requests
+#      and the SenseHat are loaded and initialized once, the credentials are
+#      read once and all the writes share one influxdb client (one pool of
+#      keep-alive connections), instead of a new interpreter for each job
+#   2) Hosts concurrent tasks :
+#       a) the collection : samples the SenseHat every SAMPLE_PERIOD seconds
+#          and appends the aggregates of every AGGREGATE_PERIOD to the spool,
+#          with the buffering and the aggregation of collect_daemon.py. The
+#          reads of the sensor and the synced appends to the spool block, they
+#          run in their own worker thread, so they never delay the event loop
+#       b) the upload of the spool (and of the old volume samples) every
+#          UPLOAD_PERIOD seconds, at UPLOAD_OFFSET seconds after the end of
+#          an interval, as transfer_db.py, the result is shown on the LEDs
+#       c) the fetch of the MeteoSuisse open data every FETCH_PERIOD seconds,
+#          as fetch_open_data.py (same cache directory)
+#   3) The upload and the fetch run one at a time in a worker thread, so the
+#      event loop keeps sampling the sensor while they wait for the network,
+#      and they never use the influxdb client at the same time. A job still
+#      running at its next slot is not started again, its slot is skipped
+#   4) On SIGTERM / SIGINT, the current interval is appended to the spool
+#      (sent by the next upload), the job running is finished, then it exits
+#   5) The errors of all the tasks (sensor, spool, upload) are logged to the
+#      'data_collection' logger, with the time and the level of each message
+#
+# e.g. python3 ingest_service.py --fetch-period 7200
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import spool
+import collect_daemon
+import transfer_db
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import influx_client
+
+# The fetch of the open data, in the processing folder
+PROCESSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing')
+sys.path.append(PROCESSING_DIR)
+import fetch_open_data
+
+# ------------------------------------------------------------------------------
+# Constants
+SAMPLE_PERIOD = collect_daemon.SAMPLE_PERIOD
+AGGREGATE_PERIOD = collect_daemon.AGGREGATE_PERIOD
+
+# Upload at **05 and **35, as the transfer_db.py cron job
+UPLOAD_PERIOD = 30 * 60
+UPLOAD_OFFSET = 5 * 60
+
+# Fetch at **09 every 2 hours, as the fetch_open_data.py cron job
+FETCH_PERIOD = 2 * 60 * 60
+FETCH_OFFSET = 9 * 60
+
+FETCH_CACHE_DIR = os.path.join(PROCESSING_DIR, fetch_open_data.CACHE_DIR)
+
+LOGGER = logging.getLogger('data_collection')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+async def wait_stop(stopping, delay):
+    """
+    Wait for the given delay, or less if the service is stopping
+    :param stopping: the asyncio Event set to stop the service
+    :param delay: float, the delay in seconds
+    :return: True if the service is stopping
+    """
+    try:
+        await asyncio.wait_for(stopping.wait(), max(delay, 0))
+    except asyncio.TimeoutError:
+        pass
+    return stopping.is_set()
+
+
+def next_slot(now, period, offset):
+    """
+    Returns the next time of a job run every period seconds at offset
+    seconds after a multiple of the period (e.g. **05 and **35)
+    :param now: float, the current time in seconds since the epoch
+    :param period: int, the period of the job, in seconds
+    :param offset: int, the offset of the runs in the period, in seconds
+    :return: float, the time of the next run in seconds since the epoch
+    """
+    return ((now - offset) // period + 1) * period + offset
+
+
+async def collect(sensor, stopping, sample_period=SAMPLE_PERIOD,
+                  aggregate_period=AGGREGATE_PERIOD, source=collect_daemon.SOURCE,
+                  executor=None):
+    """
+    Sample the sensor and append the aggregates to the spool until the service
+    stops (see collect_daemon.run)
+    :param sensor: the SenseHat sensor
+    :param stopping: the asyncio Event set to stop the service
+    :param sample_period: float, the period between 2 samples, in seconds
+    :param aggregate_period: int, the duration of an interval, in seconds
+    :param source: string, the tag source of the points
+    :param executor: the ThreadPoolExecutor reading the sensor and appending
+                     to the spool, or None for the default one of the loop
+    """
+    loop = asyncio.get_running_loop()
+    buffer = collect_daemon.make_buffer(sample_period, aggregate_period)
+    interval_start = collect_daemon.interval_of(time.time(), aggregate_period)
+    next_sample = loop.time()
+
+    while not stopping.is_set():
+        points, interval_start = collect_daemon.end_interval(
+            buffer, interval_start, time.time(), aggregate_period, source)
+        if len(points) > 0:
+            await loop.run_in_executor(executor, spool.append, points)
+        await loop.run_in_executor(executor, collect_daemon.take_sample, sensor, buffer)
+
+        # Keep a regular pace, whatever the time taken to read the sensor
+        next_sample += sample_period
+        if next_sample < loop.time():
+            next_sample = loop.time()
+        await wait_stop(stopping, next_sample - loop.time())
+
+    # Emit the samples of the interval not finished yet
+    await loop.run_in_executor(executor, spool.append,
+                               collect_daemon.aggregate(list(buffer), interval_start,
+                                                        source))
+
+
+async def schedule(name, job, period, offset, executor, stopping):
+    """
+    Run the job in the worker thread at each slot (see next_slot) until the
+    service stops. The job is never started twice at once : the slots passed
+    while it runs are skipped
+    :param name: string, the name of the job, for the logs
+    :param job: function without argument running the job
+    :param period: int, the period of the job, in seconds
+    :param offset: int, the offset of the runs in the period, in seconds
+    :param executor: the ThreadPoolExecutor running the jobs
+    :param stopping: the asyncio Event set to stop the service
+    """
+    loop = asyncio.get_running_loop()
+    while not await wait_stop(stopping, next_slot(time.time(), period, offset) - time.time()):
+        start = time.time()
+        try:
+            await loop.run_in_executor(executor, job)
+        except Exception as e:
+            # A failed run must not stop the service, the next one retries
+            LOGGER.error('Job %s failed : %r', name, e)
+        elapsed = time.time() - start
+        if elapsed > period:
+            LOGGER.warning('Job %s took %d s, %d run(s) skipped', name,
+                           int(elapsed), int(elapsed // period))
+
+
+async def serve(args):
+    """
+    Run the tasks of the service until SIGTERM / SIGINT
+    :param args: the parsed arguments of the script
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    # Only needed by the service, the tasks are used without it
+    from sense_hat import SenseHat
+    sensor = SenseHat()
+    sensor.set_rotation(270)
+    sensor.clear()
+
+    # One client for all the writes, the worker runs one job at a time, the
+    # collection has its own worker so a long job never delays the samples
+    client = influx_client.connect_writer()
+    executor = ThreadPoolExecutor(max_workers=1)
+    sensor_executor = ThreadPoolExecutor(max_workers=1)
+
+    def upload():
+        transfer_db.show_status(sensor, transfer_db.transfer(client))
+
+    def fetch():
+        fetch_open_data.main(cache_dir=args.fetch_cache_dir, client=client)
+
+    tasks = [collect(sensor, stopping, args.sample_period, args.aggregate_period,
+                     args.source, sensor_executor),
+             schedule('upload', upload, args.upload_period, args.upload_offset,
+                      executor, stopping)]
+    if args.fetch_period > 0:
+        tasks.append(schedule('fetch', fetch, args.fetch_period, args.fetch_offset,
+                              executor, stopping))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        sensor_executor.shutdown(wait=True)
+        executor.shutdown(wait=True)
+        client.close()
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident ingestion service : '
+                                     'collection, upload and open data')
+    parser.add_argument('--sample-period', type=float, default=SAMPLE_PERIOD,
+                        help='period between 2 samples, in seconds')
+    parser.add_argument('--aggregate-period', type=int, default=AGGREGATE_PERIOD,
+                        help='duration of an aggregated interval, in seconds')
+    parser.add_argument('--source', default=collect_daemon.SOURCE,
+                        help='tag source of the points, the name of the device')
+    parser.add_argument('--upload-period', type=int, default=UPLOAD_PERIOD,
+                        help='period of the uploads of the spool, in seconds')
+    parser.add_argument('--upload-offset', type=int, default=UPLOAD_OFFSET,
+                        help='offset of the uploads in their period, in seconds')
+    parser.add_argument('--fetch-period', type=int, default=FETCH_PERIOD,
+                        help='period of the fetches of the open data, in '
+                             'seconds, 0 to not fetch them')
+    parser.add_argument('--fetch-offset', type=int, default=FETCH_OFFSET,
+                        help='offset of the fetches in their period, in seconds')
+    parser.add_argument('--fetch-cache-dir', default=FETCH_CACHE_DIR,
+                        help='cache directory of the open data')
+    parser.add_argument('--log-level', default='INFO',
+                        help='level of the logged messages (e.g. WARNING)')
+    args = parser.parse_args()
+    logging.basicConfig(format=LOG_FORMAT, level=args.log_level)
+    asyncio.run(serve(args))
@@ -0,0 +1,233 @@
+#!/bin/python3
+
+# This module :
+#   1) Stores the data samples in an append-only spool : each sample is one
+#      json line appended to the current segment file 'NNNNNNNNNNNN.jsonl' in
+#      the spool directory. When the segment reaches SEGMENT_MAX_BYTES, a new
+#      one is started, so there is one file per segment instead of one
+#      directory per sample
+#   2) Each append is synced to the disk. A line cut by a crash (no trailing
+#      '\n') is never read, and the next append starts a new segment
+#   3) Reads the segments (memory-mapped) by batches of samples, from the
+#      offset acknowledged so far, which is stored in 'NNNNNNNNNNNN.ack'.
+#      A fully acknowledged segment is removed, except the newest one which
+#      may still be appended to
+
+import os
+import mmap
+import json
+import logging
+import tempfile
+
+# ------------------------------------------------------------------------------
+# Constants
+SPOOL_DIR = 'volume/spool'
+
+# Size after which a new segment is started
+SEGMENT_MAX_BYTES = 1024 * 1024
+
+SEGMENT_SUFFIX = '.jsonl'
+ACK_SUFFIX = '.ack'
+
+# Logger of the data collection (see transfer_db.py)
+LOGGER = logging.getLogger('data_collection')
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def list_segments(spool_dir=SPOOL_DIR):
+    """
+    List the segments in the spool directory, oldest first
+    :param spool_dir: string, the path of the spool directory
+    :return: the sorted list of the paths of the segments
+    """
+    if not os.path.isdir(spool_dir):
+        return []
+    return sorted(os.path.join(spool_dir, name) for name in os.listdir(spool_dir)
+                  if name.endswith(SEGMENT_SUFFIX))
+
+
+def segment_path(spool_dir, number):
+    """
+    Returns the path of the segment with the given number
+    :param spool_dir: string, the path of the spool directory
+    :param number: int, the number of the segment
+    :return: string of the path of the segment
+    """
+    return os.path.join(spool_dir, '%012d' % number + SEGMENT_SUFFIX)
+
+
+def ends_with_newline(path):
+    """
+    Check if the given segment is empty or ends with a complete line,
+    i.e. the last append to it was not cut by a crash
+    :param path: string, the path of the segment
+    :return: True if the segment can be appended to, False otherwise
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def current_segment(spool_dir=SPOOL_DIR, max_bytes=SEGMENT_MAX_BYTES):
+    """
+    Returns the path of the segment to append to : the newest one, or a new
+    one if there is none, if it is full or if its last line is incomplete
+    :param spool_dir: string, the path of the spool directory
+    :param max_bytes: int, the size after which a new segment is started
+    :return: string of the path of the segment
+    """
+    segments = list_segments(spool_dir)
+    if len(segments) == 0:
+        return segment_path(spool_dir, 0)
+
+    newest = segments[-1]
+    if os.path.getsize(newest) < max_bytes and ends_with_newline(newest):
+        return newest
+    number = int(os.path.basename(newest)[:-len(SEGMENT_SUFFIX)])
+    return segment_path(spool_dir, number + 1)
+
+
+def append(records, spool_dir=SPOOL_DIR, max_bytes=SEGMENT_MAX_BYTES):
+    """
+    Append the given samples to the spool, with a single write and sync
+    :param records: list of dict, the samples (points) to append
+    :param spool_dir: string, the path of the spool directory
+    :param max_bytes: int, the size after which a new segment is started
+    """
+    if len(records) == 0:
+        return
+
+    os.makedirs(spool_dir, exist_ok=True)
+    data = ''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                   for record in records).encode()
+
+    fd = os.open(current_segment(spool_dir, max_bytes),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_ack(path):
+    """
+    Returns the offset acknowledged so far in the given segment
+    :param path: string, the path of the segment
+    :return: int, the offset in bytes (0 if nothing was acknowledged)
+    """
+    try:
+        with open(path[:-len(SEGMENT_SUFFIX)] + ACK_SUFFIX, 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def write_ack(path, offset):
+    """
+    Write atomically the offset acknowledged so far in the given segment
+    :param path: string, the path of the segment
+    :param offset: int, the offset in bytes
+    """
+    ack_path = path[:-len(SEGMENT_SUFFIX)] + ACK_SUFFIX
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(ack_path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ack_path)
+
+
+def read_records(path, offset=0, max_records=None):
+    """
+    Read the complete lines of the given segment from the given offset,
+    using a memory map of the segment. Lines that are not valid json are skipped
+    :param path: string, the path of the segment
+    :param offset: int, the offset in bytes to read from
+    :param max_records: int, maximum number of samples to read, or None for all
+    :return: (list of the samples, offset right after the last line read)
+    """
+    records = []
+    if os.path.getsize(path) <= offset:
+        return records, offset
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        while max_records is None or len(records) < max_records:
+            end = m.find(b'\n', offset)
+            if end == -1:
+                # No complete line anymore
+                break
+            line = m[offset:end]
+            offset = end + 1
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                LOGGER.warning('Skipping invalid record in %s', path)
+    return records, offset
+
+
+def iter_batches(spool_dir=SPOOL_DIR, batch_size=500):
+    """
+    Generator of the batches of samples not acknowledged yet, oldest first.
+    A batch contains samples of a single segment
+    :param spool_dir: string, the path of the spool directory
+    :param batch_size: int, maximum number of samples in a batch
+    :return: generator of (path of the segment, list of samples, end offset)
+    """
+    for path in list_segments(spool_dir):
+        offset = read_ack(path)
+        while True:
+            records, end = read_records(path, offset, batch_size)
+            if len(records) == 0 and end == offset:
+                break
+            yield path, records, end
+            if not os.path.exists(path):
+                # The whole segment was acknowledged and removed
+                break
+            offset = end
+
+
+def acknowledge(path, offset, spool_dir=SPOOL_DIR):
+    """
+    Acknowledge the samples of the given segment up to the given offset.
+    If the whole segment is acknowledged and it is not the newest one
+    (which may still be appended to), it is removed
+    :param path: string, the path of the segment
+    :param offset: int, the end offset of the acknowledged batch
+    :param spool_dir: string, the path of the spool directory
+    """
+    write_ack(path, offset)
+    if offset >= os.path.getsize(path) and path != list_segments(spool_dir)[-1]:
+        remove_segment(path)
+
+
+def remove_segment(path):
+    """
+    Remove the given segment and its acknowledged offset
+    :param path: string, the path of the segment
+    """
+    os.remove(path)
+    ack_path = path[:-len(SEGMENT_SUFFIX)] + ACK_SUFFIX
+    if os.path.exists(ack_path):
+        os.remove(ack_path)
+
+
+def purge(spool_dir=SPOOL_DIR):
+    """
+    Remove the segments that have no complete line left to acknowledge,
+    except the newest one. This also removes a segment whose last line was
+    cut by a crash, once all its complete lines are acknowledged
+    :param spool_dir: string, the path of the spool directory
+    """
+    for path in list_segments(spool_dir)[:-1]:
+        records, _ = read_records(path, read_ack(path), max_records=1)
+        if len(records) == 0:
+            remove_segment(path)
@@ -0,0 +1,28 @@
+#!/bin/bash
+
+# This script :
+#   1) Create (if not here) a directory 'volume' used to store the data
+#      temporarily
+#   2) Starts the resident collector collect_daemon.py in the background
+#      (instead of the collect.py cron job of start_collecting.sh, do not
+#      use both), and makes it start again at reboot
+#   3) Sets the cron job sending the data to the db every half hour
+
+DIR=/home/pi/RaspberryProjects/weather_monitoring/Weather_monitoring/src/data_collection
+
+# Creates the volume directory of the host if it does not exist
+mkdir -p volume
+
+# Starts the collector, its pid is kept to stop it
+nohup python3 collect_daemon.py >> collect_daemon.log 2>&1 &
+echo $! > collect_daemon.pid
+
+# write out current crontab
+crontab -l > mycron
+# echo new cron into cron file
+echo "@reboot cd $DIR && nohup python3 collect_daemon.py >> collect_daemon.log 2>&1 & echo \$! > $DIR/collect_daemon.pid" >> mycron
+echo "5,35 * * * * cd $DIR && python3 transfer_db.py" >> mycron
+
+# install new cron file
+crontab mycron
+rm mycron
@@ -0,0 +1,38 @@
+#!/bin/bash
+
+# This script :
+#   1) Create (if not here) a directory 'volume' used to store the data
+#      temporarily
+#   2) Removes the cron jobs and stops the collector it replaces
+#      (collect.py, collect_daemon.py, transfer_db.py, fetch_open_data.py)
+#   3) Starts the resident service ingest_service.py in the background
+#      (collection, upload to the db and fetch of the open data), and makes
+#      it start again at reboot
+
+DIR=/home/pi/RaspberryProjects/weather_monitoring/Weather_monitoring/src/data_collection
+
+# Creates the volume directory of the host if it does not exist
+mkdir -p volume
+
+# Stops the jobs done by the service, they must not run twice
+crontab -l 2>/dev/null | grep -v 'python3 collect.py' | crontab -
+crontab -l 2>/dev/null | grep -v 'python3 collect_daemon.py' | crontab -
+crontab -l 2>/dev/null | grep -v 'python3 transfer_db.py' | crontab -
+crontab -l 2>/dev/null | grep -v 'python3 fetch_open_data.py' | crontab -
+if [ -f collect_daemon.pid ]; then
+    kill -TERM "$(cat collect_daemon.pid)"
+    rm collect_daemon.pid
+fi
+
+# Starts the service, its pid is kept to stop it
+nohup python3 ingest_service.py >> ingest_service.log 2>&1 &
+echo $! > ingest_service.pid
+
+# write out current crontab
+crontab -l > mycron
+# echo new cron into cron file
+echo "@reboot cd $DIR && nohup python3 ingest_service.py >> ingest_service.log 2>&1 & echo \$! > $DIR/ingest_service.pid" >> mycron
+
+# install new cron file
+crontab mycron
+rm mycron
@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# This script :
+#   1) Stops the resident collector (the current interval is still written
+#      to the spool) and the cron jobs of start_collect_daemon.sh
+
+# Stops the cron jobs
+crontab -l 2>/dev/null | grep -v 'python3 collect_daemon.py' | crontab -
+crontab -l 2>/dev/null | grep -v 'python3 transfer_db.py' | crontab -
+
+# Stops the collector
+if [ -f collect_daemon.pid ]; then
+    kill -TERM "$(cat collect_daemon.pid)"
+    rm collect_daemon.pid
+fi
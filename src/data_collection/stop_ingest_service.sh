@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# This script :
+#   1) Stops the resident service (the current interval is still written
+#      to the spool, and the job running is finished) and its cron job of
+#      start_ingest_service.sh
+
+# Stops the cron job
+crontab -l 2>/dev/null | grep -v 'python3 ingest_service.py' | crontab -
+
+# Stops the service
+if [ -f ingest_service.pid ]; then
+    kill -TERM "$(cat ingest_service.pid)"
+    rm ingest_service.pid
+fi
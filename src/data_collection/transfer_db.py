@@ -1,83 +1,233 @@
 #!/bin/python3
 
 # This script :
-#   1) Walks through all data samples in the volume directory and send them
-#   2) If one of them fails to send, we keep it, otherwise, if it was succesful,
-#      we remove it
+#   1) Walks through all data samples in the volume directory (the old one
+#      directory per sample format) and then in the spool (see spool.py),
+#      oldest first, and sends them by batches of at most BATCH_SIZE samples
+#   2) Once a batch is acknowledged by the influxdb server, its samples are
+#      removed, if a batch fails to send, we keep it and all the following ones,
+#      the next run resumes from there. When catching up (e.g. after a network
+#      outage), it waits PACE_SECONDS between batches to not flood the link
+#   3) The time taken to read and send the batches and the number of samples
+#      sent are written to the measurement 'pipeline_metrics' (see
+#      common/metrics.py)
 
 import os
-from os.path import join
+import sys
+import time
 import shutil
 import json
-from influxdb import InfluxDBClient
-from sense_hat import SenseHat
+import logging
+import argparse
+import spool
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+import influx_client
+import line_protocol
 
 
 # ------------------------------------------------------------------------------
 # Constants
-CREDENTIALS_FILE = '../credentials.txt'
-# =================================================================
-# Read the credentials in the file, omit the last char that is '\n'
-# when using readline
-with open(CREDENTIALS_FILE, 'r') as f:
-    IP_RP4 = f.readline()[:-1]
-    PORT = f.readline()[:-1]
-    USER_NAME = f.readline()[:-1]
-    PWD = f.readline()[:-1]
-    DB_NAME = f.readline()[:-1]
-
-# =================================================================
+VOLUME = 'volume'
+
+# Maximum number of samples sent in one request
+BATCH_SIZE = 500
+
+# Pause between 2 batches, in seconds
+PACE_SECONDS = 2
+
+# The errors of the data collection are all reported to this logger, which
+# ingest_service.py configures
+LOGGER = logging.getLogger('data_collection')
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def list_samples(volume=VOLUME):
+    """
+    List the data samples directories in the volume directory, oldest first
+    (the directories are named 'YYYYMMDDHHmm'). Only the direct
+    sub-directories of volume are listed, the spool directory is not a sample
+    :param volume: string, the path of the volume directory
+    :return: the sorted list of the paths of the samples directories, empty if
+             there is no volume directory (e.g. only the spool is used)
+    """
+    spool_dir = os.path.abspath(spool.SPOOL_DIR)
+    try:
+        entries = list(os.scandir(volume))
+    except FileNotFoundError:
+        return []
+    return sorted(entry.path for entry in entries
+                  if entry.is_dir() and os.path.abspath(entry.path) != spool_dir)
+
+
+def read_samples(sample_dirs):
+    """
+    Read the data points of the given samples directories. The directories
+    without a readable data.json file are skipped (and kept)
+    :param sample_dirs: list of the paths of the samples directories
+    :return: (list of the points, list of the directories that were read)
+    """
+    points = []
+    read_dirs = []
+    for d in sample_dirs:
+        try:
+            with open(os.path.join(d, 'data.json')) as f:
+                points.append(json.load(f))
+        except (OSError, ValueError) as e:
+            LOGGER.warning('Skipping sample %s : %s', d, e)
+            continue
+        read_dirs.append(d)
+    return points, read_dirs
+
+
+def upload_samples(client, volume=VOLUME, batch_size=BATCH_SIZE,
+                   pace=PACE_SECONDS):
+    """
+    Send the data samples of the volume directory to the influxdb server by
+    batches, oldest first. The samples of a batch are removed only once the
+    batch is acknowledged by the server, and it stops at the first batch that
+    fails to send. Sending again a batch that was written but not removed
+    (e.g. after a crash) is harmless, as the server overwrites identical points
+    :param client: the influxdb client to write to
+    :param volume: string, the path of the volume directory
+    :param batch_size: int, maximum number of samples sent in one request
+    :param pace: float, pause in seconds between 2 batches
+    :return: True if all the samples were sent, False otherwise
+    """
+    samples = list_samples(volume)
+    for start in range(0, len(samples), batch_size):
+        if start > 0:
+            time.sleep(pace)
+
+        with metrics.stage('read'):
+            points, read_dirs = read_samples(samples[start:start + batch_size])
+        if len(points) > 0:
+            try:
+                with metrics.stage('send'):
+                    success = line_protocol.write_points(client, points, precision='ms')
+            except Exception as e:
+                LOGGER.error('Failed to send the batch starting at %s : %s',
+                             samples[start], e)
+                success = False
+            if not success:
+                return False
+            metrics.count('points', len(points))
+            metrics.count('batches')
+
+        # The batch is acknowledged, remove its samples from the volume
+        for d in read_dirs:
+            shutil.rmtree(d)
+    return True
+
+
+def upload_spool(client, spool_dir=spool.SPOOL_DIR, batch_size=BATCH_SIZE,
+                 pace=PACE_SECONDS):
+    """
+    Send the samples of the spool to the influxdb server by batches, oldest
+    first. The samples of a batch are acknowledged in the spool only once the
+    batch is acknowledged by the server, and it stops at the first batch that
+    fails to send (see upload_samples)
+    :param client: the influxdb client to write to
+    :param spool_dir: string, the path of the spool directory
+    :param batch_size: int, maximum number of samples sent in one request
+    :param pace: float, pause in seconds between 2 batches
+    :return: True if all the samples were sent, False otherwise
+    """
+    spool.purge(spool_dir)
+    first = True
+    for path, points, end in spool.iter_batches(spool_dir, batch_size):
+        if not first:
+            time.sleep(pace)
+        first = False
+
+        if len(points) > 0:
+            try:
+                with metrics.stage('send'):
+                    success = line_protocol.write_points(client, points, precision='ms')
+            except Exception as e:
+                LOGGER.error('Failed to send a batch of %s : %s', path, e)
+                success = False
+            if not success:
+                return False
+            metrics.count('points', len(points))
+            metrics.count('batches')
+            # The batch starts at the offset acknowledged so far
+            metrics.count('bytes', end - spool.read_ack(path))
+
+        spool.acknowledge(path, end, spool_dir)
+    return True
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
 # ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def transfer(client):
+    """
+    Send the samples of the volume directory and of the spool to the influxdb
+    server, and write the metrics of the run
+    :param client: the influxdb client to write to
+    :return: True if all the samples were sent, False otherwise
+    """
+    metrics.start_run('transfer_db')
+    success = False
+    try:
+        # Sends the data to the influxdb server, the samples left in the old
+        # format are older than the ones in the spool
+        success = upload_samples(client) and upload_spool(client)
+    finally:
+        metrics.finish_run(client, success)
+    return success
+
+
+def show_status(sensor, success):
+    """
+    Show the result of the transfer on the LEDs of the SenseHat
+    :param sensor: the SenseHat sensor
+    :param success: boolean, True if all the samples were sent
+    """
+    if success:
+        # Clear the LEDs on the senseHat, if there were a signal
+        sensor.clear()
+    else:
+        # Transfer crashed, display a red '!' on the
+        x = [255, 0, 0]
+        o = [0, 0, 0]
+        error = [
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, o, o,
+            o, o, o, o, o, o, x, x,
+            o, o, o, o, o, o, x, x]
+        sensor.set_pixels(error)
+
+
+def main():
+    # Connect to the influx db, a batch that fails to send (e.g. the link
+    # is down for a few seconds) is sent again before giving up the run
+    client = influx_client.connect_writer()
+    success = transfer(client)
+    client.close()
+
+    # Only needed for the LEDs, not loaded when transfer is used by ingest_service.py
+    from sense_hat import SenseHat
+    sensor = SenseHat()
+    sensor.set_rotation(270)
+    show_status(sensor, success)
+
 
-# The list of samples to write to the db
-points = []
-
-# Loop over all the directories (data samples) in  the volume directory
-for roots, dirs, files in os.walk('volume'):
-    # Read the data
-    for d in dirs:
-        with open(join(join('volume', d), 'data.json')) as f:
-            data = json.load(f)
-
-        points.append(data)
-
-# Connect to the influx db
-client = InfluxDBClient(host=IP_RP4,
-                        port=PORT,
-                        username=USER_NAME,
-                        password=PWD,
-                        database=DB_NAME,
-                        timeout=10)
-
-# Sends the data to the influxdb server
-success = client.write_points(points, time_precision='ms')
-
-client.close()
-
-sensor = SenseHat()
-sensor.set_rotation(270)
-
-if success:
-    # The transfer succeeded, remove the data samples from RP3 volume directory,
-    # have to walk through the directories in volume, because rmtree also deletes
-    # the root, i.e. the volume directory, but don't want that...
-    for roots, dirs, file in os.walk('volume'):
-        for d in dirs:
-            shutil.rmtree(join('volume', d))
-
-    # Also clear the LEDs on the senseHat, if there were a signal
-    sensor.clear()
-else:
-    # Transfer crashed, display a red '!' on the
-    x = [255, 0, 0]
-    o = [0, 0, 0]
-    error = [
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, o, o,
-        o, o, o, o, o, o, x, x,
-        o, o, o, o, o, o, x, x]
-    sensor.set_pixels(error)
+if __name__ == '__main__':
+    argparse.ArgumentParser(description='Send the spool to the influxdb server').parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    main()
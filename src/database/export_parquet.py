@@ -0,0 +1,229 @@
+#!/bin/python3
+
+# This script :
+#   1) Exports measurements of the influxdb server (by default the cleaned
+#      data 'clean_sh_data', optionally the raw data 'data') to Parquet files,
+#      one file per month : export/<measurement>/YYYY-MM.parquet
+#   2) Only the months from the last exported one are queried and written :
+#      the last month is written again (it was probably not complete at the
+#      last export), the older ones are never touched again
+#   3) Each month is queried and written separately, and atomically (through
+#      a temporary file), so the memory used does not grow with the history
+#      and an interrupted export leaves only complete files
+#   4) read_export reads the exported months back into a pandas dataframe,
+#      with memory mapped files and without copying the columns when possible
+#
+# e.g. python3 export_parquet.py --raw
+#      then, for the analysis : from export_parquet import read_export
+#                               df = read_export('clean_sh_data', start='2020-03')
+
+import os
+import sys
+import argparse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import influx_client
+
+# ------------------------------------------------------------------------------
+# Constants
+EXPORT_DIR = 'export'
+
+CLEAN_MEASUREMENT = 'clean_sh_data'
+RAW_MEASUREMENT = 'data'
+
+# Columns stored as dictionaries (few distinct values), i.e. the tags
+TAG_COLUMNS = ['source', 'station']
+
+COMPRESSION = 'zstd'
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def month_path(measurement, month, export_dir=EXPORT_DIR):
+    """
+    Returns the path of the file of the given month
+    :param measurement: string, the name of the measurement
+    :param month: pandas Period of the month
+    :param export_dir: string, the path of the export directory
+    :return: string of the path
+    """
+    return os.path.join(export_dir, measurement, str(month) + '.parquet')
+
+
+def exported_months(measurement, export_dir=EXPORT_DIR):
+    """
+    List the months already exported for the measurement
+    :param measurement: string, the name of the measurement
+    :param export_dir: string, the path of the export directory
+    :return: sorted list of the months, as pandas Periods
+    """
+    directory = os.path.join(export_dir, measurement)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(pd.Period(name[:-len('.parquet')], freq='M')
+                  for name in os.listdir(directory) if name.endswith('.parquet'))
+
+
+def query_first_month(client, measurement):
+    """
+    Query the month of the first point of the measurement
+    :param client: the influxdb client to query to
+    :param measurement: string, the name of the measurement
+    :return: pandas Period of the month, or None if the measurement is empty
+    """
+    points = client.query('SELECT * FROM "db"."autogen"."' + measurement
+                          + '" ORDER BY time ASC LIMIT 1').get_points()
+    for point in points:
+        return to_times(pd.Series([point['time']])).iloc[0].tz_localize(None).to_period('M')
+    return None
+
+
+def to_times(column):
+    """
+    Convert the time column returned by the influxdb client (epoch in ns or
+    RFC3339 strings) to UTC datetimes
+    :param column: pandas series of the times
+    :return: pandas series of the datetimes
+    """
+    if pd.api.types.is_integer_dtype(column):
+        return pd.to_datetime(column, unit='ns', utc=True)
+    return pd.to_datetime(column, utc=True)
+
+
+def query_month(client, measurement, month):
+    """
+    Query all the points of the measurement in the given month
+    :param client: the influxdb client to query to
+    :param measurement: string, the name of the measurement
+    :param month: pandas Period of the month
+    :return: pandas dataframe of the points, with a datetime 'time' column
+    """
+    start = month.start_time.tz_localize('UTC')
+    end = (month + 1).start_time.tz_localize('UTC')
+    query = ('SELECT * FROM "db"."autogen"."' + measurement + '" WHERE time >= \''
+             + start.strftime('%Y-%m-%dT%H:%M:%SZ') + '\' AND time < \''
+             + end.strftime('%Y-%m-%dT%H:%M:%SZ') + '\'')
+    # Decoded chunk by chunk into numpy columns, a month of raw data is
+    # never held as python dicts
+    df = pd.DataFrame(influx_client.query_columns(client, query))
+    if len(df.index) > 0:
+        df['time'] = to_times(df['time'])
+    return df
+
+
+def write_month(df, path):
+    """
+    Write the dataframe of a month to a Parquet file, through a temporary file
+    that replaces it, the tags are dictionary encoded
+    :param df: pandas dataframe of the points
+    :param path: string, the path of the file
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i in range(table.num_columns):
+        if table.column_names[i] in TAG_COLUMNS:
+            table = table.set_column(i, table.field(i).name,
+                                     table.column(i).dictionary_encode())
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression=COMPRESSION)
+    os.replace(tmp_path, path)
+
+
+def export_measurement(client, measurement, export_dir=EXPORT_DIR, until=None):
+    """
+    Export the months of the measurement not exported yet, and the last
+    exported one again
+    :param client: the influxdb client to query to
+    :param measurement: string, the name of the measurement
+    :param export_dir: string, the path of the export directory
+    :param until: pandas Period of the last month to export, by default
+                  the current month
+    :return: list of the exported months
+    """
+    if until is None:
+        until = pd.Timestamp.now(tz='UTC').tz_localize(None).to_period('M')
+    months = exported_months(measurement, export_dir)
+    first = months[-1] if len(months) > 0 else query_first_month(client, measurement)
+    if first is None:
+        return []
+
+    written = []
+    month = first
+    while month <= until:
+        df = query_month(client, measurement, month)
+        if len(df.index) > 0:
+            write_month(df, month_path(measurement, month, export_dir))
+            written.append(month)
+            print(measurement + ' ' + str(month) + ' : ' + str(len(df.index)) + ' points')
+        month += 1
+    return written
+
+
+def read_export(measurement, start=None, end=None, export_dir=EXPORT_DIR, columns=None):
+    """
+    Read the exported months of the measurement between start and end back
+    into a pandas dataframe. The files are memory mapped and the columns are
+    converted without copying them when possible (numeric without nulls)
+    :param measurement: string, the name of the measurement
+    :param start: string or Period of the first month (e.g. '2020-03'), or None
+    :param end: string or Period of the last month (included), or None
+    :param export_dir: string, the path of the export directory
+    :param columns: list of the columns to read, or None for all of them
+    :return: pandas dataframe of the points, sorted by time
+    """
+    months = exported_months(measurement, export_dir)
+    if start is not None:
+        months = [m for m in months if m >= pd.Period(start, freq='M')]
+    if end is not None:
+        months = [m for m in months if m <= pd.Period(end, freq='M')]
+    if len(months) == 0:
+        return pd.DataFrame()
+
+    tables = [pq.read_table(month_path(measurement, m, export_dir),
+                            columns=columns, memory_map=True) for m in months]
+    try:
+        # The months may not all have the same columns
+        table = pa.concat_tables(tables, promote_options='default')
+    except TypeError:
+        # pyarrow < 14
+        table = pa.concat_tables(tables, promote=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Export measurements to Parquet files')
+    parser.add_argument('--measurement', action='append', default=None,
+                        help='measurement to export (can be repeated), '
+                             'by default ' + CLEAN_MEASUREMENT)
+    parser.add_argument('--raw', action='store_true',
+                        help='also export the raw data (' + RAW_MEASUREMENT + ')')
+    parser.add_argument('--export-dir', default=EXPORT_DIR,
+                        help='directory of the Parquet files')
+    args = parser.parse_args()
+
+    measurements = args.measurement or [CLEAN_MEASUREMENT]
+    if args.raw and RAW_MEASUREMENT not in measurements:
+        measurements.append(RAW_MEASUREMENT)
+
+    client = influx_client.connect()
+    for measurement in measurements:
+        export_measurement(client, measurement, args.export_dir)
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,562 @@
+#!/bin/python3
+
+# This script :
+#   1) Re-cleans a time range of the raw sensehat data (e.g. after a change of
+#      the thresholds, the detectors or the calibration), independently of the
+#      regular cleaning of clean.py and of its state
+#   2) The range is split into partitions of a day or a week, processed in
+#      parallel by a pool of processes. Each partition queries the raw rows just
+#      before it : the last ones are its previous_row (see clean.convolve_dataframe)
+#      and they are cleaned again to get the previous_clean_row, so the
+#      partitions do not depend on each other. As in the windows of clean.py,
+#      the anormal rows at the end of a partition are cleaned with the next one
+#   3) The data are adjusted with the running calibration, as clean.py does
+#      (see calibration.py) : a first parallel pass computes the statistics of
+#      the differences with the meteo suisse data of each partition, they are
+#      added in time order to get the calibration at the start of each
+#      partition, then the partitions are cleaned in parallel. With
+#      --batch-calibration, the old scheme : each partition is adjusted with
+#      its own average differences, and the partitions without meteo suisse
+#      data to compare to afterwards, with the ones of the nearest previous
+#      partition
+#   4) Once all the partitions are done, the hourly, daily and monthly rollups
+#      of the range are computed again (see rollups.py)
+#   5) The progress is kept in a json file, updated after each partition, so an
+#      interrupted backfill restarts from the partitions not done yet
+#   6) One device (tag source) is backfilled at a time, sensehat by default,
+#      each one with its own progress file
+#
+# e.g. python3 backfill.py --start 2020-01-01 --end 2021-01-01 --partition week --workers 4
+#      python3 backfill.py --source sensehat_2 --partition week
+
+import os
+import sys
+import copy
+import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import calibration
+import clean
+import clean_state
+import rollups
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import influx_client
+
+# ------------------------------------------------------------------------------
+# Constants
+PROGRESS_FILE = 'backfill_progress.json'
+
+PARTITIONS = {'day': pd.Timedelta(days=1),
+              'week': pd.Timedelta(weeks=1)}
+
+# Number of raw rows before a partition cleaned again to get its
+# previous_clean_row, an anomaly lasting longer than that before the
+# partition may not be corrected exactly as by a single run
+CONTEXT_ROWS = 48
+
+# Maximum number of points written in one request
+BATCH_SIZE = 5000
+
+WORKERS = 2
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def to_utc(time):
+    """
+    Convert the given time to a pandas Timestamp in UTC, a time without
+    timezone is taken as UTC
+    :param time: string or datetime of the time
+    :return: pandas Timestamp (UTC)
+    """
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        return time.tz_localize('UTC')
+    return time.tz_convert('UTC')
+
+
+def make_partitions(start, end, length):
+    """
+    Split the time range into consecutive partitions of the given length, the
+    first one starts at midnight (UTC) of the day of start
+    :param start: pandas Timestamp (UTC), the start of the range
+    :param end: pandas Timestamp (UTC), the end of the range (excluded)
+    :param length: pandas Timedelta, the length of a partition
+    :return: list of (start, end) of the partitions, as pandas Timestamps
+    """
+    bounds = list(pd.date_range(start.floor('D'), end, freq=length))
+    if bounds[-1] < end:
+        bounds.append(bounds[-1] + length)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def progress_path(source):
+    """
+    Path of the progress file of the backfill of the source, the default
+    source keeps the original file
+    :param source: the tag source of the raw data
+    :return: string of the path
+    """
+    if source == clean.SOURCE:
+        return PROGRESS_FILE
+    root, extension = os.path.splitext(PROGRESS_FILE)
+    return root + '_' + source + extension
+
+
+def load_progress(path, partition, scheme='running'):
+    """
+    Read the progress file of a previous backfill, it is ignored if it was
+    made with another length of partitions or another calibration scheme
+    :param path: string, the path of the progress file
+    :param partition: string, the name of the length of the partitions
+    :param scheme: string, the calibration, 'running' or 'batch' (the files
+                   without it were made with 'batch')
+    :return: dict of the progress
+    """
+    try:
+        with open(path, 'r') as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        progress = None
+
+    if not isinstance(progress, dict) or progress.get('partition') != partition \
+            or progress.get('calibration', 'batch') != scheme:
+        return {'partition': partition, 'calibration': scheme, 'partitions': {}}
+    return progress
+
+
+def previous_rows(client, start, context_rows=CONTEXT_ROWS, source=clean.SOURCE):
+    """
+    Query the raw rows just before the partition and clean them, to get the
+    previous_row and the previous_clean_row of the partition. The anormal rows
+    at the end of them are left to the partition (see clean.trailing_anomalies)
+    :param client: the influxdb client to query to
+    :param start: pandas Timestamp, the start of the partition
+    :param context_rows: int, the number of rows before the partition
+    :param source: the tag source of the raw data
+    :return: (previous_row, previous_clean_row, the raw rows left to the
+             partition or None), None if there is no row before
+    """
+    df = clean.query_previous_rows(client, clean.to_rfc3339(start), context_rows,
+                                   source)
+    if df is None:
+        return None, None, None
+    held = clean.trailing_anomalies(df, None)
+    if held == len(df.index):
+        return None, None, df
+    held_rows = df.iloc[len(df.index) - held:].reset_index(drop=True) if held > 0 else None
+    df = df.iloc[:len(df.index) - held]
+    previous_row = df.iloc[-clean.HISTORY_ROWS:].reset_index(drop=True)
+
+    df_convol = pd.DataFrame(index=df.index)
+    clean.convolve_dataframe(df, df_convol, None)
+    clean.clean_data(df, df_convol, None)
+    return previous_row, df.iloc[[-1]].reset_index(drop=True), held_rows
+
+
+def query_partition(client, start, end, reference_station=None,
+                    context_rows=CONTEXT_ROWS, source=clean.SOURCE):
+    """
+    Query the raw sensehat data of the partition, the meteo suisse data around
+    it and the rows before it (see previous_rows). As in the windows of
+    clean.py, the anormal rows at the end of the partition are left to the
+    next one, unless there is no data after them
+    :param client: the influxdb client to query to
+    :param start: pandas Timestamp, the start of the partition
+    :param end: pandas Timestamp, the end of the partition (excluded)
+    :param reference_station: string, the meteo suisse station used for the
+                              calibration (see clean.main), or None
+    :param context_rows: int, the number of rows before the partition
+    :param source: the tag source of the raw data
+    :return: (df, df_ms, previous_row, previous_clean_row), df is empty if
+             there is no data in the partition
+    """
+    # The queries exclude their start, the partition includes it
+    df, df_ms = clean.query_batch(
+        client, clean.to_rfc3339(start - pd.Timedelta(microseconds=1)),
+        end=clean.to_rfc3339(end), reference_station=reference_station,
+        source=source)
+    if len(df.index) == 0:
+        return df, df_ms, None, None
+    previous_row, previous_clean_row, held_rows = previous_rows(client, start,
+                                                                context_rows, source)
+    if held_rows is not None:
+        # The rows of query_previous_rows have string times
+        held_rows['time'] = pd.to_datetime(held_rows['time'], utc=True)
+        df = pd.concat([held_rows[df.columns.intersection(held_rows.columns)], df],
+                       ignore_index=True)
+
+    held = clean.trailing_anomalies(df, previous_row)
+    if 0 < held < len(df.index) and clean.query_next_time(
+            client, source, clean.to_rfc3339(df['time'].iloc[-1])) is not None:
+        df = df.iloc[:len(df.index) - held]
+    return df, df_ms, previous_row, previous_clean_row
+
+
+def partition_statistics(start, end, reference_station=None,
+                         context_rows=CONTEXT_ROWS, source=clean.SOURCE):
+    """
+    Clean the raw sensehat data of the partition as clean_partition does,
+    without writing anything, and compute the statistics of their differences
+    with the meteo suisse data (see calibration.statistics), to rebuild the
+    running calibration in time order. Runs in a process of the pool
+    :param start: pandas Timestamp, the start of the partition
+    :param end: pandas Timestamp, the end of the partition (excluded)
+    :param reference_station: string, the meteo suisse station used for the
+                              calibration (see clean.main), or None
+    :param context_rows: int, the number of rows before the partition
+    :param source: the tag source of the raw data
+    :return: dict {'rows': number of rows, 'stats': the statistics, or None if
+             there is no meteo suisse data to compare to}
+    """
+    client = influx_client.connect()
+    try:
+        df, df_ms, previous_row, previous_clean_row = query_partition(
+            client, start, end, reference_station, context_rows, source)
+    finally:
+        client.close()
+    if len(df.index) == 0:
+        return {'rows': 0, 'stats': None}
+
+    df_convol = pd.DataFrame(index=df.index)
+    clean.convolve_dataframe(df, df_convol, previous_row)
+    clean.clean_data(df, df_convol, previous_row, previous_clean_row)
+    form_df = clean.prepare_ms_df(df_ms, df['time'])
+    if form_df is None:
+        return {'rows': len(df.index), 'stats': None}
+    return {'rows': len(df.index),
+            'stats': calibration.statistics(df['time'],
+                                            clean.calibration_differences(df, form_df))}
+
+
+def clean_partition(start, end, avg_diffs=None, persist_convol=True,
+                    reference_station=None, context_rows=CONTEXT_ROWS,
+                    source=clean.SOURCE, calibrator=None):
+    """
+    Clean the raw sensehat data of the partition and write them, runs in
+    a process of the pool, so it opens its own connections
+    :param start: pandas Timestamp, the start of the partition
+    :param end: pandas Timestamp, the end of the partition (excluded)
+    :param avg_diffs: dict, the calibration to use when the partition can not be
+                      compared to the meteo suisse data, or None
+    :param persist_convol: boolean, False to not write the convolution signals
+    :param reference_station: string, the meteo suisse station used for the
+                              calibration (see clean.main), or None
+    :param context_rows: int, the number of rows before the partition
+                         cleaned again (see previous_rows)
+    :param source: the tag source of the raw data
+    :param calibrator: dict of the running calibration at the start of the
+                       partition (see running_calibrations), the partition is
+                       adjusted with it instead of avg_diffs, or None
+    :return: dict {'rows': number of rows, 'avg_diffs': calibration used, or
+             None, 'done': True if the partition was adjusted and written}
+    """
+    client, df_client = influx_client.connect_pair()
+    try:
+        df, df_ms, previous_row, previous_clean_row = query_partition(
+            client, start, end, reference_station, context_rows, source)
+        if len(df.index) == 0:
+            return {'rows': 0, 'avg_diffs': avg_diffs, 'done': True}
+
+        _, _, avg_diffs = clean.clean_batch(df, df_ms, previous_row,
+                                            previous_clean_row, avg_diffs,
+                                            df_client, persist_convol=persist_convol,
+                                            batch_size=BATCH_SIZE,
+                                            calibrator=calibrator)
+        if avg_diffs is not None and np.isnan(list(avg_diffs.values())).all():
+            # No meteo suisse data overlapping the partition
+            avg_diffs = None
+        if calibrator is not None:
+            done = not calibration.empty(calibrator)
+        else:
+            done = avg_diffs is not None
+        return {'rows': len(df.index), 'avg_diffs': avg_diffs, 'done': done}
+    finally:
+        df_client.close()
+        client.close()
+
+
+def record(progress, path, key, result):
+    """
+    Record the result of a partition in the progress file
+    :param progress: dict of the progress (see load_progress)
+    :param path: string, the path of the progress file
+    :param key: string, the start of the partition
+    :param result: dict, the result of clean_partition
+    """
+    avg_diffs = result['avg_diffs']
+    progress['partitions'].setdefault(key, {}).update({
+        'done': result['done'],
+        'rows': result['rows'],
+        'avg_diffs': None if avg_diffs is None else
+        {col: clean_state.to_json_value(diff) for col, diff in avg_diffs.items()}})
+    clean_state.save_state(progress, path)
+
+
+def record_statistics(progress, path, key, result):
+    """
+    Record the statistics of a partition in the progress file
+    :param progress: dict of the progress (see load_progress)
+    :param path: string, the path of the progress file
+    :param key: string, the start of the partition
+    :param result: dict, the result of partition_statistics
+    """
+    progress['partitions'].setdefault(key, {'done': False}).update({
+        'rows': result['rows'],
+        'stats': result['stats']})
+    clean_state.save_state(progress, path)
+
+
+def previous_calibration(progress, partitions, index):
+    """
+    Returns the calibration of the nearest partition before the given one that
+    has one, or of the nearest one after it if there is none before
+    :param progress: dict of the progress (see load_progress)
+    :param partitions: list of (start, end) of the partitions
+    :param index: int, the index of the partition
+    :return: dict of the calibration, or None
+    """
+    order = list(range(index - 1, -1, -1)) + list(range(index + 1, len(partitions)))
+    for i in order:
+        done = progress['partitions'].get(clean.to_rfc3339(partitions[i][0]))
+        if done is not None and done.get('avg_diffs') is not None:
+            return {col: float('nan') if diff is None else diff
+                    for col, diff in done['avg_diffs'].items()}
+    return None
+
+
+def running_calibrations(progress, partitions):
+    """
+    Rebuild the running calibration in time order from the statistics of the
+    partitions (see partition_statistics), as clean.py builds it batch after
+    batch. Each partition gets the calibration of the end of the previous one,
+    clean.clean_batch then adds its own differences to it. The partitions
+    before the first one compared to the meteo suisse data get the calibration
+    of the end of that one
+    :param progress: dict of the progress, with the statistics of all the partitions
+    :param partitions: list of (start, end) of the partitions
+    :return: list of the calibrations (see calibration.py), one per partition
+    """
+    calibrator = calibration.new_calibration(clean.FORMATED_COLS)
+    calibrations = []
+    for start, _ in partitions:
+        calibrations.append(copy.deepcopy(calibrator))
+        calibration.add(calibrator, progress['partitions'][clean.to_rfc3339(start)]['stats'])
+
+    first = next((i for i in range(len(calibrations))
+                  if not calibration.empty(calibrations[i])), None)
+    if first is not None:
+        for i in range(first):
+            calibrations[i] = copy.deepcopy(calibrations[first])
+    return calibrations
+
+
+def run_partitions(function, jobs, workers, done, failed):
+    """
+    Run the function for each partition, in this process or in a pool of
+    processes. A partition that fails does not stop the others
+    :param function: the function run for a partition (module level, so it
+                     can be sent to the processes of the pool)
+    :param jobs: dict {index of the partition: (args, kwargs) of the function}
+    :param workers: int, the number of processes, 1 to run in this process
+    :param done: function(index, result) called with the result of each partition
+    :param failed: function(index, exception) called for each partition that failed
+    """
+    if workers <= 1:
+        for i, (args, kwargs) in jobs.items():
+            try:
+                done(i, function(*args, **kwargs))
+            except Exception as e:
+                failed(i, e)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(function, *args, **kwargs): i
+                   for i, (args, kwargs) in jobs.items()}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                done(i, future.result())
+            except Exception as e:
+                failed(i, e)
+
+
+def backfill(start, end, partition='day', workers=WORKERS, persist_convol=True,
+             reference_station=None, progress_file=PROGRESS_FILE, restart=False,
+             update_rollups=True, source=clean.SOURCE, running_calibration=True):
+    """
+    Clean again all the raw sensehat data between start and end, by partitions
+    processed in parallel, skipping the ones already done by a previous backfill
+    :param start: pandas Timestamp (UTC), the start of the range
+    :param end: pandas Timestamp (UTC), the end of the range (excluded)
+    :param partition: string, the length of the partitions, 'day' or 'week'
+    :param workers: int, the number of processes, 1 to clean in this process
+    :param persist_convol: boolean, False to not write the convolution signals
+    :param reference_station: string, the meteo suisse station used for the
+                              calibration (see clean.main), or None
+    :param progress_file: string, the path of the progress file
+    :param restart: boolean, True to ignore the progress of a previous backfill
+    :param update_rollups: boolean, True to compute again the rollups of the range
+    :param source: the tag source of the raw data
+    :param running_calibration: boolean, True to adjust the data with the running
+                                calibration rebuilt over the range, as clean.py
+                                does, False with the average differences of each
+                                partition
+    :return: True if all the partitions are done
+    """
+    partitions = make_partitions(start, end, PARTITIONS[partition])
+    scheme = 'running' if running_calibration else 'batch'
+    progress = load_progress(progress_file, partition, scheme)
+    if restart:
+        progress['partitions'] = {}
+
+    def entry(i):
+        return progress['partitions'].get(clean.to_rfc3339(partitions[i][0]), {})
+
+    todo = [i for i in range(len(partitions)) if not entry(i).get('done')]
+    print(str(len(partitions) - len(todo)) + '/' + str(len(partitions))
+          + ' partitions already done')
+
+    begin = time.monotonic()
+    finished = 0
+    failed = 0
+
+    def report(i, result):
+        nonlocal finished
+        finished += 1
+        elapsed = time.monotonic() - begin
+        remaining = elapsed / finished * (len(todo) - finished)
+        print('[' + str(finished) + '/' + str(len(todo)) + '] '
+              + clean.to_rfc3339(partitions[i][0]) + ' : '
+              + str(result['rows']) + ' rows'
+              + ('' if result['done'] else ', no calibration yet')
+              + ', ' + str(round(remaining)) + ' s remaining')
+        record(progress, progress_file, clean.to_rfc3339(partitions[i][0]), result)
+
+    def report_statistics(i, result):
+        record_statistics(progress, progress_file, clean.to_rfc3339(partitions[i][0]),
+                          result)
+
+    def report_failure(i, error):
+        nonlocal failed
+        failed += 1
+        print('Partition ' + clean.to_rfc3339(partitions[i][0])
+              + ' failed : ' + str(error))
+
+    options = {'persist_convol': persist_convol,
+               'reference_station': reference_station,
+               'source': source}
+    calibrations = [None] * len(partitions)
+    if running_calibration:
+        # The calibration of a partition depends on all the ones before it,
+        # the statistics of all the partitions are needed, even of the done ones
+        missing = [i for i in range(len(partitions)) if 'stats' not in entry(i)]
+        print('Computing the calibration statistics of ' + str(len(missing))
+              + ' partition(s)')
+        run_partitions(partition_statistics,
+                       {i: (partitions[i], {'reference_station': reference_station,
+                                            'source': source}) for i in missing},
+                       workers, report_statistics, report_failure)
+        if failed > 0:
+            print('Backfill stopped, the calibration needs the statistics of all '
+                  'the partitions, run it again to retry them')
+            return False
+        calibrations = running_calibrations(progress, partitions)
+
+    run_partitions(clean_partition,
+                   {i: (partitions[i], dict(options, calibrator=calibrations[i]))
+                    for i in todo},
+                   workers, report, report_failure)
+
+    # With the average differences of each partition, the partitions without
+    # meteo suisse data take the calibration of the previous one, in order,
+    # once all the others are done
+    for i in range(len(partitions)):
+        if running_calibration or entry(i).get('done', True):
+            continue
+        avg_diffs = previous_calibration(progress, partitions, i)
+        if avg_diffs is None:
+            print('No calibration for ' + clean.to_rfc3339(partitions[i][0]))
+            continue
+        result = clean_partition(*partitions[i], avg_diffs=avg_diffs, **options)
+        record(progress, progress_file, clean.to_rfc3339(partitions[i][0]), result)
+
+    undone = len([i for i in range(len(partitions)) if not entry(i).get('done')])
+    if undone == 0 and failed == 0 and update_rollups:
+        client, df_client = influx_client.connect_pair()
+        rollups.update_rollups(client, df_client, start, end, clean.CONVOL_COLS)
+        df_client.close()
+        client.close()
+
+    print('Backfill finished in ' + str(round(time.monotonic() - begin)) + ' s, '
+          + str(undone) + ' partition(s) not done'
+          + (', run it again to retry them' if undone > 0 else ''))
+    return undone == 0 and failed == 0
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean again a time range of the '
+                                                 'raw sensehat data')
+    parser.add_argument('--source', default=clean.SOURCE,
+                        help='source (device) of the raw data to clean again')
+    parser.add_argument('--start', default=None,
+                        help='start of the range (e.g. 2020-01-01), '
+                             'by default the first sensehat sample')
+    parser.add_argument('--end', default=None,
+                        help='end of the range (excluded), by default now')
+    parser.add_argument('--partition', choices=sorted(PARTITIONS), default='day',
+                        help='length of the partitions')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of processes cleaning the partitions')
+    parser.add_argument('--no-convol', action='store_true',
+                        help='do not write the convolution signals to the db')
+    parser.add_argument('--reference-station', default=None,
+                        help='meteo suisse station used for the calibration '
+                             '(e.g. MAS), or best to choose it')
+    parser.add_argument('--progress-file', default=None,
+                        help='json file of the progress, to restart the backfill '
+                             '(default: ' + PROGRESS_FILE + ' for ' + clean.SOURCE + ')')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the progress of a previous backfill')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help='do not update the hourly, daily and monthly rollups')
+    parser.add_argument('--batch-calibration', action='store_true',
+                        help='adjust each partition with its own average differences '
+                             'instead of the running calibration')
+    args = parser.parse_args()
+
+    start = args.start
+    if start is None:
+        client = influx_client.connect()
+        start = clean.query_next_time(client, args.source, '0')
+        client.close()
+        if start is None:
+            print('No ' + args.source + ' data to clean')
+            return
+    end = pd.Timestamp.now(tz='UTC') if args.end is None else args.end
+
+    backfill(to_utc(start), to_utc(end), args.partition, args.workers,
+             persist_convol=not args.no_convol,
+             reference_station=args.reference_station,
+             progress_file=args.progress_file or progress_path(args.source),
+             restart=args.restart, update_rollups=not args.no_rollups,
+             source=args.source, running_calibration=not args.batch_calibration)
+
+
+if __name__ == '__main__':
+    main()
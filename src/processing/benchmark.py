@@ -0,0 +1,328 @@
+#!/bin/python3
+
+# This script :
+#   1) Benchmarks the hot paths of the processing (decoding of the queries,
+#      encoding of the writes, format_OD, resampling, convolution, cleaning,
+#      calibration) on synthetic data (see synthetic_data.py), so it runs
+#      fully offline, without the influxdb server
+#   2) Reports for each stage and size the wall time (best of the repeats),
+#      the peak memory allocated (tracemalloc) and the throughput in rows / s
+#   3) Appends the results to a json lines file, tagged with the git revision,
+#      and compares them with the previous revision benchmarked, so the
+#      regressions between versions are visible
+#
+# e.g. python3 benchmark.py --sizes 1k,100k,1M --compare
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from influxdb import DataFrameClient
+from influxdb.resultset import ResultSet
+
+import clean
+import format_OD
+import resample
+import synthetic_data
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import influx_client
+import line_protocol
+
+# ------------------------------------------------------------------------------
+# Constants
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+SIZES = '1k,10k,100k,1M'
+
+# The loop of format_OD.make_formated_column is too slow for the big sizes
+MAX_LEGACY_ROWS = 100000
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def parse_size(size):
+    """
+    Parse a size like '10k' or '1M' to an int
+    :param size: string of the size
+    :return: int, the size
+    """
+    size = size.strip()
+    factor = {'k': 10**3, 'M': 10**6}.get(size[-1], 1)
+    return int(float(size.rstrip('kM')) * factor)
+
+
+def git_revision():
+    """
+    Returns the short hash of the current git revision, or 'unknown'
+    :return: string of the revision
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def make_inputs(n):
+    """
+    Make the synthetic sensehat and meteo suisse dataframes for n rows
+    :param n: int, the number of sensehat rows
+    :return: (sensehat dataframe, meteo suisse dataframe)
+    """
+    df = synthetic_data.make_sensehat_frame(n)
+    df_ms = synthetic_data.make_meteosuisse_frame(df['time'].iloc[0],
+                                                  df['time'].iloc[-1])
+    return df, df_ms
+
+
+def stage_points(df, df_ms):
+    lines = synthetic_data.to_influx_answer(df)
+
+    def run():
+        # As clean.query_to_points, one dict per point
+        points = ResultSet(json.loads(lines[0])['results'][0]).get_points()
+        return pd.DataFrame(points)
+    return run
+
+
+def stage_columns(df, df_ms):
+    lines = synthetic_data.to_influx_answer(df, chunk_size=influx_client.CHUNK_SIZE)
+
+    def run():
+        # As clean.query_frame, the chunks are decoded into numpy columns
+        return clean.chunks_to_frame(arrays for line in lines
+                                     for _, arrays in influx_client.decode_chunk(line))
+    return run
+
+
+def stage_write_legacy(df, df_ms):
+    df_write = df.set_index('time').drop(columns='source')
+    df_client = DataFrameClient(database='benchmark')
+    # The conversion done by DataFrameClient.write_points before sending
+    return lambda: df_client._convert_dataframe_to_lines(df_write, clean.CLEAN_MEASUREMENT)
+
+
+def stage_write(df, df_ms):
+    df_write = df.set_index('time').drop(columns='source')
+    return lambda: line_protocol.encode_frame(df_write, clean.CLEAN_MEASUREMENT)
+
+
+def stage_format_legacy(df, df_ms):
+    dst_df, src_df = format_inputs(df, df_ms)
+    return lambda: format_OD.format_dataframe(dst_df, src_df, clean.FORMATED_COLS)
+
+
+def stage_resample(df, df_ms):
+    methods = {col: 'linear' for col in clean.FORMATED_COLS}
+    return lambda: resample.resample_frame(df_ms, df['time'], methods,
+                                           max_gap=clean.MS_MAX_GAP)
+
+
+def format_inputs(df, df_ms):
+    """
+    Make the destination and source dataframes of the format_OD loop, with
+    the times as strings as it needs them
+    :param df: the sensehat dataframe
+    :param df_ms: the meteo suisse dataframe
+    :return: (destination dataframe, source dataframe)
+    """
+    src_df = synthetic_data.to_influx_times(df_ms)
+    dst_df = pd.DataFrame({'time': synthetic_data.to_influx_times(df)['time']})
+    for col in clean.FORMATED_COLS:
+        # The columns filled by the loop
+        dst_df[col] = np.empty(len(dst_df.index))
+    return dst_df, src_df
+
+
+def stage_convolve(df, df_ms):
+    dst_df = pd.DataFrame(index=df.index)
+    return lambda: clean.convolve_dataframe(df, dst_df, None)
+
+
+def stage_clean(df, df_ms):
+    df_convol = pd.DataFrame(index=df.index)
+    clean.convolve_dataframe(df, df_convol, None)
+    df_copy = df.copy()
+    return lambda: clean.clean_data(df_copy, df_convol, None)
+
+
+def stage_avg_diff(df, df_ms):
+    form_df = clean.prepare_ms_df(df_ms, df['time'])
+    return lambda: clean.avg_diff_df(form_df, df)
+
+
+def stage_adjust(df, df_ms):
+    form_df = clean.prepare_ms_df(df_ms, df['time'])
+    avg_diffs = clean.avg_diff_df(form_df, df)
+    df_copy = df.copy()
+    return lambda: clean.adjust_df(df_copy, avg_diffs)
+
+
+# Name of the stage -> function making the callable to benchmark from the inputs
+STAGES = {'clean.query_to_points': stage_points,
+          'clean.query_frame': stage_columns,
+          'DataFrameClient.write_points': stage_write_legacy,
+          'line_protocol.encode_frame': stage_write,
+          'format_OD.make_formated_column': stage_format_legacy,
+          'resample.resample_frame': stage_resample,
+          'clean.convolve_dataframe': stage_convolve,
+          'clean.clean_data': stage_clean,
+          'clean.avg_diff_df': stage_avg_diff,
+          'clean.adjust_df': stage_adjust}
+
+
+def measure(make_run, df, df_ms, repeat):
+    """
+    Measure the given stage : the best wall time over the repeats and the peak
+    memory allocated during one run (measured in a separate run, as tracemalloc
+    slows the allocations down)
+    :param make_run: function making the callable to benchmark (see STAGES)
+    :param df: the sensehat dataframe
+    :param df_ms: the meteo suisse dataframe
+    :param repeat: int, the number of timed runs
+    :return: (best wall time in seconds, peak memory in bytes)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        run = make_run(df, df_ms)
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    run = make_run(df, df_ms)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def load_results(path=RESULTS_FILE):
+    """
+    Read the results stored by the previous benchmarks
+    :param path: string, the path of the results file
+    :return: list of the results (dict)
+    """
+    try:
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def previous_results(results, revision):
+    """
+    Returns the results of the last revision benchmarked before the given one
+    :param results: list of the stored results
+    :param revision: string, the current revision
+    :return: dict {(stage, rows): result}
+    """
+    previous = [r for r in results if r['revision'] != revision]
+    if len(previous) == 0:
+        return {}
+    last = previous[-1]['revision']
+    return {(r['stage'], r['rows']): r for r in previous if r['revision'] == last}
+
+
+def run_benchmarks(sizes, stages, repeat=3, max_legacy_rows=MAX_LEGACY_ROWS):
+    """
+    Run the benchmarks of the given stages for the given sizes
+    :param sizes: list of int, the numbers of rows
+    :param stages: list of the names of the stages (see STAGES)
+    :param repeat: int, the number of timed runs of each stage
+    :param max_legacy_rows: int, the maximum size for the format_OD loop
+    :return: list of the results (dict)
+    """
+    revision = git_revision()
+    date = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    results = []
+    for n in sizes:
+        df, df_ms = make_inputs(n)
+        for stage in stages:
+            if stage == 'format_OD.make_formated_column' and n > max_legacy_rows:
+                continue
+            try:
+                wall, peak = measure(STAGES[stage], df, df_ms, repeat)
+            except ValueError as e:
+                # e.g. the loop of make_formated_column writes into the numpy
+                # arrays of the columns, read-only with the copy on write of pandas
+                print('Skipping ' + stage + ' for ' + str(n) + ' rows : ' + str(e))
+                continue
+            results.append({'revision': revision, 'date': date, 'stage': stage,
+                            'rows': n, 'seconds': wall, 'peak_bytes': peak,
+                            'rows_per_second': n / wall if wall > 0 else None,
+                            'numpy': np.__version__, 'pandas': pd.__version__,
+                            'python': sys.version.split()[0]})
+            print_result(results[-1])
+    return results
+
+
+def print_result(result, previous=None):
+    """
+    Print one result, with the ratio of the time with the previous
+    revision if given
+    :param result: dict of the result
+    :param previous: dict of the result of the previous revision, or None
+    """
+    line = '{:<34} {:>10} rows {:>10.4f} s {:>10.1f} MiB {:>14.0f} rows/s'.format(
+        result['stage'], result['rows'], result['seconds'],
+        result['peak_bytes'] / 2**20, result['rows_per_second'] or 0)
+    if previous is not None:
+        line += '   x{:.2f} vs {}'.format(result['seconds'] / previous['seconds'],
+                                          previous['revision'])
+    print(line)
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the processing')
+    parser.add_argument('--sizes', default=SIZES,
+                        help='numbers of rows, e.g. 1k,10k,100k,1M,10M')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='stages to benchmark, among ' + ', '.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each stage')
+    parser.add_argument('--max-legacy-rows', type=parse_size,
+                        default=MAX_LEGACY_ROWS,
+                        help='maximum size for the make_formated_column loop')
+    parser.add_argument('--results', default=RESULTS_FILE,
+                        help='json lines file the results are appended to')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the previous revision benchmarked')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    stages = args.stages.split(',')
+    stored = load_results(args.results)
+
+    results = run_benchmarks(sizes, stages, args.repeat, args.max_legacy_rows)
+
+    with open(args.results, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+    if args.compare:
+        previous = previous_results(stored, git_revision())
+        print('\nCompared with the previous revision :')
+        for result in results:
+            print_result(result, previous.get((result['stage'], result['rows'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/bin/python3
+
+# This module :
+#   1) Keeps running statistics (weight, mean and sum of the squared
+#      deviations, i.e. Welford / Chan) of the differences between the sensehat
+#      data and the meteo suisse data, for each column and each hour of the
+#      day (UTC), as the bias of the sensehat depends on the sun
+#   2) The old differences can be exponentially decayed (half life in days), so
+#      the calibration follows the slow changes of the bias (e.g. the seasons)
+#   3) Each update merges the statistics of a batch in O(number of bins), and
+#      the state is a small dict that can be written in json (see clean_state),
+#      so the calibration is stable and cheap whatever the history behind it.
+#      The statistics of a batch can also be computed apart and added later,
+#      in time order (see backfill.py)
+#   4) The offsets of each row are the mean of its hour of the day, or the
+#      mean over all the hours while its hour has not enough samples yet, or 0
+#      while the column has no sample at all
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# Constants
+BINS = 24
+
+# Half life of the weight of a difference, in days, None for no decay
+HALF_LIFE = 30.0
+
+# Minimum weight of an hour of the day to use its own mean
+MIN_WEIGHT = 10.0
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def new_calibration(columns, bins=BINS, half_life=HALF_LIFE):
+    """
+    Make an empty calibration
+    :param columns: list of the columns calibrated
+    :param bins: int, the number of bins of the day
+    :param half_life: float, the half life of the weights in days, or None
+    :return: dict of the calibration
+    """
+    return {'bins': bins,
+            'half_life': half_life,
+            'updated': None,
+            'columns': {col: {'weight': [0.0] * bins,
+                              'mean': [0.0] * bins,
+                              'm2': [0.0] * bins} for col in columns}}
+
+
+def day_bins(times, bins):
+    """
+    Returns the bin of the day (UTC) of each time
+    :param times: the times (strings or datetimes)
+    :param bins: int, the number of bins of the day
+    :return: int numpy array of the bins
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+    seconds = (times.hour * 3600 + times.minute * 60 + times.second).to_numpy()
+    return seconds * bins // 86400
+
+
+def merge(weight_a, mean_a, m2_a, weight_b, mean_b, m2_b):
+    """
+    Merge the statistics of 2 sets of samples (Chan et al.)
+    :return: (weight, mean, m2) of the union of the sets
+    """
+    weight_b = np.asarray(weight_b, dtype=np.float64)
+    weight = weight_a + weight_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(weight > 0, weight_b / weight, 0.0)
+    delta = mean_b - mean_a
+    return (weight, mean_a + delta * ratio,
+            m2_a + m2_b + delta ** 2 * weight_a * ratio)
+
+
+def batch_stats(bins, values, nbins):
+    """
+    Compute the statistics of the values of each bin, the Nan values are ignored
+    :param bins: int numpy array of the bin of each value
+    :param values: numpy array of the values
+    :param nbins: int, the number of bins
+    :return: (weight, mean, m2) numpy arrays of nbins elements
+    """
+    known = ~np.isnan(values)
+    bins = bins[known]
+    values = values[known]
+    weight = np.bincount(bins, minlength=nbins).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(weight > 0, np.bincount(bins, values, nbins) / weight, 0.0)
+    m2 = np.bincount(bins, (values - mean[bins]) ** 2, nbins)
+    return weight, mean, m2
+
+
+def statistics(times, diffs, bins=BINS):
+    """
+    Compute the statistics of the differences of a batch, to add them later to
+    a calibration (see add). They can be written in json, so the batches can
+    be processed apart (e.g. by backfill.py) and added in time order
+    :param times: the times of the differences, sorted
+    :param diffs: dict {column: numpy array of the differences}
+    :param bins: int, the number of bins of the day
+    :return: dict {'last': time of the last difference, 'columns': {column:
+             {'weight', 'mean', 'm2'}}}, or None if there is no difference
+    """
+    if len(times) == 0:
+        return None
+    times = pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+    day = day_bins(times, bins)
+    columns = {}
+    for col, values in diffs.items():
+        weight, mean, m2 = batch_stats(day, np.asarray(values, dtype=np.float64), bins)
+        columns[col] = {'weight': weight.tolist(), 'mean': mean.tolist(),
+                        'm2': m2.tolist()}
+    return {'last': times[-1].isoformat(), 'columns': columns}
+
+
+def add(calibration, stats):
+    """
+    Add the statistics of a batch (see statistics) to the calibration (in
+    place). The weights of the previous differences are first decayed by the
+    time elapsed since the last update
+    :param calibration: dict of the calibration (see new_calibration)
+    :param stats: dict of the statistics of the batch, or None
+    """
+    if stats is None:
+        return
+    last = pd.Timestamp(stats['last'])
+
+    decay = 1.0
+    if calibration['half_life'] is not None and calibration['updated'] is not None:
+        elapsed = (last - pd.Timestamp(calibration['updated'])) / pd.Timedelta(days=1)
+        decay = 0.5 ** (max(elapsed, 0.0) / calibration['half_life'])
+
+    for col, batch in stats['columns'].items():
+        current = calibration['columns'][col]
+        weight, mean, m2 = merge(
+            np.array(current['weight']) * decay, np.array(current['mean']),
+            np.array(current['m2']) * decay,
+            batch['weight'], np.array(batch['mean']), np.array(batch['m2']))
+        current['weight'] = weight.tolist()
+        current['mean'] = mean.tolist()
+        current['m2'] = m2.tolist()
+
+    if calibration['updated'] is None or last > pd.Timestamp(calibration['updated']):
+        calibration['updated'] = last.isoformat()
+
+
+def update(calibration, times, diffs):
+    """
+    Add the differences of a batch to the calibration (in place), see add
+    :param calibration: dict of the calibration (see new_calibration)
+    :param times: the times of the differences, sorted
+    :param diffs: dict {column: numpy array of the differences}
+    """
+    add(calibration, statistics(times, diffs, calibration['bins']))
+
+
+def empty(calibration):
+    """
+    Returns True if no difference was added to the calibration yet
+    :param calibration: dict of the calibration
+    :return: boolean
+    """
+    return all(summary(calibration, col)[0] <= 0 for col in calibration['columns'])
+
+
+def summary(calibration, col):
+    """
+    Returns the statistics of the column over all the bins
+    :param calibration: dict of the calibration
+    :param col: string, the column
+    :return: (weight, mean, variance), the variance is Nan without weight
+    """
+    stats = calibration['columns'][col]
+    weights = np.array(stats['weight'])
+    means = np.array(stats['mean'])
+    weight = weights.sum()
+    if weight <= 0:
+        return 0.0, np.nan, np.nan
+    mean = (weights * means).sum() / weight
+    m2 = np.sum(stats['m2']) + (weights * (means - mean) ** 2).sum()
+    return float(weight), float(mean), float(m2 / weight)
+
+
+def offsets(calibration, times, min_weight=MIN_WEIGHT):
+    """
+    Returns the offsets to substract from each row : the mean difference of
+    its bin, or of the whole day if its bin has less than min_weight. A column
+    without any difference yet is not adjusted (offsets of 0)
+    :param calibration: dict of the calibration
+    :param times: the times of the rows
+    :param min_weight: float, the minimum weight of a bin to use its mean
+    :return: dict {column: numpy array of the offsets}, or None if the
+             calibration is still empty
+    """
+    bins = day_bins(times, calibration['bins'])
+    result = {}
+    empty = 0
+    for col, stats in calibration['columns'].items():
+        weight, mean, _ = summary(calibration, col)
+        if weight <= 0:
+            result[col] = np.zeros(len(bins))
+            empty += 1
+            continue
+        bin_means = np.where(np.array(stats['weight']) >= min_weight,
+                             np.array(stats['mean']), mean)
+        result[col] = bin_means[bins]
+
+    if empty == len(result):
+        return None
+    return result
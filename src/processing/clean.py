@@ -2,19 +2,45 @@
 
 # This script :
 #   1) Query the raw data that are not cleaned yet from the raw_data measurement
-#   2) Correct the anormal values detected by mean of a convolution :
-#       a) humidity : average of previous and next point (if existent)
-#       b) pressure : average of previous and next point (if existent)
-#       c) temperature_humidity : average of previous and next point (if existent)
+#   2) Correct the anormal values detected by the detector of each column
+#      (see detectors.py, the finite difference convolution by default) :
+#       a) humidity : interpolation between previous and next good points (if existent)
+#       b) pressure : interpolation between previous and next good points (if existent)
+#       c) temperature_humidity : interpolation between previous and next good
+#                                 points (if existent)
 #       d) temperature : same value as temperature_humidity (if existent),
 #                        because they seem to be always very close
-#       e) temperature_pressure : average of previous and next point (if existent)
-
+#       e) temperature_pressure : interpolation between previous and next good
+#                                 points (if existent)
+#   The time and the volume of each stage of a run are written to the
+#   measurement 'pipeline_metrics' (see common/metrics.py)
+#   3) Each device (tag source of the raw data, e.g. sensehat or sensehat_2
+#      for a second SenseHat) is cleaned separately : its own watermark, its
+#      own state file and its own calibration, and the convolution signals
+#      and the clean data are tagged with it. With several sources (--sources),
+#      each one is cleaned by its own worker process, so a run takes as long
+#      as the largest source, then the rollups are updated once for all
+#
+# e.g. python3 clean.py --window 1d
+#      python3 clean.py --sources all --workers 4
+
+import os
 import sys
-from influxdb import InfluxDBClient, DataFrameClient
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
-import format_OD
+import clean_state
+import detectors
+import calibration
+import resample
+import rollups
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+import influx_client
+import line_protocol
 
 # ------------------------------------------------------------------------------
 # Constants
@@ -24,22 +50,21 @@ TMP_P = 'temperature_pressure'
 HUM = 'humidity'
 PRES = 'pressure'
 
+# A value is anormal when the absolute score of the detector of its column
+# exceeds the threshold, in the unit of the field for the finite_difference,
+# second_difference and rolling_median detectors, in number of standard
+# deviations for hampel and mad_zscore
 THRESHOLDS = {TMP: 5, HUM: 7, PRES: 1,
               TMP_H: 5,
               TMP_P: 5}
 
-CREDENTIALS_FILE = '../credentials.txt'
-# =================================================================
-# Read the credentials in the file, omit the last char that is '\n'
-# when using readline
-with open(CREDENTIALS_FILE, 'r') as f:
-    IP_RP4 = f.readline()[:-1]
-    PORT = f.readline()[:-1]
-    USER_NAME = f.readline()[:-1]
-    PWD = f.readline()[:-1]
-    DB_NAME = f.readline()[:-1]
-
-# =================================================================
+# Detector of each column (see detectors.py) and its parameters,
+# e.g. PRES: ('hampel', {'window': 9}) with a threshold of 3
+DETECTORS = {TMP: ('finite_difference', {}),
+             HUM: ('finite_difference', {}),
+             PRES: ('finite_difference', {}),
+             TMP_H: ('finite_difference', {}),
+             TMP_P: ('finite_difference', {})}
 
 FORMATED_COLS = [TMP, HUM]
 ADJUSTED_COLS = [TMP, HUM,
@@ -47,6 +72,36 @@ ADJUSTED_COLS = [TMP, HUM,
 CONVOL_COLS = [TMP, HUM, PRES,
                TMP_H, TMP_P]
 
+# Tag source of the raw data cleaned by default. The points written before
+# the measurements were tagged have no source and belong to it
+SOURCE = 'sensehat'
+MS_SOURCE = 'meteosuisse'
+
+# Number of sources cleaned at once
+WORKERS = 4
+
+# Number of raw rows kept between 2 batches for the windows of the detectors
+HISTORY_ROWS = detectors.history_rows([DETECTORS[col] for col in CONVOL_COLS])
+
+CONVOL_MEASUREMENT = 'convol_signals'
+CLEAN_MEASUREMENT = 'clean_sh_data'
+
+# Measurement of all the meteo suisse stations (see fetch_open_data.py),
+# used when a reference station is given
+STATIONS_MEASUREMENT = 'meteosuisse_stations'
+
+# Margin around a batch of sensehat data for which we fetch the meteo suisse
+# data, so that the first and last samples of the batch can be interpolated
+MS_MARGIN = pd.Timedelta(hours=6)
+
+# The meteo suisse data are fetched every 2 hours (see fetch_open_data.py and
+# FETCH_PERIOD in ingest_service.py), one point per fetch. They are not
+# interpolated over a gap longer than a fetch period plus a margin for the late
+# fetches (e.g. a missed fetch), the sensehat samples in it are not compared
+# to them
+MS_FETCH_PERIOD = pd.Timedelta(hours=2)
+MS_MAX_GAP = MS_FETCH_PERIOD + pd.Timedelta(hours=1)
+
 
 # ------------------------------------------------------------------------------
 # Functions
@@ -55,61 +110,113 @@ CONVOL_COLS = [TMP, HUM, PRES,
 def query_to_points(query, client):
     """
     Query the db and returns the generator of the points
-    Note that the time is in UTC
+    Note that the time is in UTC. The client already retries the failed
+    requests (see common/influx_client.py), the errors left are raised, so a
+    failed query is never mistaken for a query without any point
     :param query: string of the query to execute
     :param client: the influxdb client to query to
     :return: the result as a generator of points
     """
-    try:
-        results = client.query(query)
-    except:
-        client.close()
-        return
-    return results.get_points()
+    return client.query(query).get_points()
 
 
-def query_convolution(client, from_time):
+def chunks_to_frame(chunks):
     """
-    Query the db for the convolution signal, from the specified sample
+    Build the dataframe of an answer from its chunks of numpy columns (see
+    influx_client.iter_columns), each chunk is converted to its final types as
+    soon as it arrives, and the chunks are concatenated only once at the end
+    :param chunks: iterable of the dicts {column: numpy array} of the chunks
+    :return: pandas dataframe of the points, the 'time' column is a UTC datetime,
+             empty if there is no point
+    """
+    frames = []
+    for arrays in chunks:
+        if len(arrays.get('time', ())) == 0:
+            continue
+        df = pd.DataFrame(arrays, copy=False)
+        df['time'] = pd.to_datetime(df['time'], unit='ns', utc=True)
+        # The measurements are float fields, but a chunk of whole values is
+        # decoded as integers
+        for col in CONVOL_COLS:
+            if col in df.columns and df[col].dtype.kind in 'iu':
+                df[col] = df[col].astype(np.float64)
+        frames.append(df)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def query_frame(query, client):
+    """
+    Query the db with a chunked answer decoded straight into numpy columns
+    (see influx_client.iter_columns), for the big queries : the points are
+    never held as python dicts, and the columns of each chunk are converted
+    as they arrive (see chunks_to_frame)
+    :param query: string of the query to execute
     :param client: the influxdb client to query to
-    :param from_time: string of the time we want to query data from
-    :return: the result as a generator of points
+    :return: pandas dataframe of the points, the 'time' column is a UTC datetime
     """
-    query = ('SELECT * FROM "db"."autogen"."convol_signals" '
-             + 'WHERE time >= \'' + from_time + '\'')
-    return query_to_points(query, client)
+    return chunks_to_frame(influx_client.iter_columns(client, query))
 
 
-def query_last_raw_values(last_cleaned_time, client):
+def query_last_raw_values(last_cleaned_time, client, source=SOURCE, n=HISTORY_ROWS):
     """
     Query the last values that were convolved (the actual values, not the last
-    values of the convolutions).
+    values of the convolutions), i.e. the last n raw rows up to the last
+    cleaned one, the history of the detectors (see HISTORY_ROWS)
     :param last_cleaned_time: int, the time of the last data that was cleaned
     :param client: the influxdb client to query to
+    :param source: the tag source of the raw data
+    :param n: int, the number of rows
     :return: If last_cleaned_time == 0, return None,
-             otherwise return a Dataframe containing only the whole last row
+             otherwise return a Dataframe of the rows sorted by time
     """
     if last_cleaned_time == '0':
         return None
 
-    return pd.DataFrame(query_to_points(
+    df = pd.DataFrame(query_to_points(
         ('SELECT * FROM "db"."autogen"."data" '
-         + 'WHERE "source" = \'sensehat\' AND time = \''
-         + str(last_cleaned_time) + '\''),
+         + 'WHERE "source" = \'' + source + '\' AND time <= \''
+         + str(last_cleaned_time) + '\' ORDER BY time DESC LIMIT ' + str(n)),
          client))
+    if len(df.index) == 0:
+        return None
+    return df.iloc[::-1].reset_index(drop=True)
+
+
+def query_previous_rows(client, before, n=1, source=SOURCE):
+    """
+    Query the last n raw sensehat rows with a time strictly before the given time
+    :param client: the influxdb client to query to
+    :param before: string of the time
+    :param n: int, the number of rows
+    :param source: the tag source of the raw data
+    :return: Dataframe of the rows sorted by time, or None if there is none
+    """
+    df = pd.DataFrame(query_to_points(
+        ('SELECT * FROM "db"."autogen"."data" WHERE "source" = \'' + source
+         + '\' AND time < \'' + str(before) + '\' ORDER BY time DESC LIMIT ' + str(n)),
+        client))
+    if len(df.index) == 0:
+        return None
+    return df.iloc[::-1].reset_index(drop=True)
 
 
-def check_clean_measurement(client):
+def check_clean_measurement(client, watermark=CONVOL_MEASUREMENT):
     """
-    Check if the measurement 'clean_data' exists in the influxdb server
-    in database 'db'. If not, then no data have been cleaned yet and
-    return False, otherwise, some data have been cleaned and return True
+    Check if the measurement watermark (by default 'convol_signals') exists
+    in the influxdb server in database 'db'. If not, then no data have been
+    cleaned yet and return False, otherwise, some data have been cleaned
+    and return True
     :param client: the influxdb client to query to
+    :param watermark: string, the measurement written by each cleaning
     :return: True if some data have already been cleaned, False otherwise
     """
     meas = client.get_list_measurements()
     for m in meas:
-        if m.get('name') == 'convol_signals':
+        if m.get('name') == watermark:
             return True
 
     # The clean_data measurement was not found,
@@ -117,7 +224,23 @@ def check_clean_measurement(client):
     return False
 
 
-def query_data_to_clean(client, source, last_cleaned='0', update_last_cleaned=True, fields='*'):
+def source_condition(source):
+    """
+    Build the condition on the tag source of the points written by the cleaning
+    (convolution signals, clean data). The points written before they were
+    tagged have no source, they belong to the default source (see SOURCE).
+    ::tag because the clean data of that time have a field source too
+    :param source: the tag source of the raw data
+    :return: string of the condition
+    """
+    condition = '"source"::tag = \'' + source + '\''
+    if source == SOURCE:
+        condition += ' OR "source"::tag = \'\''
+    return '(' + condition + ')'
+
+
+def query_data_to_clean(client, source, last_cleaned='0', update_last_cleaned=True, fields='*',
+                        watermark=CONVOL_MEASUREMENT):
     """
     Make the right query according to the data that were already cleaned or not
     and the given source tag value. Can pass directly the timestamp of last
@@ -128,13 +251,16 @@ def query_data_to_clean(client, source, last_cleaned='0', update_last_cleaned=Tr
     :param last_cleaned: int, the time of the last data that was cleaned
     :param update_last_cleaned: boolean : True if you want to seek the time of the last cleaned data
     :param fields: the fields we want to fetch
+    :param watermark: string, the measurement whose last point is the last
+                      cleaned sample
     :return: (timestamp of last cleaned sample, string of the query)
     """
-    if check_clean_measurement(client) and not (last_cleaned == '0' and not update_last_cleaned):
+    if check_clean_measurement(client, watermark) and not (last_cleaned == '0' and not update_last_cleaned):
         # Measurement already exists
         if update_last_cleaned:
-            # Query what was the last cleaned data point
-            query = 'SELECT LAST("temperature") FROM "db"."autogen"."convol_signals"'
+            # Query what was the last cleaned data point of the source
+            query = ('SELECT LAST("temperature") FROM "db"."autogen"."' + watermark
+                     + '" WHERE ' + source_condition(source))
             points = query_to_points(query, client)
 
             # Get the timestamp of the last cleaned sample, not nice ...
@@ -153,39 +279,56 @@ def query_data_to_clean(client, source, last_cleaned='0', update_last_cleaned=Tr
 
 def convolve_dataframe(src_df, dst_df, previous_row):
     """
-    Convolve the entire dataframe (columns by columns) with given filter
-    and store the convolved signals into the given dest_df, keeping
-    the same columns names. It also sets the 1st element of each column to 0
-    as the convolution is just the identity for the 1st element
-    with the default filter. Default filter is the finite differences filter,
+    Compute the scores of the detector of each column (see DETECTORS) on the
+    whole CONVOL_COLS block at once and store them into the given dest_df,
+    keeping the same columns names. With the default finite_difference
+    detector, it is the convolution with the finite differences filter,
     i.e. approximation of the derivative. previous_row is a Dataframe
-    containing the last values (the whole last row) that were convolved
-    (i.e. the temperature, etc, not the value of the convolution itself).
-    This is to avoid a gap in the convolution between 2 calls
+    containing the last values (the whole last rows, see HISTORY_ROWS) that
+    were convolved (i.e. the temperature, etc, not the value of the
+    convolution itself). This is to avoid a gap in the signals between 2
+    calls, without it the first score of the finite differences is 0 and
+    the windows of the other detectors restart at each batch
     :param dst_df: the destination pandas dataframe
     :param src_df: the source pandas dataframe
-    :param previous_row: the measurement values of the last convolved data (see above)
+    :param previous_row: the measurement values of the last convolved rows (see above)
     """
-    if len(src_df.index) >= 3:
-        filter=[0, 1, -1]
-        df_np = src_df[CONVOL_COLS].to_numpy()
+    history = None
+    if previous_row is not None:
+        history = previous_row[CONVOL_COLS].to_numpy(dtype=np.float64)
 
-        # Convolve all the columns except 'time' along their axis (axis 0)
-        lambd = lambda col: np.convolve(col, filter, 'same')
-        convol_np = np.apply_along_axis(lambd, axis=0, arr=df_np)
+    scores = detectors.score(src_df[CONVOL_COLS].to_numpy(dtype=np.float64),
+                             history, [DETECTORS[col] for col in CONVOL_COLS])
+    for i in range(len(CONVOL_COLS)):
+        dst_df[CONVOL_COLS[i]] = scores[:, i]
 
-        if previous_row is None:
-            convol_np[0, :] = 0
-        else:
-            # Set the first values of each columns in the convolutions to the
-            # difference with the actual first value - actual last treated value
-            # to avoid gap in the convolutions signals between 2 different calls
-            convol_np[0, :] = df_np[0, :] - previous_row[CONVOL_COLS].to_numpy()[0]
 
-        # Again, not yet found a way to set multiple columns at once
-        # with multi-dimensional np array
-        for i in range(len(CONVOL_COLS)):
-            dst_df[CONVOL_COLS[i]] = convol_np[:, i]
+def interpolate_anomalies(values, anormal, previous_value=None):
+    """
+    Replace (in place) all the anormal values at once by a linear interpolation
+    between the nearest good (i.e. not anormal) neighbors. Runs of consecutive
+    anormal values are interpolated over the whole run, so the result does not
+    depend on the order in which they are corrected. If there is no good value
+    after a run, the last good value is copied, if there is no good value before
+    it, the previous_value is used as neighbor (or the next good value is copied
+    if there is no previous_value)
+    :param values: numpy array of the measurement values
+    :param anormal: boolean numpy array, True where the value is anormal
+    :param previous_value: float, the last value of the previous batch, or None
+    """
+    positions = np.arange(values.shape[0])
+    good = ~anormal
+    good_pos = positions[good]
+    good_values = values[good]
+
+    if previous_value is not None:
+        # The last value of the previous batch is a neighbor at index -1
+        good_pos = np.concatenate(([-1], good_pos))
+        good_values = np.concatenate(([previous_value], good_values))
+
+    if good_pos.shape[0] > 0:
+        # np.interp copies the first/last good value outside of the good range
+        values[anormal] = np.interp(positions[anormal], good_pos, good_values)
 
 
 def clean_column(dataframe, dataframe_convol, col, previous_row,
@@ -193,57 +336,59 @@ def clean_column(dataframe, dataframe_convol, col, previous_row,
     """
     Clean the given column with the specified rules below (see function clean_data)
     The mode specify the techniques used to correct values : average or copy
-    previous_row is the same as for convolve_dataframe
+    previous_row is the same as for convolve_dataframe, or the last cleaned row
+    when it is known (see clean_data)
     :param dataframe: the pandas dataframe containing the measurements values
     :param dataframe_convol: the pandas dataframe containing the convolutions values
     :param col: the column we want to clean in dataframe
-    :param previous_row: the measurement values of the last convolved data (see above)
-    :param mode: string, either 'average' to take the average between neighbors
-                 to fill a missing value, or 'copy' to copy the value from
-                 another measurement
+    :param previous_row: the measurement values of the last convolved rows (see above)
+    :param mode: string, either 'average' to interpolate between the nearest good
+                 neighbors to fill a missing value, or 'copy' to copy the value
+                 from another measurement
     """
-    values = dataframe[col].to_numpy()
+    values = dataframe[col].to_numpy(dtype=np.float64, copy=True)
     convol = dataframe_convol[col].to_numpy()
 
     # Detect the indexes where the corresponding threshold is exceeded
-    anormal_index = np.argwhere(np.absolute(convol) > THRESHOLDS[col])
+    anormal = np.absolute(convol) > THRESHOLDS[col]
 
     if mode == 'average':
-        for i in anormal_index:
-            if 0 < i < values.shape[0] - 1:
-                # I.e. there exist previous and next values
-                values[i] = (values[i - 1] + values[i + 1]) / 2.0
-            elif i > 0:
-                # I.e. there is no next value, or we don't have it yet
-                values[i] = values[i - 1]
-            else:
-                if previous_row is None:
-                    # I.e. there is no previous value
-                    values[i] = values[i + 1]
-                else:
-                    values[i] = (previous_row[col].to_numpy()[0] + values[i + 1]) / 2.0
+        previous_value = None
+        if previous_row is not None:
+            previous_value = previous_row[col].to_numpy()[-1]
+        interpolate_anomalies(values, anormal, previous_value)
     else:
         # I.e. copy method, only for temperature
-        values[anormal_index] = dataframe[TMP_H].to_numpy()[anormal_index]
+        values[anormal] = dataframe[TMP_H].to_numpy()[anormal]
     dataframe[col] = values
 
 
-def clean_data(dataframe, dataframe_convol, previous_row):
+def clean_data(dataframe, dataframe_convol, previous_row, previous_clean_row=None):
     """
     Correct the anormal values spotted by the convolution signal
     Correct (in order):
-      1) Humidity : average of previous and next values (if existent)
-      2) Pressure : average of previous and next values (if existent)
-      3) Temperature_humidity : average of previous and next values (if existent)
-      4) Temperature_pressure : average of previous and next values (if existent)
+      1) Humidity : interpolation between previous and next good values (if existent)
+      2) Pressure : interpolation between previous and next good values (if existent)
+      3) Temperature_humidity : interpolation between previous and next good
+                                values (if existent)
+      4) Temperature_pressure : interpolation between previous and next good
+                                values (if existent)
       5) Temperature : same value as the temperature_humidity,
                        because they seem very close. In worst case,
                        it takes the corrected value of temperature_humidity
-    It takes the dataframe to clean and the dataframe of the convolution in args
+    It takes the dataframe to clean and the dataframe of the convolution in args.
+    If the cleaned values of the last convolved data are known, they are used
+    instead of the previous_row ones as neighbors of the first values, so that
+    an anormal value at the end of the previous batch is not used to correct them
     :param dataframe: the pandas dataframe containing the measurements values
     :param dataframe_convol: the pandas dataframe containing the convolutions values
-    :param previous_row: the measurement values of the last convolved data (see above)
+    :param previous_row: the measurement values of the last convolved rows (see above)
+    :param previous_clean_row: the cleaned (not adjusted) values of the last
+                               convolved data, or None
     """
+    if previous_clean_row is not None:
+        previous_row = previous_clean_row
+
     columns = [HUM, PRES,
                TMP_H, TMP_P, TMP]
     for col in columns:
@@ -253,29 +398,44 @@ def clean_data(dataframe, dataframe_convol, previous_row):
             clean_column(dataframe, dataframe_convol, col, previous_row, mode='average')
 
 
+def trailing_anomalies(df, previous_row):
+    """
+    Count the anormal rows (in any column) at the end of the batch, they are
+    corrected with the next good values, which are not in the batch
+    :param df: the pandas dataframe of the raw data of the batch
+    :param previous_row: the measurement values of the last convolved rows
+                         (see convolve_dataframe), or None
+    :return: int, the number of rows
+    """
+    scores = pd.DataFrame(index=df.index)
+    convolve_dataframe(df, scores, previous_row)
+    anormal = np.zeros(len(df.index), dtype=bool)
+    for col in CONVOL_COLS:
+        anormal |= np.absolute(scores[col].to_numpy()) > THRESHOLDS[col]
+    normal = np.flatnonzero(~anormal)
+    return len(df.index) - (normal[-1] + 1 if len(normal) > 0 else 0)
+
+
 def prepare_ms_df(src_df, time_column):
     """
-    Make the meteo suisse dataframe dst_df containing the interpolated data for
-    every hour using the module format_OD from the given src_df "raw" meteo
-    suisse dataframe. The hours corresponds to the given 'time' column.
-    :param src_df:
-    :param time_column:
-    :return: the formated dataframe dst_df
+    Make the meteo suisse dataframe dst_df containing the data interpolated
+    at the times of the given 'time' column (see resample.py), Nan where the
+    meteo suisse data have a gap longer than MS_MAX_GAP
+    :param src_df: the "raw" meteo suisse dataframe
+    :param time_column: the times of the sensehat samples
+    :return: the formated dataframe dst_df, with the same rows as time_column
     """
     if len(src_df.index) == 0:
         return None
 
-    # Add the needed columns to the newly created dst_df dataframe:
-    # with the correct size : 'time', TMP, HUM
-    dst_df = pd.DataFrame()
-    dst_df['time'] = pd.to_datetime(time_column)
-    len_dst = len(dst_df.index)
-    dst_df[TMP] = np.empty(len_dst)
-    dst_df[HUM] = np.empty(len_dst)
+    # The fields missing in the open data ('-') are left out of the points,
+    # a column of the batch may be missing
+    src_df = src_df.reindex(columns=['time'] + FORMATED_COLS)
 
-    # Format the dataframe
-    format_OD.format_dataframe(dst_df, src_df, FORMATED_COLS)
-    return dst_df
+    # Format the dataframe : 'time', TMP, HUM, in a single vectorized pass
+    return resample.resample_frame(src_df, time_column,
+                                   {col: 'linear' for col in FORMATED_COLS},
+                                   max_gap=MS_MAX_GAP)
 
 
 def avg_diff_df(form_ms_df, sensehat_clean_df):
@@ -310,16 +470,17 @@ def avg_diff_df(form_ms_df, sensehat_clean_df):
 def adjust_df(dst_df, adjustements):
     """
     Adjust the whole dataframe dst_df according to the adjustements dict,
-    which specify the adjustement to do for each column in the formated df
+    which specify the adjustement to do for each column in the formated df,
+    either one value for the whole column or an array with one value per row
     :param dst_df: the pandas dataframe to write to
     :param adjustements: dict : the adjustements to make
     """
-    dst_np = dst_df[ADJUSTED_COLS].to_numpy()
+    dst_np = dst_df[ADJUSTED_COLS].to_numpy(dtype=np.float64)
 
     # Careful to put the columns in the same order
-    adjust_np = np.array([adjustements[TMP], adjustements[HUM],
-                          adjustements[TMP_H],
-                          adjustements[TMP_P]])
+    adjust_np = np.column_stack([
+        np.broadcast_to(adjustements[col], (dst_np.shape[0],))
+        for col in (TMP, HUM, TMP_H, TMP_P)])
     result_np = dst_np - adjust_np
 
     # Not yet found a way to set all the columns at once with a multi-dimensional
@@ -329,50 +490,294 @@ def adjust_df(dst_df, adjustements):
         dst_df[ADJUSTED_COLS[i]] = result_np[:, i]
 
 
-def write_df(df_to_write, measurement, df_client):
+def write_df(df_to_write, measurement, df_client, batch_size=None):
     """
     Write the given dataframe to the measurement on the database corresponding to
     the influxdb client
     :param df_to_write: the pandas dataframe to write to the influxdb server
     :param measurement: string, the measurement to write the dataframe
                         into in the influxdb
-    :param df_client: the influxdb client for writing directly from pandas dataframe
+    :param df_client: the influxdb client to write to, the dataframe is
+                      encoded to the line protocol (see line_protocol.py)
+    :param batch_size: int, maximum number of points sent in one request,
+                       or None to send them all at once
     """
+    # The source (if any) is a tag, as in the raw data
+    tags = ['source'] if 'source' in df_to_write.columns else None
+    # A row without any value would not be a valid point (e.g. the first
+    # scores of a detector that needs previous values)
+    fields = [col for col in df_to_write.columns if col != 'source']
+    df_to_write = df_to_write.dropna(how='all', subset=fields)
     if len(df_to_write.index) > 0:
-        df_client.write_points(df_to_write, measurement)
+        line_protocol.write_frame(df_client, df_to_write, measurement,
+                                  tag_columns=tags, batch_size=batch_size)
+        metrics.count('points', len(df_to_write.index))
 
 
-# ------------------------------------------------------------------------------
-# ------------------------------------------------------------------------------
-# Script
-# ------------------------------------------------------------------------------
-# ------------------------------------------------------------------------------
+def to_rfc3339(time):
+    """
+    Format the given time as a RFC3339 UTC string that can be used in a query
+    :param time: string or datetime of the time
+    :return: the time as a string formated as YYYY-MM-DDThh:mm:ss.ffffffZ
+    """
+    time = pd.Timestamp(time)
+    if time.tzinfo is not None:
+        time = time.tz_convert('UTC')
+    return time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
 
-def main():
-    # Connect to influxdb
-    client = InfluxDBClient(host=IP_RP4,
-                            port=PORT,
-                            username=USER_NAME,
-                            password=PWD,
-                            database=DB_NAME,
-                            timeout=10)
 
-    # String of the query to make to get the data to clean
-    last_cleaned_time, query = query_data_to_clean(client, 'sensehat')
+def query_range(source, start=None, end=None, fields='*', limit=None):
+    """
+    Build the query of the points of the given source tag value(s), with a time
+    strictly after start and strictly before end. start and end can be None
+    (or '0' for start) for no bound
+    :param source: the tag source in the influxdb, i.e. either 'sense_hat' or
+                   'meteosuisse', or a list of them
+    :param start: string of the time we want to query data from (excluded)
+    :param end: string of the time we want to query data until (excluded)
+    :param fields: the fields we want to fetch
+    :param limit: int, maximum number of points to fetch, or None
+    :return: string of the query
+    """
+    sources = [source] if isinstance(source, str) else source
+    query = ('SELECT ' + fields + ' FROM "db"."autogen"."data" WHERE ('
+             + ' OR '.join('"source" = \'' + s + '\'' for s in sources) + ')')
+    if start is not None and start != '0':
+        query += ' AND time > \'' + str(start) + '\''
+    if end is not None:
+        query += ' AND time < \'' + str(end) + '\''
+    if limit is not None:
+        query += ' LIMIT ' + str(limit)
+    return query
+
+
+def query_next_time(client, source, after):
+    """
+    Query the time of the first point of the given source after the given time
+    :param client: the influxdb client to query to
+    :param source: the tag source in the influxdb
+    :param after: string of the time, '0' to search from the begining
+    :return: the time as a string, or None if there is no such point
+    """
+    points = query_to_points(query_range(source, start=after,
+                                         fields='FIRST("temperature")'), client)
+    for point in points:
+        return point['time']
+    return None
 
-    # Make the query and get the generator of points
-    points = query_to_points(query, client)
 
-    # Create panda dataframe
-    df = pd.DataFrame(points)
+def query_stations(start, end, station=None):
+    """
+    Build the query of the temperature and humidity of the meteo suisse
+    stations, with a time strictly after start and strictly before end
+    :param start: string of the time we want to query data from (excluded)
+    :param end: string of the time we want to query data until (excluded)
+    :param station: string, the code of the station, or None for all of them
+    :return: string of the query
+    """
+    query = ('SELECT "temperature", "humidity", "station" FROM "db"."autogen"."'
+             + STATIONS_MEASUREMENT + '" WHERE time > \'' + str(start)
+             + '\' AND time < \'' + str(end) + '\'')
+    if station is not None:
+        query += ' AND "station" = \'' + station + '\''
+    return query
 
-    # If there is no data to clean, exit
-    if len(df.index) <= 0:
-        client.close()
-        sys.exit()
 
-    # ------------------------------------------------------------------------------
-    # Cleaning
+def best_reference_station(df, df_stations, min_samples=10):
+    """
+    Choose the meteo suisse station that follows best the sensehat data :
+    the one for which the difference of temperature with the sensehat
+    varies the least (the constant part of the difference is removed
+    by the calibration anyway)
+    :param df: the pandas dataframe of the (raw) sensehat data
+    :param df_stations: the pandas dataframe of the stations data, with a
+                        'station' column (see query_stations)
+    :param min_samples: int, the minimum number of samples to compare
+    :return: string, the code of the best station, or None
+    """
+    best, best_std = None, np.inf
+    for station, df_station in df_stations.groupby('station'):
+        form_df = prepare_ms_df(df_station.reset_index(drop=True), df['time'])
+        diff = df[TMP].to_numpy(dtype=np.float64) - form_df[TMP].to_numpy()
+        diff = diff[~np.isnan(diff)]
+        if diff.shape[0] >= min_samples and np.std(diff) < best_std:
+            best, best_std = station, np.std(diff)
+    return best
+
+
+def query_reference(client, reference_station, df, start, end):
+    """
+    Query the data of the given reference station between start and end.
+    With 'best', the data of all the stations are queried and the one
+    following best the sensehat data is kept (see best_reference_station)
+    :param client: the influxdb client to query to
+    :param reference_station: string, the code of the station, or 'best'
+    :param df: the pandas dataframe of the (raw) sensehat data
+    :param start: string of the time we want to query data from (excluded)
+    :param end: string of the time we want to query data until (excluded)
+    :return: the pandas dataframe of the reference station data
+    """
+    if reference_station != 'best':
+        return query_frame(query_stations(start, end, reference_station), client)
+
+    df_stations = query_frame(query_stations(start, end), client)
+    if len(df_stations.index) == 0:
+        return df_stations
+    station = best_reference_station(df, df_stations)
+    return df_stations[df_stations['station'] == station].reset_index(drop=True)
+
+
+def query_batch(client, start, end=None, limit=None, reference_station=None,
+                source=SOURCE):
+    """
+    Query the sensehat data to clean, with a time strictly after start and
+    strictly before end (or the limit first ones), and the meteo suisse data
+    around them (see MS_MARGIN). Without limit and reference station, both are
+    fetched with a single query
+    :param client: the influxdb client to query to
+    :param start: string of the time of the last cleaned data, or '0'
+    :param end: string of the time we want to clean data until (excluded), or None
+    :param limit: int, maximum number of sensehat points to fetch, or None
+    :param reference_station: string, the code of the meteo suisse station to
+                              compare to in 'meteosuisse_stations', 'best' to
+                              choose it, or None to use the meteo suisse data
+                              in 'data'
+    :param source: the tag source of the raw data
+    :return: (sensehat dataframe, meteo suisse dataframe)
+    """
+    if limit is not None or reference_station is not None:
+        df = query_frame(query_range(source, start=start, end=end,
+                                     limit=limit), client)
+        if len(df.index) == 0:
+            return df, df
+        ms_start = to_rfc3339(pd.Timestamp(df['time'].iloc[0]) - MS_MARGIN)
+        ms_end = to_rfc3339(pd.Timestamp(df['time'].iloc[-1]) + MS_MARGIN)
+        if reference_station is not None:
+            df_ms = query_reference(client, reference_station, df, ms_start, ms_end)
+        else:
+            df_ms = query_frame(query_range(MS_SOURCE, start=ms_start,
+                                            end=ms_end), client)
+        return df, df_ms
+
+    ms_start = None if start == '0' else to_rfc3339(pd.Timestamp(start) - MS_MARGIN)
+    ms_end = None if end is None else to_rfc3339(pd.Timestamp(end) + MS_MARGIN)
+    df_all = query_frame(query_range([source, MS_SOURCE],
+                                     start=ms_start, end=ms_end), client)
+    if len(df_all.index) == 0:
+        return df_all, df_all
+
+    # Split the sources and keep only the sensehat data in the batch range
+    times = pd.to_datetime(df_all['time'], utc=True)
+    in_batch = df_all['source'] == source
+    if start != '0':
+        in_batch &= times > pd.Timestamp(start)
+    if end is not None:
+        in_batch &= times < pd.Timestamp(end)
+    df = df_all[in_batch].reset_index(drop=True)
+    df_ms = df_all[df_all['source'] == MS_SOURCE].reset_index(drop=True)
+    return df, df_ms
+
+
+def align_convolution(df, df_convol):
+    """
+    Align the convolution signals on the rows of the measurements dataframe,
+    joining them on the timestamp, so that elements at the same index in both
+    dataframes correspond to the same time
+    :param df: the pandas dataframe containing the measurements values
+    :param df_convol: the pandas dataframe containing the convolutions values,
+                      indexed by datetime
+    :return: the convolutions dataframe with the same indexing as df
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(df['time'], utc=True))
+    index = pd.DatetimeIndex(df_convol.index)
+    if index.tz is None:
+        index = index.tz_localize('UTC')
+    aligned = df_convol.set_axis(index, axis=0).reindex(times)
+    return aligned.reset_index(drop=True)
+
+
+def merge_calibration(batch_diffs, avg_diffs):
+    """
+    Merge the average differences computed on the current batch with the ones
+    of the previous batch : the columns for which the current batch could not
+    be compared to the meteo suisse data (i.e. Nan) keep the previous value
+    :param batch_diffs: dict, the average differences of the current batch (or None)
+    :param avg_diffs: dict, the average differences of the previous batch (or None)
+    :return: dict, the average differences to use for the current batch (or None)
+    """
+    if batch_diffs is None:
+        return avg_diffs
+    if avg_diffs is None:
+        return batch_diffs
+    return {col: avg_diffs[col] if np.isnan(diff) else diff
+            for col, diff in batch_diffs.items()}
+
+
+def calibration_differences(df, form_df):
+    """
+    Returns the differences between the sensehat data and the formated meteo
+    suisse data of each row, the ones added to the running calibration
+    :param df: the pandas dataframe of the clean sensehat data of the batch
+    :param form_df: the formated meteo suisse dataframe (see prepare_ms_df)
+    :return: dict {column: numpy array of the differences}
+    """
+    diffs = (df[FORMATED_COLS].to_numpy(dtype=np.float64)
+             - form_df[FORMATED_COLS].to_numpy(dtype=np.float64))
+    return {FORMATED_COLS[i]: diffs[:, i] for i in range(len(FORMATED_COLS))}
+
+
+def running_adjustements(df, form_df, calibrator):
+    """
+    Add the differences between the sensehat data and the formated meteo
+    suisse data of the batch to the running calibration (in place), and
+    returns the adjustements of each row (see calibration.offsets)
+    :param df: the pandas dataframe of the clean sensehat data of the batch
+    :param form_df: the formated meteo suisse dataframe (see prepare_ms_df), or None
+    :param calibrator: dict of the running calibration (see calibration.py)
+    :return: dict of the adjustements for adjust_df, or None if the
+             calibration is still empty
+    """
+    if form_df is not None:
+        calibration.update(calibrator, df['time'], calibration_differences(df, form_df))
+
+    offsets = calibration.offsets(calibrator, df['time'])
+    if offsets is None:
+        return None
+    # Same adjustements for the temperatures as in avg_diff_df
+    return {TMP: offsets[TMP], HUM: offsets[HUM],
+            TMP_H: offsets[TMP], TMP_P: offsets[TMP]}
+
+
+def clean_batch(df, df_ms, previous_row, previous_clean_row, avg_diffs, df_client,
+                persist_convol=True, batch_size=None, calibrator=None):
+    """
+    Convolve, clean and adjust the given batch of raw sensehat data and write
+    the results to the influxdb server. Returns the state needed by the next
+    batch, so that the batches can be processed one after another
+    :param df: the pandas dataframe of the raw data of the batch, sorted by time
+    :param df_ms: the pandas dataframe of the meteo suisse data around the batch
+    :param previous_row: the measurement values of the last convolved rows
+                         (see convolve_dataframe), None for the first batch ever
+    :param previous_clean_row: the cleaned values of the last convolved data
+                               (see clean_data), or None
+    :param avg_diffs: dict, the average differences used to adjust the previous
+                      batch (see avg_diff_df), or None
+    :param df_client: the influxdb client for writing directly from pandas dataframe
+    :param persist_convol: boolean, False to not write the convolution signals
+                           to the influxdb server
+    :param batch_size: int, maximum number of points sent in one request
+                       (see write_df), or None
+    :param calibrator: dict of the running calibration (see calibration.py),
+                       updated in place and used instead of avg_diffs to adjust
+                       the batch, or None to adjust it with avg_diffs
+    :return: (previous_row, previous_clean_row, avg_diffs) to give to the next batch
+    """
+    # Keep the raw values of the last rows for the next batch (the history of
+    # the detectors), before they get cleaned
+    history = df if previous_row is None else pd.concat([previous_row, df],
+                                                         ignore_index=True)
+    last_raw_row = history.iloc[-HISTORY_ROWS:].reset_index(drop=True)
+
     # ------------------------------------------------------------------------------
     # Do the convolutions
 
@@ -384,73 +789,351 @@ def main():
     df_convol = df_convol.set_index('Datetime')
 
     # Convolve the entire dataframe
-    previous_row = query_last_raw_values(last_cleaned_time, client)
-
-    convolve_dataframe(df, dst_df=df_convol, previous_row=previous_row)
-
-    # Connect to DB with a DataFrameClient
-    df_client = DataFrameClient(host=IP_RP4,
-                                port=PORT,
-                                username=USER_NAME,
-                                password=PWD,
-                                database=DB_NAME,
-                                timeout=10)
+    with metrics.stage('convolve'):
+        convolve_dataframe(df, dst_df=df_convol, previous_row=previous_row)
+    if 'source' in df.columns:
+        # Tag the convolution signals with the device, it is their watermark
+        df_convol['source'] = df['source'].to_numpy()
 
     # Write the convolved signals to the influxdb server
-    write_df(df_convol, 'convol_signals', df_client)
+    if persist_convol:
+        with metrics.stage('write_convol'):
+            write_df(df_convol, CONVOL_MEASUREMENT, df_client, batch_size)
 
     # ------------------------------------------------------------------------------
     # Correct the anormal values
 
-    # The result dataframe is now the original df
-    # !!! Normally, elements at the same index in dataframe df and df_convol
-    # correspond to the same timestamp (as this script is exectued in its
-    # completeness via a cron job, so both index the same time range). However,
-    # if e.g. only the convolution is done and later the cleaning, then they won't
-    # have the same indexing. To avoid this, we query again the db for the correct
-    # time range, so we don't have problems with indexing
-    from_time = df['time'].to_numpy()[0]
-    df_convol = pd.DataFrame(query_convolution(client, from_time))
+    # The result dataframe is now the original df, elements at the same index
+    # in df and df_convol must correspond to the same timestamp, so we join
+    # them on the time
+    df_convol = align_convolution(df, df_convol)
 
     # Clean the data
-    clean_data(df, df_convol, previous_row)
+    with metrics.stage('clean'):
+        clean_data(df, df_convol, previous_row, previous_clean_row)
     # Now the dataframe df is clean
+    last_clean_row = df.iloc[[-1]].reset_index(drop=True)
 
     # ------------------------------------------------------------------------------
-    # Now fetch the meteo suisse data and adjust,
-    # we don't want to again search for last sample in the convolution signal
-    # as we just wrote the new convolved samples
-    last_cleaned_time, query = query_data_to_clean(client,
-                                                   source='meteosuisse',
-                                                   last_cleaned=last_cleaned_time,
-                                                   update_last_cleaned=False,
-                                                   fields='"temperature", "humidity"')
-    points_ms = query_to_points(query, client)
-    df_ms = pd.DataFrame(points_ms)
+    # Now adjust with the meteo suisse data around the batch
 
     # Format the meteo suisse data dataframe
-    form_df = prepare_ms_df(df_ms, df['time'])
-    if form_df is not None:
-        # Get the average differences for each columns
-        # (i.e. sensehat data - meteo suisse data)
-        avg_diffs = avg_diff_df(form_df, df)
-
-        # Adjust the clean sensehat dataframe "df" with the average differences
-        # for each column (in place)
-        adjust_df(df, avg_diffs)
-
+    with metrics.stage('format_OD'):
+        form_df = prepare_ms_df(df_ms, df['time'])
+        batch_diffs = None
+        if form_df is not None:
+            # Get the average differences for each columns
+            # (i.e. sensehat data - meteo suisse data)
+            batch_diffs = avg_diff_df(form_df, df)
+        avg_diffs = merge_calibration(batch_diffs, avg_diffs)
+
+    with metrics.stage('adjust'):
+        adjustements = avg_diffs
+        if calibrator is not None:
+            adjustements = running_adjustements(df, form_df, calibrator)
+
+        if adjustements is not None:
+            # Adjust the clean sensehat dataframe "df" with the average differences
+            # for each column (in place)
+            adjust_df(df, adjustements)
+
+    if adjustements is not None:
         # Now "df" is the sensehat data, cleaned and adjusted
         # Write the result to the measurement "clean_sh_data"
         # (just have to set the index to the time column to be able to write
         # directly to the influxdb database)
-        df['time'] = pd.to_datetime(df['time'])
-        df = df.set_index('time')
-        write_df(df, 'clean_sh_data', df_client)
+        with metrics.stage('write_clean'):
+            df['time'] = pd.to_datetime(df['time'])
+            df = df.set_index('time')
+            write_df(df, CLEAN_MEASUREMENT, df_client, batch_size)
+
+    return last_raw_row, last_clean_row, avg_diffs
+
+
+def query_sources(client):
+    """
+    Query the devices that have raw data, i.e. the values of the tag source of
+    'data' except the meteo suisse one
+    :param client: the influxdb client to query to
+    :return: sorted list of the sources
+    """
+    points = query_to_points('SHOW TAG VALUES FROM "data" WITH KEY = "source"', client)
+    return sorted(point['value'] for point in points if point['value'] != MS_SOURCE)
+
+
+def state_path(source):
+    """
+    Path of the local state file of the source (see clean_state), each source
+    has its own so the workers cleaning several sources never write the same
+    file. The default source keeps the original file
+    :param source: the tag source of the raw data
+    :return: string of the path
+    """
+    if source == SOURCE:
+        return clean_state.STATE_FILE
+    root, extension = os.path.splitext(clean_state.STATE_FILE)
+    return root + '_' + source + extension
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def clean_source(source=SOURCE, window=None, window_rows=None, persist_convol=True,
+                 use_state=True, reference_station=None, running_calibration=True,
+                 update_rollups=True):
+    """
+    Clean all the data of the source that were not cleaned yet. By default, all
+    of them are loaded and cleaned at once. With a window (pandas Timedelta) or
+    a window_rows (int), they are processed in consecutive windows of that
+    duration or number of rows, so that the memory used does not depend
+    on the amount of data to clean. Without persisting the convolution
+    signals, the last cleaned sample is the last one of the source in
+    'clean_sh_data'.
+    The time of the last cleaned sample, the last rows and the calibration are
+    read from the local state file of the source (see state_path), the
+    influxdb server is only queried for them when the state is missing or stale
+    :param source: the tag source of the raw data to clean
+    :param window: pandas Timedelta, the duration of a window, or None
+    :param window_rows: int, the maximum number of rows in a window, or None
+    :param persist_convol: boolean, False to not write the convolution signals
+    :param use_state: boolean, False to ignore the local state and query the
+                      influxdb server for it
+    :param reference_station: string, the code of the meteo suisse station
+                              used for the calibration, 'best' to choose it
+                              for each batch, or None for the one in 'data'
+    :param running_calibration: boolean, True to adjust the data with the
+                                running calibration kept in the state (see
+                                calibration.py), False with the average
+                                differences of each batch
+    :param update_rollups: boolean, True to compute again the hours, days and
+                           months of the rollups touched by the run (see rollups.py)
+    :return: (time of the first cleaned sample, time of the last cleaned
+             sample), the first one is None if there was nothing to clean
+    """
+    metrics.start_run('clean', {'source': source})
+
+    # Connect to influxdb, and to DB with a DataFrameClient for the writes,
+    # both share the same connections
+    client, df_client = influx_client.connect_pair()
+
+    # Time of the last cleaned data, last rows and calibration
+    with metrics.stage('load_state'):
+        watermark = CONVOL_MEASUREMENT if persist_convol else CLEAN_MEASUREMENT
+        path = state_path(source)
+        state = clean_state.load_state(path)
+        source_state = None
+        if use_state:
+            source_state = clean_state.get_source_state(state, source, watermark)
+
+        if source_state is not None:
+            last_cleaned_time = source_state['last_cleaned']
+            previous_row = source_state['previous_row']
+            previous_clean_row = source_state['previous_clean_row']
+            avg_diffs = source_state['avg_diffs']
+        else:
+            # Missing or stale state, fall back to the influxdb server
+            last_cleaned_time, _ = query_data_to_clean(client, source,
+                                                       watermark=watermark)
+            previous_row = query_last_raw_values(last_cleaned_time, client, source)
+            previous_clean_row = None
+            avg_diffs = None
+
+    # The running calibration does not depend on the watermark, it is
+    # kept even if the rest of the state is stale
+    calibrator = None
+    if running_calibration:
+        if use_state:
+            calibrator = clean_state.get_calibration(state, source)
+        if calibrator is None:
+            calibrator = calibration.new_calibration(FORMATED_COLS)
+
+    first_cleaned_time = None
+    success = False
+    try:
+        while True:
+            with metrics.stage('query'):
+                end = None
+                if window is not None:
+                    # The window starts at the first point not cleaned yet,
+                    # so we don't loop over empty windows after an outage
+                    first_time = query_next_time(client, source, last_cleaned_time)
+                    if first_time is None:
+                        break
+                    end = to_rfc3339(pd.Timestamp(first_time) + window)
+
+                # Make the query and create panda dataframes of the batch
+                df, df_ms = query_batch(client, last_cleaned_time, end=end,
+                                        limit=window_rows,
+                                        reference_station=reference_station,
+                                        source=source)
+                metrics.count('rows', len(df.index))
+                metrics.count('ms_rows', len(df_ms.index))
+
+            # If there is no (more) data to clean, stop
+            if len(df.index) <= 0:
+                break
+
+            if window is not None or window_rows is not None:
+                # The anormal rows at the end of a window are cleaned with the
+                # next one, with the good values after them, as in a single run
+                held = trailing_anomalies(df, previous_row)
+                if 0 < held < len(df.index) and query_next_time(
+                        client, source, to_rfc3339(df['time'].iloc[-1])) is not None:
+                    df = df.iloc[:-held]
+
+            if first_cleaned_time is None:
+                first_cleaned_time = df['time'].iloc[0]
+            # As a string, it is used in the next queries and kept in the state
+            last_cleaned_time = to_rfc3339(df['time'].iloc[-1])
+            previous_row, previous_clean_row, avg_diffs = clean_batch(
+                df, df_ms, previous_row, previous_clean_row, avg_diffs, df_client,
+                persist_convol=persist_convol, calibrator=calibrator)
+            metrics.count('batches')
+            del df, df_ms
+
+            # The batch is written, save the state so that the next batch
+            # (or the next run) starts from here
+            with metrics.stage('save_state'):
+                clean_state.set_source_state(state, source, watermark,
+                                             last_cleaned_time, previous_row,
+                                             previous_clean_row, avg_diffs, calibrator)
+                clean_state.save_state(state, path)
+
+            if window is None and window_rows is None:
+                # Everything was cleaned at once
+                break
+
+        # Update the hourly, daily and monthly aggregates of the cleaned data
+        if update_rollups and first_cleaned_time is not None:
+            with metrics.stage('rollups'):
+                rollups.update_rollups(client, df_client, first_cleaned_time,
+                                       last_cleaned_time, CONVOL_COLS)
+        success = True
+    finally:
+        # Write the metrics of the run, even if it failed
+        metrics.finish_run(client, success)
+
+        # Close the connections to the influxdb server
+        df_client.close()
+        client.close()
+
+    return first_cleaned_time, last_cleaned_time
+
+
+def main(sources=None, workers=WORKERS, window=None, window_rows=None,
+         persist_convol=True, use_state=True, reference_station=None,
+         running_calibration=True, update_rollups=True):
+    """
+    Clean the data of the sources that were not cleaned yet (see clean_source).
+    A single source is cleaned in this process. Several sources are cleaned at
+    once, each one by a worker process, then the rollups are updated once over
+    the times cleaned for all of them
+    :param sources: list of the tag sources of the raw data, 'all' for all the
+                    devices in the influxdb (see query_sources), or None for
+                    the default source
+    :param workers: int, the maximum number of sources cleaned at once
+    :param window: pandas Timedelta, the duration of a window, or None
+    :param window_rows: int, the maximum number of rows in a window, or None
+    :param persist_convol: boolean, False to not write the convolution signals
+    :param use_state: boolean, False to ignore the local states and query the
+                      influxdb server for them
+    :param reference_station: string, the code of the meteo suisse station
+                              used for the calibration, 'best' to choose it
+                              for each batch, or None for the one in 'data'
+    :param running_calibration: boolean, False to adjust the data with the
+                                average differences of each batch
+    :param update_rollups: boolean, True to compute again the hours, days and
+                           months of the rollups touched by the run
+    """
+    if sources == 'all':
+        client = influx_client.connect()
+        try:
+            sources = query_sources(client)
+        finally:
+            client.close()
+    sources = sources or [SOURCE]
+    options = dict(window=window, window_rows=window_rows,
+                   persist_convol=persist_convol, use_state=use_state,
+                   reference_station=reference_station,
+                   running_calibration=running_calibration)
+    if len(sources) == 1 or workers <= 1:
+        for source in sources:
+            clean_source(source, update_rollups=update_rollups, **options)
+        return
 
-    # Close the connections to the influxdb server
-    df_client.close()
-    client.close()
+    # The rollups group the clean data by source, they are updated once for
+    # all the sources, over the union of the times cleaned
+    ranges = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+        futures = {executor.submit(clean_source, source, update_rollups=False,
+                                   **options): source for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                first, last = future.result()
+            except Exception as e:
+                # The other sources are still cleaned, the failed one starts
+                # again from its last saved state at the next run
+                print('Cleaning of ' + source + ' failed : ' + repr(e))
+                failed.append(source)
+                continue
+            if first is not None:
+                ranges.append((pd.Timestamp(first), pd.Timestamp(last)))
+
+    if update_rollups and len(ranges) > 0:
+        metrics.start_run('clean', {'source': 'all'})
+        client, df_client = influx_client.connect_pair()
+        success = False
+        try:
+            with metrics.stage('rollups'):
+                rollups.update_rollups(client, df_client,
+                                       to_rfc3339(min(r[0] for r in ranges)),
+                                       to_rfc3339(max(r[1] for r in ranges)),
+                                       CONVOL_COLS)
+            success = True
+        finally:
+            metrics.finish_run(client, success)
+            df_client.close()
+            client.close()
+
+    if len(failed) > 0:
+        raise RuntimeError('Cleaning failed for ' + ', '.join(sorted(failed)))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Clean the raw sensehat data')
+    parser.add_argument('--sources', default=SOURCE,
+                        help='comma separated sources (devices) to clean, or all '
+                             'for all of them (default: ' + SOURCE + ')')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='maximum number of sources cleaned at once')
+    parser.add_argument('--window', type=pd.Timedelta, default=None,
+                        help='clean the data by windows of that duration (e.g. 1d)')
+    parser.add_argument('--window-rows', type=int, default=None,
+                        help='clean the data by windows of that number of rows')
+    parser.add_argument('--no-convol', action='store_true',
+                        help='do not write the convolution signals to the db')
+    parser.add_argument('--reset-state', action='store_true',
+                        help='ignore the local state and query the db for it, '
+                             'the running calibration is thrown away and starts '
+                             'again empty')
+    parser.add_argument('--reference-station', default=None,
+                        help='meteo suisse station used for the calibration '
+                             '(e.g. MAS), or best to choose it')
+    parser.add_argument('--batch-calibration', action='store_true',
+                        help='adjust each batch with its own average differences '
+                             'instead of the running calibration')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help='do not update the hourly, daily and monthly rollups')
+    args = parser.parse_args()
+    sources = args.sources if args.sources == 'all' else args.sources.split(',')
+    main(sources=sources, workers=args.workers, window=args.window,
+         window_rows=args.window_rows, persist_convol=not args.no_convol,
+         use_state=not args.reset_state,
+         reference_station=args.reference_station,
+         running_calibration=not args.batch_calibration,
+         update_rollups=not args.no_rollups)
@@ -0,0 +1,217 @@
+#!/bin/python3
+
+# This module :
+#   1) Stores locally, in a json file, the state of the cleaning of each
+#      source : the time of the last cleaned sample (watermark), the last raw
+#      row, the last cleaned row, the calibration of the last batch and the
+#      running calibration (see calibration.py)
+#   2) The file is updated atomically (written to a temporary file that
+#      replaces the old one), so a crash or a power cut on the Raspberry Pi
+#      never leaves a half written state
+#   3) A missing, unreadable or stale state means clean.py has to fall back
+#      to the queries on the influxdb server
+
+import os
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# Constants
+STATE_FILE = 'clean_state.json'
+STATE_VERSION = 1
+
+# After that long without update, the state is not trusted anymore
+# (e.g. the data may have been cleaned from another machine in the meantime)
+MAX_STATE_AGE = timedelta(days=7)
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def to_json_value(value):
+    """
+    Convert the given value (e.g. a numpy scalar) to a value that can be
+    written in json, Nan values become None
+    :param value: the value to convert
+    :return: the converted value
+    """
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return value
+
+
+def row_to_dict(row):
+    """
+    Convert a dataframe containing only one row to a dict that can be
+    written in json
+    :param row: the pandas dataframe containing only one row, or None
+    :return: dict of the row {column: value}, or None
+    """
+    if row is None:
+        return None
+    return {col: to_json_value(value) for col, value in row.iloc[0].items()}
+
+
+def rows_to_list(rows):
+    """
+    Convert a dataframe to a list of dicts that can be written in json
+    :param rows: the pandas dataframe, or None
+    :return: list of the dicts of the rows (see row_to_dict), or None
+    """
+    if rows is None:
+        return None
+    return [row_to_dict(rows.iloc[[i]]) for i in range(len(rows.index))]
+
+
+def dict_to_row(values):
+    """
+    Convert a dict written by row_to_dict (or a list of them written by
+    rows_to_list) back to a dataframe, None values become Nan
+    :param values: dict of the row {column: value}, list of them, or None
+    :return: the pandas dataframe of the rows, or None
+    """
+    if values is None:
+        return None
+    if isinstance(values, dict):
+        values = [values]
+    return pd.DataFrame([{col: np.nan if value is None else value
+                          for col, value in row.items()} for row in values])
+
+
+def load_state(path=STATE_FILE):
+    """
+    Read the state file, returns an empty state if it is missing,
+    unreadable or written by another version
+    :param path: string, the path of the state file
+    :return: dict of the state
+    """
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {'version': STATE_VERSION, 'sources': {}}
+
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        return {'version': STATE_VERSION, 'sources': {}}
+    state.setdefault('sources', {})
+    return state
+
+
+def save_state(state, path=STATE_FILE):
+    """
+    Write atomically the state to the state file : it is written to a
+    temporary file in the same directory, synced to the disk and then
+    renamed to replace the previous state file
+    :param state: dict of the state
+    :param path: string, the path of the state file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.clean_state.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    # Also sync the directory, so that the rename itself is on the disk
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def get_source_state(state, source, watermark, max_age=MAX_STATE_AGE):
+    """
+    Returns the state of the given source, if it can be trusted, i.e. it was
+    saved with the same watermark measurement and recently enough
+    :param state: dict of the state
+    :param source: string, the tag source in the influxdb (e.g. 'sensehat')
+    :param watermark: string, the measurement whose last point is the last
+                      cleaned sample (see clean.query_data_to_clean)
+    :param max_age: timedelta, the maximum age of the state
+    :return: dict {'last_cleaned', 'previous_row', 'previous_clean_row',
+             'avg_diffs'} or None if it is missing or stale
+    """
+    entry = state['sources'].get(source)
+    if entry is None or entry.get('watermark') != watermark:
+        return None
+
+    try:
+        updated = datetime.strptime(entry['updated'], TIME_FORMAT).replace(tzinfo=timezone.utc)
+    except (KeyError, ValueError):
+        return None
+    if datetime.now(timezone.utc) - updated > max_age:
+        return None
+
+    avg_diffs = entry.get('avg_diffs')
+    if avg_diffs is not None:
+        avg_diffs = {col: np.nan if diff is None else diff
+                     for col, diff in avg_diffs.items()}
+
+    return {'last_cleaned': entry['last_cleaned'],
+            'previous_row': dict_to_row(entry.get('previous_row')),
+            'previous_clean_row': dict_to_row(entry.get('previous_clean_row')),
+            'avg_diffs': avg_diffs}
+
+
+def get_calibration(state, source):
+    """
+    Returns the running calibration of the given source (see calibration.py),
+    whatever the age of the state, as it can not be rebuilt from the
+    influxdb server without querying the whole history
+    :param state: dict of the state
+    :param source: string, the tag source in the influxdb (e.g. 'sensehat')
+    :return: dict of the calibration, or None
+    """
+    entry = state['sources'].get(source)
+    if entry is None:
+        return None
+    return entry.get('calibration')
+
+
+def set_source_state(state, source, watermark, last_cleaned, previous_row,
+                     previous_clean_row, avg_diffs, calibration=None):
+    """
+    Update the state of the given source (in place), it still has to be
+    written with save_state
+    :param state: dict of the state
+    :param source: string, the tag source in the influxdb (e.g. 'sensehat')
+    :param watermark: string, the measurement whose last point is the last
+                      cleaned sample
+    :param last_cleaned: string, the time of the last cleaned sample
+    :param previous_row: dataframe of the last raw rows (see clean.convolve_dataframe)
+    :param previous_clean_row: dataframe of the last cleaned row (see clean.clean_data)
+    :param avg_diffs: dict, the calibration (see clean.avg_diff_df), or None
+    :param calibration: dict of the running calibration (see calibration.py),
+                        or None to keep the one already in the state
+    """
+    if calibration is None:
+        calibration = get_calibration(state, source)
+    if avg_diffs is not None:
+        avg_diffs = {col: to_json_value(diff) for col, diff in avg_diffs.items()}
+
+    state['sources'][source] = {
+        'watermark': watermark,
+        'last_cleaned': str(last_cleaned),
+        'previous_row': rows_to_list(previous_row),
+        'previous_clean_row': row_to_dict(previous_clean_row),
+        'avg_diffs': avg_diffs,
+        'calibration': calibration,
+        'updated': datetime.now(timezone.utc).strftime(TIME_FORMAT)
+    }
@@ -0,0 +1,280 @@
+#!/bin/python3
+
+# This module :
+#   1) Registers the anomaly detectors that can be used by clean.py, each one
+#      computes a score for every value of a 2-D block of measurements (one
+#      column per measured field) at once, with numpy sliding windows :
+#       a) finite_difference : difference with the previous value, i.e. the
+#          historical [0, 1, -1] convolution
+#       b) second_difference : difference with the mean of the previous and
+#          next values, an isolated spike of height h gets a score of h and
+#          its neighbours only h / 2
+#       c) rolling_median : difference with the median of the centered window
+#       d) hampel : difference with the median of the centered window, in
+#          number of standard deviations estimated by the MAD
+#       e) mad_zscore : modified z-score against the median and the MAD of the
+#          previous values only (trailing window), so it does not need the
+#          next values
+#   2) A value is anormal when the absolute value of its score exceeds the
+#      threshold of its column, in the unit of the field for a) b) c) and in
+#      number of standard deviations for d) e)
+#   Each detector takes the values (n rows) and the history, i.e. the last
+#   rows of the previous batch (or None), so the scores do not have a gap
+#   between 2 batches, and returns the scores as a (n, columns) array. The
+#   number of rows of history each detector needs is registered with it (see
+#   history_rows), clean.py keeps that many raw rows between the batches. The
+#   centered windows (c, d) also need the next values : the last values of a
+#   batch are scored without them (Nan padding), and are not scored again by
+#   the next batch
+
+import inspect
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ------------------------------------------------------------------------------
+# Constants
+
+# Number of rows of the sliding windows processed at once, so the memory
+# used by the windows does not grow with the size of the batch
+CHUNK_ROWS = 65536
+
+# Ratio between the standard deviation and the MAD for a normal distribution
+MAD_SCALE = 1.4826
+
+# Name -> function of the detector
+DETECTORS = {}
+
+# Name -> function of the parameters returning the number of previous rows
+# the detector uses
+HISTORY = {}
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def register(name, history=lambda params: 1):
+    """
+    Decorator registering the decorated function as the detector of the given name
+    :param name: string, the name of the detector used in the configuration
+    :param history: function of the dict of the parameters of the detector
+                    (defaults included) returning the number of previous rows
+                    it uses
+    :return: the decorator
+    """
+    def decorator(function):
+        DETECTORS[name] = function
+        HISTORY[name] = history
+        return function
+    return decorator
+
+
+def history_rows(config):
+    """
+    Returns the number of previous rows the detectors need, so the scores of
+    the first rows of a batch are the same as if the previous batch was part
+    of it
+    :param config: list of (name of the detector, dict of its parameters),
+                   one per column
+    :return: int, at least 1
+    """
+    rows = 1
+    for name, params in config:
+        signature = inspect.signature(DETECTORS[name]).parameters
+        values = {key: parameter.default for key, parameter in signature.items()
+                  if parameter.default is not inspect.Parameter.empty}
+        values.update(params)
+        rows = max(rows, HISTORY[name](values))
+    return rows
+
+
+def pad(values, history, before, after):
+    """
+    Stack the last rows of the history before the values, and Nan rows after
+    them. When there are not enough rows in the history, the missing ones are Nan
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :param before: int, the number of rows to put before the values
+    :param after: int, the number of Nan rows to put after the values
+    :return: the padded 2-D numpy array
+    """
+    head = np.full((before, values.shape[1]), np.nan)
+    if history is not None and before > 0:
+        last = history[-before:]
+        head[before - len(last):] = last
+    return np.concatenate((head, values, np.full((after, values.shape[1]), np.nan)))
+
+
+def nan_median(windows, medians):
+    """
+    Replace the Nan medians (i.e. of the windows containing a Nan) by the
+    median of the values of the window that are not Nan
+    :param windows: numpy array of the windows, the last axis is the window
+    :param medians: numpy array of the medians of the windows, updated in place
+    """
+    missing = np.isnan(medians)
+    if missing.any():
+        with warnings.catch_warnings():
+            # The windows without any value keep a Nan median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            medians[missing] = np.nanmedian(windows[missing], axis=-1)
+
+
+def rolling_median(padded, window, n, with_mad=False):
+    """
+    Compute the median (and the median absolute deviation) of the n windows
+    padded[i:i + window] of each column, ignoring the Nan values
+    :param padded: 2-D numpy array of the values (see pad)
+    :param window: int, the size of the windows
+    :param n: int, the number of windows
+    :param with_mad: boolean, True to also compute the MAD
+    :return: (medians, MADs or None), 2-D numpy arrays of n rows
+    """
+    views = sliding_window_view(padded, window, axis=0)
+    medians = np.empty((n, padded.shape[1]))
+    mads = np.empty((n, padded.shape[1])) if with_mad else None
+
+    for start in range(0, n, CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, n)
+        windows = views[start:end]
+        median = np.median(windows, axis=-1)
+        nan_median(windows, median)
+        medians[start:end] = median
+        if with_mad:
+            deviations = np.absolute(windows - median[..., None])
+            mad = np.median(deviations, axis=-1)
+            nan_median(deviations, mad)
+            mads[start:end] = mad
+    return medians, mads
+
+
+@register('finite_difference')
+def finite_difference(values, history):
+    """
+    Difference with the previous value, 0 for the first value if there is
+    no history
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :return: 2-D numpy array of the scores
+    """
+    scores = np.empty_like(values, dtype=np.float64)
+    # Directly into the result, a temporary array would cost more than the
+    # subtraction itself
+    np.subtract(values[1:], values[:-1], out=scores[1:])
+    scores[0] = 0 if history is None else values[0] - history[-1]
+    return scores
+
+
+@register('second_difference')
+def second_difference(values, history):
+    """
+    Difference with the mean of the previous and next values (i.e. minus half
+    the centered second difference), or with the only one of them that is known
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :return: 2-D numpy array of the scores
+    """
+    padded = pad(values, history, 1, 1)
+    previous = padded[:-2]
+    following = padded[2:]
+    neighbors = np.where(np.isnan(previous), following,
+                         np.where(np.isnan(following), previous,
+                                  (previous + following) / 2))
+    return values - neighbors
+
+
+@register('rolling_median', history=lambda params: params['window'] // 2)
+def rolling_median_difference(values, history, window=7):
+    """
+    Difference with the median of the centered window
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :param window: int, the size of the window (odd)
+    :return: 2-D numpy array of the scores
+    """
+    half = window // 2
+    medians, _ = rolling_median(pad(values, history, half, half),
+                                2 * half + 1, len(values))
+    return values - medians
+
+
+@register('hampel', history=lambda params: params['window'] // 2)
+def hampel(values, history, window=7, min_mad=0.01):
+    """
+    Hampel filter score : difference with the median of the centered window,
+    divided by the standard deviation estimated by the MAD of the window
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :param window: int, the size of the window (odd)
+    :param min_mad: float, lower bound of the MAD, so a constant signal
+                    does not give infinite scores
+    :return: 2-D numpy array of the scores
+    """
+    half = window // 2
+    medians, mads = rolling_median(pad(values, history, half, half),
+                                   2 * half + 1, len(values), with_mad=True)
+    return (values - medians) / (MAD_SCALE * np.maximum(mads, min_mad))
+
+
+@register('mad_zscore', history=lambda params: params['window'])
+def mad_zscore(values, history, window=12, min_periods=5, min_mad=0.01):
+    """
+    Modified z-score against the median and the MAD of the window of the
+    previous values (not including the value itself). The scores are Nan
+    (i.e. never anormal) while there are less than min_periods previous values
+    :param values: 2-D numpy array of the values
+    :param history: 2-D numpy array of the previous values, or None
+    :param window: int, the number of previous values in the window
+    :param min_periods: int, the minimum number of previous values
+    :param min_mad: float, lower bound of the MAD (see hampel)
+    :return: 2-D numpy array of the scores
+    """
+    n = len(values)
+    padded = pad(values, history, window, 0)
+    medians, mads = rolling_median(padded, window, n, with_mad=True)
+
+    # Number of values that are not Nan in each window
+    known = np.concatenate((np.zeros((1, values.shape[1])),
+                            np.cumsum(~np.isnan(padded), axis=0)))
+    counts = known[window:window + n] - known[:n]
+
+    scores = (values - medians) / (MAD_SCALE * np.maximum(mads, min_mad))
+    scores[counts < min_periods] = np.nan
+    return scores
+
+
+def score(values, history, config):
+    """
+    Compute the scores of all the columns, the columns using the same detector
+    with the same parameters are processed together as one 2-D block
+    :param values: 2-D numpy array of the values, one column per field
+    :param history: 2-D numpy array of the previous values (same columns), or None
+    :param config: list of (name of the detector, dict of its parameters),
+                   one per column
+    :return: 2-D numpy array of the scores
+    """
+    groups = {}
+    for i in range(len(config)):
+        name, params = config[i]
+        if name not in DETECTORS:
+            raise ValueError('Unknown detector ' + name + ', available : '
+                             + ', '.join(DETECTORS))
+        groups.setdefault((name, tuple(sorted(params.items()))), []).append(i)
+
+    if len(groups) == 1 and len(values) > 0:
+        # Same detector for all the columns, no need to split the block
+        (name, params), = groups
+        return DETECTORS[name](values, history, **dict(params))
+
+    # Same memory layout as the values, i.e. column by column for the
+    # values of a dataframe
+    scores = np.empty_like(values, dtype=np.float64)
+    if len(values) == 0:
+        return scores
+    for (name, params), columns in groups.items():
+        block_history = None if history is None else history[:, columns]
+        scores[:, columns] = DETECTORS[name](values[:, columns], block_history,
+                                             **dict(params))
+    return scores
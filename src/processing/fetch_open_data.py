@@ -5,80 +5,376 @@
 #      https://opendata.swiss/en/dataset/automatische-wetterstationen-aktuelle-messwerte
 # -> Source: MétéoSuisse, Bundesamt für Meteorologie und Klimatologie
 #      we want the temperature, humidity
-#   2) Send them directly to the influxdb server
+#   2) The csv file is fetched with a conditional request (ETag /
+#      If-Modified-Since) and kept in a local cache : if it did not change
+#      since the last run, there is nothing to do
+#   3) Only the row of the station and the needed columns are parsed
+#   4) Send them directly to the influxdb server
+#   5) With --all-stations, every station of the csv file is also sent, with
+#      all its fields, to the measurement 'meteosuisse_stations' (tag 'station'),
+#      the point of the station is still sent to 'data' for clean.py
+#   6) The time of each stage of a run and the bytes downloaded are written to
+#      the measurement 'pipeline_metrics' (see common/metrics.py). When nothing
+#      new was sent, the client is not even created and the metrics only go
+#      to the Prometheus text file, if any
 
 # https://www.crummy.com/software/BeautifulSoup/bs4/doc/
 # https://requests.readthedocs.io/en/master/user/quickstart/#make-a-request
 # https://www.pluralsight.com/guides/extracting-data-html-beautifulsoup
 
-import pandas as pd
-from influxdb import InfluxDBClient
+import io
+import os
+import sys
+import gzip
+import json
+import argparse
+import urllib.request
+import urllib.error
+from datetime import datetime, timedelta
 
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+import influx_client
+import line_protocol
 
-# ------------------------------------------------------------------------------
-# Constants
-IP_RP4 = '192.168.1.124'
-PORT = 8086
-USER_NAME = 'collector'
-PWD = 'radis'
-DB_NAME = 'db'
 
 # ------------------------------------------------------------------------------
+# Constants
 
 # Source : MétéoSuisse, Bundesamt für Meteorologie und Klimatologie
 # obtained via https://opendata.swiss/en/dataset/automatische-wetterstationen-aktuelle-messwerte
 URL = 'https://data.geo.admin.ch/ch.meteoschweiz.messwerte-aktuell/VQHA80.csv'
 
-# Directly fetch the csv file containing the data,
-# and put it into a panda dataframe
-# it is ';' separator in the file and we want to drop the first 2 rows
-df = pd.read_csv(URL, sep=';', skiprows=2)
-
-
-# Read the temperature
-temp = df.loc[df['stn'] == 'MAS', 'tre200s0'].values[0]
-if temp != '-':
-    temp = float(temp)
-else:
-    temp = float("inf")
-
-# Read the humidity
-humidity = df.loc[df['stn'] == 'MAS', 'ure200s0'].values[0]
-if humidity != '-':
-    humidity = float(humidity)
-else:
-    humidity = float(-10)
-
-# Read the time when the data where measured, have to substract 1h
-# due to the time format in influxdb
-time = str(df.loc[df['stn'] == 'MAS', 'time'].values[0])
-timestamp = time[:4]+'-'+time[4:6]+'-'+time[6:8]+'T'+str((int(time[8:10]) - 1)%24)+':'+time[10:]+'Z'
-
-# Format the data as a point in json
-point = [{
-    'measurement': 'data',
-    'tags': {
-        'source': 'meteosuisse'
-    },
-    'time': timestamp,
-    'fields': {
-        'temperature': temp,
+CACHE_DIR = 'cache'
+STATION = 'MAS'
+
+# Columns of the csv file we want for each field
+COLUMNS = {'temperature': 'tre200s0',
+           'humidity': 'ure200s0'}
+
+STATIONS_MEASUREMENT = 'meteosuisse_stations'
+
+# Names of the fields for the columns of the csv file, the other columns keep
+# the MeteoSuisse parameter name
+FIELD_NAMES = {'tre200s0': 'temperature',
+               'rre150z0': 'precipitation',
+               'sre000z0': 'sunshine',
+               'gre000z0': 'global_radiation',
+               'ure200s0': 'humidity',
+               'tde200s0': 'dew_point',
+               'dkl010z0': 'wind_direction',
+               'fu3010z0': 'wind_speed',
+               'fu3010z1': 'gust_peak',
+               'prestas0': 'pressure',
+               'pp0qffs0': 'pressure_qff',
+               'pp0qnhs0': 'pressure_qnh'}
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def write_atomic(path, data):
+    """
+    Write the given bytes to the file, through a temporary file that replaces it
+    :param path: string, the path of the file
+    :param data: bytes to write
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_cache_meta(cache_dir=CACHE_DIR):
+    """
+    Read the metadata of the cached csv file (ETag, Last-Modified and the time
+    of the last point sent)
+    :param cache_dir: string, the path of the cache directory
+    :return: dict of the metadata, empty if there is no cache
+    """
+    try:
+        with open(os.path.join(cache_dir, 'VQHA80.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache_meta(meta, cache_dir=CACHE_DIR):
+    """
+    Write the metadata of the cached csv file
+    :param meta: dict of the metadata
+    :param cache_dir: string, the path of the cache directory
+    """
+    write_atomic(os.path.join(cache_dir, 'VQHA80.json'), json.dumps(meta).encode())
+
+
+def fetch_csv(url=URL, cache_dir=CACHE_DIR, timeout=30):
+    """
+    Fetch the csv file with a conditional request : if the server answers it
+    did not change since the cached version (304), it is not downloaded again
+    :param url: string, the url of the csv file
+    :param cache_dir: string, the path of the cache directory
+    :param timeout: float, the timeout of the request, in seconds
+    :return: (text of the csv file, True if it changed since the last fetch)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path = os.path.join(cache_dir, 'VQHA80.csv')
+    meta = read_cache_meta(cache_dir)
+
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if os.path.exists(data_path):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = response.read()
+            metrics.count('bytes', len(data))
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            meta['etag'] = response.headers.get('ETag')
+            meta['last_modified'] = response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        # Not modified, use the cached version
+        with open(data_path, 'rb') as f:
+            return f.read().decode('latin-1'), False
+
+    # New version, its points are not sent yet
+    meta['sent'] = False
+    meta['stations_sent'] = False
+    write_atomic(data_path, data)
+    write_cache_meta(meta, cache_dir)
+    return data.decode('latin-1'), True
+
+
+def parse_station(text, station=STATION, columns=('time',) + tuple(COLUMNS.values())):
+    """
+    Read only the given columns of the row of the given station in the csv
+    file (';' separator, the header is the line starting with 'stn').
+    It stops reading the file at the row of the station
+    :param text: string of the content of the csv file
+    :param station: string, the code of the station (e.g. 'MAS')
+    :param columns: the columns of the csv file we want
+    :return: dict {column: value as a string}, or None if the station is not found
+    """
+    lines = iter(text.splitlines())
+    for line in lines:
+        if line.startswith('stn;'):
+            header = line.split(';')
+            break
+    else:
+        return None
+
+    indexes = [header.index(col) for col in columns]
+    prefix = station + ';'
+    for line in lines:
+        if line.startswith(prefix):
+            row = line.split(';')
+            return {col: row[i] for col, i in zip(columns, indexes)}
+    return None
+
+
+def to_float(value):
+    """
+    Convert the value read in the csv file to a float, None when it is
+    missing ('-')
+    :param value: string, the value read in the csv file
+    :return: the value as a float, or None
+    """
+    if value == '-':
+        return None
+    return float(value)
+
+
+def to_timestamp(time):
+    """
+    Convert the time read in the csv file (YYYYMMDDhhmm) to the time of the
+    point, have to substract 1h due to the time format in influxdb
+    :param time: string, the time read in the csv file
+    :return: the time as a string formated as YYYY-MM-DDThh:mm:ssZ
+    """
+    return (datetime.strptime(time, '%Y%m%d%H%M')
+            - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def make_point(row):
+    """
+    Format the values of the row of the station as a point, the missing
+    values are left out of the fields
+    :param row: dict {column: value} (see parse_station)
+    :return: the line_protocol.Point
+    """
+    fields = {
+        'temperature': to_float(row[COLUMNS['temperature']]),
         'temperature_pressure': float(0),
         'temperature_humidity': float(0),
-        'humidity': humidity,
+        'humidity': to_float(row[COLUMNS['humidity']]),
         'pressure': float(0)
     }
-}]
+    return line_protocol.Point('data',
+                               {field: value for field, value in fields.items()
+                                if value is not None},
+                               {'source': 'meteosuisse'},
+                               to_timestamp(row['time']))
+
+
+def parse_all_stations(text):
+    """
+    Parse the whole csv file into a dataframe indexed by the time of the
+    points (see to_timestamp), with a 'station' column and one column per
+    field (see FIELD_NAMES). The missing values ('-') are Nan, and the
+    stations without any value are dropped
+    :param text: string of the content of the csv file
+    :return: the pandas dataframe of all the stations
+    """
+    import pandas as pd
+
+    # The header is the line starting with 'stn'
+    lines = text.splitlines()
+    header = next(i for i in range(len(lines)) if lines[i].startswith('stn;'))
+
+    df = pd.read_csv(io.StringIO(text), sep=';', skiprows=header,
+                     na_values='-', dtype={'stn': str, 'time': str})
+    df = df.dropna(subset=['stn', 'time'])
+
+    fields = (df.drop(columns=['stn', 'time'])
+              .apply(pd.to_numeric, errors='coerce')
+              .rename(columns=FIELD_NAMES))
+    fields['station'] = df['stn'].to_numpy()
+    fields.index = pd.DatetimeIndex(
+        pd.to_datetime(df['time'], format='%Y%m%d%H%M', utc=True)
+        - pd.Timedelta(hours=1))
+    return fields.dropna(how='all', subset=fields.columns.drop('station'))
+
+
+def write_all_stations(text, client):
+    """
+    Write all the stations of the csv file to the measurement
+    'meteosuisse_stations', with a single request
+    :param text: string of the content of the csv file
+    :param client: the influxdb client to write to
+    """
+    stations = parse_all_stations(text)
+    if len(stations.index) == 0:
+        return
+
+    line_protocol.write_frame(client, stations, STATIONS_MEASUREMENT,
+                              tag_columns=['station'])
+    metrics.count('points', len(stations.index))
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def send_open_data(connect, url=URL, cache_dir=CACHE_DIR, all_stations=False):
+    """
+    Fetch the csv file and send its new points
+    :param connect: function returning the influxdb client to write to, only
+                    called when there is something to write
+    :param url: string, the url of the csv file
+    :param cache_dir: string, the path of the cache directory
+    :param all_stations: boolean, True to also send all the stations
+    :return: True if points were written
+    """
+    # Directly fetch the csv file containing the data, only if it changed
+    with metrics.stage('fetch'):
+        text, changed = fetch_csv(url, cache_dir)
+    meta = read_cache_meta(cache_dir)
+    if not changed and meta.get('sent') and (meta.get('stations_sent') or not all_stations):
+        return False
+
+    written = False
+    if all_stations and not meta.get('stations_sent'):
+        with metrics.stage('write_stations'):
+            write_all_stations(text, connect())
+        written = True
+        meta['stations_sent'] = True
+        write_cache_meta(meta, cache_dir)
+
+    with metrics.stage('parse'):
+        row = parse_station(text)
+    if row is None:
+        print('Station ' + STATION + ' not found in ' + url)
+        return written
+
+    # Nothing new if the station still has the same measurement time
+    if meta.get('last_time') == row['time']:
+        meta['sent'] = True
+        write_cache_meta(meta, cache_dir)
+        return written
+
+    # Format the data as a point
+    point = [make_point(row)]
+
+    # Write the point to the server
+    with metrics.stage('write'):
+        line_protocol.write_points(connect(), point, precision='s')
+        metrics.count('points', len(point))
+
+    # Remember the measurement time that was sent
+    meta['last_time'] = row['time']
+    meta['sent'] = True
+    write_cache_meta(meta, cache_dir)
+    return True
+
+
+def finish_metrics(connect, success):
+    """
+    Write the metrics of the run (see metrics.finish_run), a failure to connect
+    to the server is only printed, so it never hides the error of the run
+    :param connect: function returning the client to write them to, or None to
+                    not write them to the server
+    :param success: boolean, True if the run succeeded
+    """
+    client = None
+    if connect is not None:
+        try:
+            client = connect()
+        except Exception as e:
+            print('Failed to connect to write the metrics of the run : ' + str(e))
+    metrics.finish_run(client, success)
+
+
+def main(url=URL, cache_dir=CACHE_DIR, all_stations=False, client=None):
+    # Connect to the influxdb server only when there is something to write,
+    # unless the client of a resident service (see ingest_service.py) is given
+    own_client = client is None
+
+    def connect():
+        nonlocal client
+        if client is None:
+            client = influx_client.connect_writer()
+        return client
 
-# Connect to the influxdb server
-client = InfluxDBClient(host=IP_RP4,
-                        port=PORT,
-                        username=USER_NAME,
-                        password=PWD,
-                        database=DB_NAME,
-                        timeout=10)
+    metrics.start_run('fetch_open_data')
+    success = False
+    written = False
+    try:
+        written = send_open_data(connect, url, cache_dir, all_stations)
+        success = True
+    finally:
+        # Write the metrics of the run to the server only if something was
+        # written or if it failed, an unchanged csv file is the common case
+        finish_metrics(connect if written or not success else None, success)
+        if own_client and client is not None:
+            client.close()
 
-# Write the point to the server
-client.write_points(point)
 
-client.close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the MeteoSuisse open data')
+    parser.add_argument('--url', default=URL, help='url of the csv file')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help='directory of the local cache')
+    parser.add_argument('--all-stations', action='store_true',
+                        help='send all the stations to ' + STATIONS_MEASUREMENT)
+    args = parser.parse_args()
+    main(args.url, args.cache_dir, args.all_stations)
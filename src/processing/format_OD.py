@@ -4,6 +4,9 @@
 #   1) format a pandas Dataframe, containing 2 columns (temperature and humidity)
 #   2) In particular, it interpolates the given data to output a pandas
 #      Dataframe with data for every hour
+#   3) It is the reference implementation : clean.py puts the meteo suisse
+#      data onto the sensehat times with the vectorized linear interpolation
+#      of resample.py, which gives the same values (see tests/test_format_OD.py)
 
 import numpy as np
 
@@ -114,7 +117,8 @@ def make_formated_column(dst_df, src_df, col):
     i = 0
     dst_time_np = dst_df['time'].to_numpy()
     src_time_np = src_df['time'].to_numpy()
-    dst_np = dst_df[col].to_numpy()
+    # A copy written back at the end, the array of the column may be read only
+    dst_np = dst_df[col].to_numpy(dtype=np.float64, copy=True)
     src_np = src_df[col].to_numpy()
     while(before(get_index(dst_time_np, i), get_index(src_time_np, 0))
           and i < len(dst_df.index)):
@@ -165,6 +169,7 @@ def make_formated_column(dst_df, src_df, col):
     while i < len_dst:
         dst_np[i] = np.nan
         i += 1
+    dst_df[col] = dst_np
 
 
 def format_dataframe(dst_df, src_df, columns):
@@ -179,3 +184,4 @@ def format_dataframe(dst_df, src_df, columns):
     """
     for col in columns:
         make_formated_column(dst_df, src_df, col)
+
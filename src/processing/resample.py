@@ -0,0 +1,284 @@
+#!/bin/python3
+
+# This module :
+#   1) Puts the samples of any number of sources (e.g. the sensehat and the
+#      meteo suisse data) onto the same times : a regular grid (e.g. every
+#      10 minutes or every hour, see make_grid) or the times of another source
+#   2) Each column has its own method :
+#       a) linear : linear interpolation between the samples around the time
+#       b) previous : value of the last sample at or before the time
+#       c) mean : mean of the samples of the bin [time, time + step)
+#   3) A maximum gap can be given : a time between 2 samples further apart
+#      than it (linear), or further than it from the last sample (previous),
+#      gets a Nan instead of a value bridging the outage. The empty bins of
+#      the mean are always Nan. The Nan values of a column are not samples
+#      of that column, its other columns still use them
+#   4) The times (strings, naive or timezone aware datetimes) are converted
+#      once to int64 nanoseconds since the epoch, the naive times are UTC and
+#      the aware ones are converted to UTC, so the sources with different
+#      timezones are aligned correctly. The grid is aligned on the multiples
+#      of the step since the epoch, i.e. on the UTC hours for an hourly grid
+#   All the columns of a source that use the same method are computed in a
+#   single vectorized pass over a 2-D block, no loop over the times nor the
+#   columns
+#
+# e.g. aligned = resample.align_sources({'sensehat': df, 'meteosuisse': df_ms},
+#                                       '10min', max_gap='1h')
+#      diff = aligned['sensehat']['temperature'] - aligned['meteosuisse']['temperature']
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# Constants
+METHODS = ['linear', 'previous', 'mean']
+
+DEFAULT_METHOD = 'linear'
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def to_epoch_ns(times):
+    """
+    Convert the times to nanoseconds since the epoch, the naive times are UTC
+    and the timezone aware times are converted to UTC
+    :param times: the times (strings, datetimes, pandas series or index)
+    :return: int64 numpy array
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(times, utc=True)).tz_convert(None)
+    return np.asarray(times, dtype='datetime64[ns]').view(np.int64)
+
+
+def to_nanoseconds(duration):
+    """
+    Convert a duration to nanoseconds
+    :param duration: pandas Timedelta, timedelta or string (e.g. '10min'), or None
+    :return: int, or None
+    """
+    if duration is None:
+        return None
+    return int(pd.Timedelta(duration).value)
+
+
+def make_grid(start, end, step):
+    """
+    Make a regular grid of times from start to end (both included), aligned
+    on the multiples of the step since the epoch (UTC)
+    :param start: the first time covered
+    :param end: the last time covered
+    :param step: pandas Timedelta, timedelta or string (e.g. '10min', '1h')
+    :return: int64 numpy array of the times of the grid in nanoseconds
+    """
+    step = to_nanoseconds(step)
+    first = to_epoch_ns([start])[0] // step * step
+    last = to_epoch_ns([end])[0]
+    return np.arange(first, last + 1, step, dtype=np.int64)
+
+
+def valid_neighbors(values, before, after):
+    """
+    Find, for each target and each column, the last sample at or before it
+    and the first sample at or after it where the column has a value
+    :param values: 2-D float numpy array of the samples (n, columns)
+    :param before: int numpy array of the last sample at or before each
+                   target (-1 if none)
+    :param after: int numpy array of the first sample at or after each
+                  target (n if none)
+    :return: (left, right) 2-D int numpy arrays (targets, columns) of the
+             samples, -1 where there is none before and n where there is
+             none after
+    """
+    n, columns = values.shape
+    shape = (before.shape[0], columns)
+    valid = ~np.isnan(values)
+    if valid.all():
+        # Nothing to skip, the usual case
+        return (np.broadcast_to(before[:, None], shape),
+                np.broadcast_to(after[:, None], shape))
+
+    rows = np.arange(n)[:, None]
+    previous = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, rows, n)[::-1], axis=0)[::-1]
+    left = np.where(before[:, None] >= 0, previous[np.maximum(before, 0)], -1)
+    right = np.where(after[:, None] < n, following[np.minimum(after, n - 1)], n)
+    return left, right
+
+
+def gather(values, rows):
+    """
+    Take values[rows[i, j], j] for each i, j, Nan where the row is out of range
+    :param values: 2-D numpy array (n, columns), n > 0
+    :param rows: 2-D int numpy array of the rows
+    :return: 2-D numpy array
+    """
+    inside = (rows >= 0) & (rows < values.shape[0])
+    taken = np.take_along_axis(values, np.clip(rows, 0, values.shape[0] - 1), axis=0)
+    return np.where(inside, taken, np.nan)
+
+
+def interpolate_linear(times, values, targets, max_gap=None):
+    """
+    Linear interpolation of each column at the target times, between its
+    samples around them. The times before the first sample or after the last
+    sample of a column are Nan
+    :param times: sorted int64 numpy array of the times of the samples
+    :param values: 2-D float numpy array of the samples (one column per field)
+    :param targets: int64 numpy array of the target times
+    :param max_gap: int, the maximum time between the 2 samples interpolated
+                    in nanoseconds, or None for no maximum
+    :return: 2-D float numpy array (targets, columns)
+    """
+    n = times.shape[0]
+    if n == 0:
+        return np.full((targets.shape[0], values.shape[1]), np.nan)
+    # Last sample at or before, first sample at or after each target time,
+    # then the nearest ones of each column that have a value
+    before = np.searchsorted(times, targets, side='right') - 1
+    after = np.searchsorted(times, targets, side='left')
+    left, right = valid_neighbors(values, before, after)
+
+    # The differences of the times are computed in int64 before the division,
+    # the nanoseconds since the epoch do not fit in the mantissa of a float
+    t_left = times[np.clip(left, 0, n - 1)]
+    duration = times[np.clip(right, 0, n - 1)] - t_left
+    exact = left == right
+    ratio = (targets[:, None] - t_left) / np.where(duration == 0, 1, duration)
+    y_left = gather(values, left)
+    y_right = gather(values, right)
+    # The missing neighbors give Nan
+    result = np.where(exact, y_left, y_left + (y_right - y_left) * ratio)
+    if max_gap is not None:
+        result[duration > max_gap] = np.nan
+    return result
+
+
+def interpolate_previous(times, values, targets, max_gap=None):
+    """
+    Value of the last sample of each column at or before the target times
+    :param times: sorted int64 numpy array of the times of the samples
+    :param values: 2-D float numpy array of the samples (one column per field)
+    :param targets: int64 numpy array of the target times
+    :param max_gap: int, the maximum age of the sample in nanoseconds, or None
+    :return: 2-D float numpy array (targets, columns)
+    """
+    n = times.shape[0]
+    if n == 0:
+        return np.full((targets.shape[0], values.shape[1]), np.nan)
+    before = np.searchsorted(times, targets, side='right') - 1
+    left, _ = valid_neighbors(values, before, before + 1)
+
+    result = gather(values, left)
+    if max_gap is not None:
+        age = targets[:, None] - times[np.clip(left, 0, n - 1)]
+        result[age > max_gap] = np.nan
+    return result
+
+
+def bin_mean(times, values, targets, step):
+    """
+    Mean of the samples of each column in the bins [target, target + step),
+    Nan for the bins without any sample
+    :param times: sorted int64 numpy array of the times of the samples
+    :param values: 2-D float numpy array of the samples (one column per field)
+    :param targets: sorted int64 numpy array of the start of the bins
+    :param step: int, the duration of the bins in nanoseconds
+    :return: 2-D float numpy array (targets, columns)
+    """
+    columns = values.shape[1]
+    if targets.shape[0] == 0:
+        return np.empty((0, columns))
+    bins = np.searchsorted(targets, times, side='right') - 1
+    inside = (bins >= 0) & (times < targets[np.maximum(bins, 0)] + step)
+
+    # One bincount for all the columns : the bins of column j are
+    # j * len(targets) + bin
+    valid = ~np.isnan(values) & inside[:, None]
+    keys = (np.arange(columns)[None, :] * targets.shape[0] + bins[:, None])[valid]
+    size = columns * targets.shape[0]
+    sums = np.bincount(keys, values[valid], minlength=size)
+    counts = np.bincount(keys, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.reshape(columns, targets.shape[0]).T
+
+
+def resample_frame(df, targets, methods=None, max_gap=None, step=None):
+    """
+    Put the columns of a source onto the target times, each column with its
+    method. The columns using the same method are computed at once
+    :param df: pandas dataframe of the source, with a 'time' column (the
+               rows are sorted by time if they are not)
+    :param targets: the target times (int64 nanoseconds, see make_grid, or
+                    times that to_epoch_ns converts), sorted
+    :param methods: dict {column: method} (see METHODS), or None for all
+                    the numeric columns with DEFAULT_METHOD
+    :param max_gap: the maximum gap (see interpolate_linear and
+                    interpolate_previous), a duration or None
+    :param step: the duration of the bins of the mean, needed by the mean
+    :return: pandas dataframe with a 'time' column (UTC) of the target times
+             and the resampled columns
+    """
+    # A series of timezone aware times would become an array of objects
+    if not (isinstance(targets, np.ndarray) and targets.dtype == np.int64):
+        targets = to_epoch_ns(targets)
+    if methods is None:
+        methods = {col: DEFAULT_METHOD for col in df.columns
+                   if col != 'time' and pd.api.types.is_numeric_dtype(df[col])}
+    for col, method in methods.items():
+        if method not in METHODS:
+            raise ValueError('Unknown method ' + method + ' for ' + col
+                             + ', available : ' + ', '.join(METHODS))
+    if 'mean' in methods.values() and step is None:
+        raise ValueError('The mean needs the step of the bins')
+
+    times = to_epoch_ns(df['time'])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    max_gap = to_nanoseconds(max_gap)
+
+    result = pd.DataFrame({'time': pd.to_datetime(targets, unit='ns', utc=True)})
+    for method in METHODS:
+        columns = [col for col in methods if methods[col] == method]
+        if len(columns) == 0:
+            continue
+        values = df[columns].to_numpy(dtype=np.float64)[order]
+        if method == 'linear':
+            block = interpolate_linear(times, values, targets, max_gap)
+        elif method == 'previous':
+            block = interpolate_previous(times, values, targets, max_gap)
+        else:
+            block = bin_mean(times, values, targets, to_nanoseconds(step))
+        for i in range(len(columns)):
+            result[columns[i]] = block[:, i]
+    return result[['time'] + [col for col in methods]]
+
+
+def align_sources(frames, step, methods=None, max_gap=None, start=None, end=None):
+    """
+    Put several sources onto the same regular grid, covering all their samples
+    (or from start to end), so they can be compared row by row
+    :param frames: dict {name of the source: pandas dataframe with a 'time' column}
+    :param step: the step of the grid (e.g. '10min', '1h')
+    :param methods: dict {name of the source: dict {column: method}}, the
+                    sources missing use DEFAULT_METHOD for all their numeric
+                    columns, or None
+    :param max_gap: the maximum gap (see resample_frame), a duration or None
+    :param start: the first time of the grid, or None for the first sample
+    :param end: the last time of the grid, or None for the last sample
+    :return: dict {name of the source: pandas dataframe on the grid}, all with
+             the same 'time' column
+    """
+    methods = methods or {}
+    epochs = [to_epoch_ns(df['time']) for df in frames.values() if len(df.index) > 0]
+    if start is None:
+        start = pd.Timestamp(min(t.min() for t in epochs), unit='ns', tz='UTC') if epochs else None
+    if end is None:
+        end = pd.Timestamp(max(t.max() for t in epochs), unit='ns', tz='UTC') if epochs else None
+    if start is None or end is None:
+        grid = np.empty(0, dtype=np.int64)
+    else:
+        grid = make_grid(start, end, step)
+    return {name: resample_frame(df, grid, methods.get(name), max_gap, step)
+            for name, df in frames.items()}
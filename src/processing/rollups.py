@@ -0,0 +1,225 @@
+#!/bin/python3
+
+# This module :
+#   1) Maintains the rollup measurements of the cleaned data : the min, max,
+#      mean and count of each field per hour ('clean_sh_hourly'), per day
+#      ('clean_sh_daily') and per month ('clean_sh_monthly'), in UTC, so the
+#      dashboards over months or years query a few points instead of all of
+#      'clean_sh_data'
+#   2) Only the windows touched by a run of the cleaning are computed again :
+#       a) the hours and the days from the start of the first day touched,
+#          from the cleaned data of 'clean_sh_data'
+#       b) the months touched, from the days of 'clean_sh_daily', as the
+#          min / max / mean / count can be merged without the cleaned data
+#   The fields of the rollups are named <field>_min, <field>_max, <field>_mean
+#   and <field>_count, the time of a point is the start of its window
+#   3) The rollups are grouped by source (tag). In 'clean_sh_data', the source
+#      was a field before it became a tag (clean.py, one source per device),
+#      both are read as the source of the point (see merge_source)
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import influx_client
+import line_protocol
+
+# ------------------------------------------------------------------------------
+# Constants
+CLEAN_MEASUREMENT = 'clean_sh_data'
+
+HOURLY_MEASUREMENT = 'clean_sh_hourly'
+DAILY_MEASUREMENT = 'clean_sh_daily'
+MONTHLY_MEASUREMENT = 'clean_sh_monthly'
+
+STATS = ['min', 'max', 'mean', 'count']
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def query_frame(client, measurement, start, end=None):
+    """
+    Query the points of the measurement with a time after start (included)
+    and before end (included)
+    :param client: the influxdb client to query to
+    :param measurement: string, the name of the measurement
+    :param start: pandas Timestamp (UTC)
+    :param end: pandas Timestamp (UTC), or None for no bound
+    :return: pandas dataframe indexed by the (UTC) time, sorted
+    """
+    query = ('SELECT * FROM "db"."autogen"."' + measurement + '" WHERE time >= \''
+             + start.strftime(TIME_FORMAT) + '\'')
+    if end is not None:
+        query += ' AND time <= \'' + end.strftime('%Y-%m-%dT%H:%M:%S.%fZ') + '\''
+    df = pd.DataFrame(influx_client.query_columns(client, query))
+    if len(df.index) == 0:
+        return df
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.pop('time'), unit='ns', utc=True))
+    return merge_source(df).sort_index()
+
+
+def merge_source(df):
+    """
+    Merge the source field and the source tag of the points of 'clean_sh_data'.
+    The points written before the source was a tag (see clean.write_df) have
+    it as a field, SELECT * returns both, the tag as source_1. A time cleaned
+    again since (e.g. by backfill.py) has both points, only the tagged one is kept
+    :param df: pandas dataframe of the points, indexed by time
+    :return: pandas dataframe with a single 'source' column
+    """
+    if 'source_1' not in df.columns:
+        return df
+    tagged = df['source_1'].notna().to_numpy()
+    df = df.assign(source=df['source_1'].where(tagged, df['source'])).drop(columns='source_1')
+    # The tagged points last, so they are the ones kept
+    df = df.iloc[np.argsort(tagged, kind='stable')]
+    keys = pd.MultiIndex.from_arrays([df.index, df['source'].to_numpy()])
+    return df[~keys.duplicated(keep='last')]
+
+
+def group_keys(df, freq):
+    """
+    Returns the keys grouping the rows of df by window (and by source if there
+    is a source column)
+    :param df: pandas dataframe indexed by time
+    :param freq: string, the pandas frequency of the windows ('h', 'D' or 'MS')
+    :return: list of the keys for groupby
+    """
+    if freq == 'MS':
+        # Months do not have a fixed length, floor does not handle them
+        windows = month_start(df.index)
+    else:
+        windows = df.index.floor(freq)
+    keys = [windows.rename('time')]
+    if 'source' in df.columns:
+        keys.append(df['source'].to_numpy())
+    return keys
+
+
+def aggregate(df, freq, columns):
+    """
+    Compute the min, max, mean and count of the given columns of the
+    cleaned data for each window
+    :param df: pandas dataframe of the cleaned data, indexed by time
+    :param freq: string, the pandas frequency of the windows
+    :param columns: list of the columns to aggregate
+    :return: pandas dataframe of the rollup, indexed by the start of the
+             windows, with a 'source' column if df has one
+    """
+    columns = [col for col in columns if col in df.columns]
+    grouped = df[columns].astype(np.float64).groupby(group_keys(df, freq))
+    rollup = grouped.agg(STATS)
+    rollup.columns = [col + '_' + stat for col, stat in rollup.columns]
+    return finish(rollup)
+
+
+def merge(rollup, freq, columns):
+    """
+    Merge the windows of a rollup into bigger windows (e.g. days into months) :
+    min of the min, max of the max, mean weighted by the count, sum of the count
+    :param rollup: pandas dataframe of the rollup, indexed by time
+    :param freq: string, the pandas frequency of the bigger windows
+    :param columns: list of the aggregated columns
+    :return: pandas dataframe of the merged rollup
+    """
+    columns = [col for col in columns if col + '_count' in rollup.columns]
+    parts = pd.DataFrame(index=rollup.index)
+    for col in columns:
+        count = rollup[col + '_count'].astype(np.float64).fillna(0)
+        # Float fields, even when the rollup read back only has whole values
+        parts[col + '_min'] = rollup[col + '_min'].astype(np.float64)
+        parts[col + '_max'] = rollup[col + '_max'].astype(np.float64)
+        parts[col + '_sum'] = (rollup[col + '_mean'] * count).fillna(0)
+        parts[col + '_count'] = count
+    if 'source' in rollup.columns:
+        parts['source'] = rollup['source']
+
+    grouped = parts.drop(columns='source', errors='ignore').groupby(group_keys(parts, freq))
+    merged = pd.DataFrame(index=grouped.size().index)
+    for col in columns:
+        merged[col + '_min'] = grouped[col + '_min'].min()
+        merged[col + '_max'] = grouped[col + '_max'].max()
+        count = grouped[col + '_count'].sum()
+        merged[col + '_mean'] = grouped[col + '_sum'].sum() / count.where(count > 0)
+        merged[col + '_count'] = count
+    return finish(merged)
+
+
+def finish(rollup):
+    """
+    Move the source from the index to a column, and drop the windows without
+    any value
+    :param rollup: pandas dataframe of the rollup, indexed by (time[, source])
+    :return: pandas dataframe indexed by time
+    """
+    if isinstance(rollup.index, pd.MultiIndex):
+        rollup = rollup.reset_index(level=1).rename(columns={'level_1': 'source'})
+    counts = rollup[[col for col in rollup.columns if col.endswith('_count')]]
+    rollup = rollup[(counts > 0).any(axis=1)].copy()
+    for col in counts.columns:
+        rollup[col] = rollup[col].astype(np.int64)
+    return rollup
+
+
+def write_rollup(rollup, measurement, df_client):
+    """
+    Write the rollup to the measurement, the source (if any) is a tag
+    :param rollup: pandas dataframe of the rollup, indexed by time
+    :param measurement: string, the name of the measurement
+    :param df_client: the influxdb client to write to
+    """
+    if len(rollup.index) == 0:
+        return
+    tags = ['source'] if 'source' in rollup.columns else None
+    line_protocol.write_frame(df_client, rollup, measurement, tag_columns=tags)
+
+
+def month_start(time):
+    """
+    Returns the start of the month of the given time(s)
+    :param time: pandas Timestamp or DatetimeIndex (UTC)
+    :return: pandas Timestamp or DatetimeIndex (UTC)
+    """
+    return time.tz_localize(None).to_period('M').to_timestamp().tz_localize('UTC')
+
+
+def update_rollups(client, df_client, start, end, columns):
+    """
+    Compute again and write the hours, days and months touched by the
+    cleaned data between start and end, month by month so that the memory
+    used does not depend on the length of the range (e.g. after a backfill)
+    :param client: the influxdb client to query to
+    :param df_client: the influxdb client for writing directly from pandas dataframe
+    :param start: the time of the first cleaned sample of the run
+    :param end: the time of the last cleaned sample of the run
+    :param columns: list of the columns to aggregate
+    """
+    start = pd.Timestamp(pd.to_datetime(start, utc=True))
+    end = pd.Timestamp(pd.to_datetime(end, utc=True))
+
+    # Hours and days, from the start of the first day touched
+    chunk_start = start.floor('D')
+    while chunk_start <= end:
+        month = month_start(chunk_start)
+        next_month = month_start(month + pd.Timedelta(days=31))
+        chunk_end = min(end, next_month - pd.Timedelta(microseconds=1))
+
+        df = query_frame(client, CLEAN_MEASUREMENT, chunk_start, chunk_end)
+        if len(df.index) > 0:
+            hourly = aggregate(df, 'h', columns)
+            write_rollup(hourly, HOURLY_MEASUREMENT, df_client)
+            write_rollup(merge(hourly, 'D', columns), DAILY_MEASUREMENT, df_client)
+            del df
+
+            # The month, from all its days (including the ones just written)
+            daily = query_frame(client, DAILY_MEASUREMENT, month, chunk_end)
+            write_rollup(merge(daily, 'MS', columns), MONTHLY_MEASUREMENT, df_client)
+        chunk_start = next_month
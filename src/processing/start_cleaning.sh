@@ -2,12 +2,13 @@
 
 # This script :
 #   1) Sets a cron job to execute the task clean.py everyday at 0030,
-#      which clean and adjust the raw data
+#      which clean and adjust the raw data, by windows of one day so that
+#      the memory used stays bounded after an outage
 
 # write out current crontab
 crontab -l > mycron
 # echo new cron into cron file
-echo "45 23 * * * cd /home/pi/RaspberryProjects/weather_monitoring/Weather_monitoring/src/processing && python3 clean.py" >> mycron
+echo "45 23 * * * cd /home/pi/RaspberryProjects/weather_monitoring/Weather_monitoring/src/processing && python3 clean.py --window 1d" >> mycron
 
 # install new cron file
 crontab mycron
@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# This script :
+#   1) Removes the daily cron job of clean.py, the stream cleaning replaces it
+#      (it starts where clean.py stopped)
+#   2) Starts stream_clean.py in the background, cleaning the new samples every
+#      5 minutes, and makes it start again at reboot
+
+DIR=/home/pi/RaspberryProjects/weather_monitoring/Weather_monitoring/src/processing
+
+# The data must not be cleaned twice
+crontab -l 2>/dev/null | grep -v 'python3 clean.py' | crontab -
+
+# Starts the stream cleaning, its pid is kept to stop it
+nohup python3 stream_clean.py --follow 300 >> stream_clean.log 2>&1 &
+echo $! > stream_clean.pid
+
+# write out current crontab
+crontab -l > mycron
+# echo new cron into cron file
+echo "@reboot cd $DIR && nohup python3 stream_clean.py --follow 300 >> stream_clean.log 2>&1 & echo \$! > $DIR/stream_clean.pid" >> mycron
+
+# install new cron file
+crontab mycron
+rm mycron
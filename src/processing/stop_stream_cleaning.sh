@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# This script :
+#   1) Stops the stream cleaning (the pending sample is kept in its state, it
+#      is emitted by the next run) and its cron job of start_stream_cleaning.sh
+
+# Stops the cron job
+crontab -l 2>/dev/null | grep -v 'python3 stream_clean.py' | crontab -
+
+# Stops the stream cleaning
+if [ -f stream_clean.pid ]; then
+    kill -TERM "$(cat stream_clean.pid)"
+    rm stream_clean.pid
+fi
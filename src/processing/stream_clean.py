@@ -0,0 +1,551 @@
+#!/bin/python3
+
+# This script :
+#   1) Cleans the raw sensehat data point by point as they arrive, instead of
+#      once a day by batches as clean.py, so clean_sh_data lags by a few
+#      minutes instead of up to a day
+#   2) The state of the cleaning is a small dict of bounded size, whatever
+#      the number of points cleaned : the last raw values (for the finite
+#      differences), the pending samples (at most MAX_PENDING) with their
+#      anormal columns, the last good value of each column with the number of
+#      samples since it, and the running calibration (see calibration.py). It
+#      is kept in a json file (stream_state.json) and started from the state
+#      of clean.py the first time
+#   3) A sample without anomaly is emitted as soon as it arrives. A sample with
+#      an anormal column is held until a later sample is good in that column,
+#      then it is interpolated between the last good value and that one, as
+#      clean.clean_data does over a whole run of anomalies (e.g. the jump up and
+#      the drop back of a spike, both anormal with the finite differences). The
+#      result is the same as cleaning all the samples in a single batch, unless
+#      a run lasts more than MAX_PENDING samples : the oldest pending sample is
+#      then emitted with the last good value, as clean.clean_data does at the
+#      end of a batch, and the rest of the run is interpolated from it
+#   4) The calibration is updated with each sample covered by the meteo suisse
+#      data already fetched, the other samples are adjusted without updating it
+#   5) The scores are written to convol_signals as each sample arrives, the
+#      cleaned and adjusted samples to clean_sh_data, then the rollups touched
+#      are computed again (see rollups.py)
+#   6) One process follows one device (tag source, sensehat by default), with
+#      its own state file, its points are tagged with it as those of clean.py
+#   Only the finite_difference detector is supported, the other detectors of
+#   detectors.py need the following values or a window of previous values
+#
+# e.g. python3 stream_clean.py --follow 300
+#      python3 stream_clean.py --follow 300 --source sensehat_2
+
+import os
+import sys
+import time
+import signal
+import argparse
+
+import numpy as np
+
+import clean
+import clean_state
+import calibration
+import rollups
+from clean import TMP, TMP_H, TMP_P, HUM, PRES
+
+# The modules shared by the scripts of all the folders
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+import influx_client
+import line_protocol
+
+# ------------------------------------------------------------------------------
+# Constants
+STATE_FILE = 'stream_state.json'
+
+SOURCE = clean.SOURCE
+
+# Columns interpolated between their good neighbors, in the order of
+# clean.clean_data, the temperature copies the temperature_humidity
+AVERAGE_COLS = [HUM, PRES, TMP_H, TMP_P]
+
+# Maximum number of samples held while waiting for the end of a run of
+# anomalies (a day of samples every 30 minutes)
+MAX_PENDING = 48
+
+# Maximum number of raw samples queried at once
+BATCH_ROWS = 10000
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def check_detectors():
+    """
+    Check that all the columns use the finite_difference detector (see
+    clean.DETECTORS), the only one that can score a value from the previous
+    one alone. Raises ValueError otherwise
+    """
+    for col in clean.CONVOL_COLS:
+        name, _ = clean.DETECTORS[col]
+        if name != 'finite_difference':
+            raise ValueError('The stream cleaning only supports the finite_difference '
+                             'detector, ' + col + ' uses ' + name)
+
+
+def to_values(values, columns=clean.CONVOL_COLS):
+    """
+    Take the float values of the columns, the missing ones are Nan
+    :param values: dict or pandas row {column: value}
+    :param columns: list of the columns
+    :return: dict {column: float}
+    """
+    return {col: np.nan if values.get(col) is None else float(values.get(col))
+            for col in columns}
+
+
+def new_stream(last_time='0', last_raw=None, last_clean=None, calibrator=None):
+    """
+    Make the state of a stream, starting after the given sample
+    :param last_time: string, the time of the last sample already cleaned, '0' if none
+    :param last_raw: dict {column: value} of the raw values of the last sample
+                     cleaned (see clean.convolve_dataframe), or None
+    :param last_clean: dict {column: value} of its cleaned values (see
+                       clean.clean_data), or None to use the raw ones
+    :param calibrator: dict of the running calibration, or None for a new one
+    :return: dict of the stream
+    """
+    if last_clean is None:
+        last_clean = last_raw
+    if calibrator is None:
+        calibrator = calibration.new_calibration(clean.FORMATED_COLS)
+    return {'last_time': str(last_time),
+            'last_raw': None if last_raw is None else to_values(last_raw),
+            'pending': [],
+            # Last good value of each column, and the number of anormal
+            # samples since it
+            'good': {col: None if last_clean is None else to_values(last_clean)[col]
+                     for col in AVERAGE_COLS},
+            'gap': {col: 0 for col in AVERAGE_COLS},
+            'calibration': calibrator}
+
+
+def score(stream, raw):
+    """
+    Compute the finite differences of a new sample with the previous one,
+    0 for the first sample of the stream (as detectors.finite_difference)
+    :param stream: dict of the stream
+    :param raw: dict {column: float} of the raw values of the new sample
+    :return: dict {column: score}
+    """
+    if stream['last_raw'] is None:
+        return {col: 0.0 for col in clean.CONVOL_COLS}
+    return {col: raw[col] - stream['last_raw'][col] for col in clean.CONVOL_COLS}
+
+
+def next_good(samples, col):
+    """
+    Find the first sample whose value of the column is good
+    :param samples: list of the samples ('raw', 'anormal')
+    :param col: string, the column
+    :return: (int, its position from 1, float, its value), or None if there is none
+    """
+    for position in range(len(samples)):
+        if not samples[position]['anormal'][col]:
+            return position + 1, samples[position]['raw'][col]
+    return None
+
+
+def resolvable(stream):
+    """
+    Check whether the first pending sample can be cleaned : each of its
+    anormal columns has a later pending sample that is good
+    :param stream: dict of the stream, with pending samples
+    :return: boolean
+    """
+    first = stream['pending'][0]
+    later = stream['pending'][1:]
+    return all(not first['anormal'][col] or next_good(later, col) is not None
+               for col in AVERAGE_COLS)
+
+
+def resolve(stream):
+    """
+    Clean the first pending sample and update the last good values. An anormal
+    value is interpolated between the last good value and the next good value
+    of the pending samples (as np.interp in clean.interpolate_anomalies), it
+    copies the last good value if there is no next one (or the next one if
+    there is no last one, or keeps its own value if there is none)
+    :param stream: dict of the stream, with pending samples
+    :return: dict {column: cleaned value} of the first pending sample
+    """
+    first = stream['pending'][0]
+    later = stream['pending'][1:]
+    cleaned = {}
+    for col in AVERAGE_COLS:
+        value = first['raw'][col]
+        good = stream['good'][col]
+        if not first['anormal'][col]:
+            stream['good'][col] = value
+            stream['gap'][col] = 0
+        else:
+            stream['gap'][col] += 1
+            right = next_good(later, col)
+            if right is not None:
+                position, right_value = right
+                if good is None:
+                    value = right_value
+                else:
+                    # The last good value is gap samples before, the next one
+                    # position samples after
+                    gap = stream['gap'][col]
+                    value = good + (right_value - good) * gap / (gap + position)
+            elif good is not None:
+                value = good
+        cleaned[col] = value
+
+    # The temperature takes the cleaned temperature_humidity when anormal
+    cleaned[TMP] = cleaned[TMP_H] if first['anormal'][TMP] else first['raw'][TMP]
+    return cleaned
+
+
+def adjust(stream, sample_time, cleaned, reference):
+    """
+    Update the running calibration with the differences between the cleaned
+    sample and the meteo suisse data (if any), and adjust the sample with it
+    (see clean.running_adjustements)
+    :param stream: dict of the stream
+    :param sample_time: string, the time of the sample
+    :param cleaned: dict {column: cleaned value}
+    :param reference: dict {column: meteo suisse value} at the time of the
+                      sample (Nan if unknown), or None
+    :return: dict {column: cleaned and adjusted value}
+    """
+    calibrator = stream['calibration']
+    if reference is not None and not all(np.isnan(reference[col])
+                                         for col in clean.FORMATED_COLS):
+        calibration.update(calibrator, [sample_time],
+                           {col: [cleaned[col] - reference[col]]
+                            for col in clean.FORMATED_COLS})
+
+    offsets = calibration.offsets(calibrator, [sample_time])
+    adjusted = dict(cleaned)
+    if offsets is not None:
+        # Same adjustements for the temperatures as in clean.running_adjustements
+        for col in clean.ADJUSTED_COLS:
+            adjusted[col] = cleaned[col] - offsets[HUM if col == HUM else TMP][0]
+    return adjusted
+
+
+def push(stream, sample_time, raw, reference=None, other=None, max_pending=MAX_PENDING):
+    """
+    Add a new sample to the stream : it is added to the pending samples, and
+    the pending samples that can be cleaned (see resolvable), or that are
+    held for too long, are cleaned, adjusted and emitted, in order
+    :param stream: dict of the stream
+    :param sample_time: string, the time of the sample (after the previous one)
+    :param raw: dict {column: value} of the raw values of the sample
+    :param reference: dict {column: value} of the meteo suisse data at the time
+                      of the sample (see clean.prepare_ms_df), or None
+    :param other: dict of the other fields of the sample, written with it,
+                  or None
+    :param max_pending: int, the maximum number of pending samples
+    :return: (dict {column: score} of the new sample, list of the emitted
+             samples (time, dict {field: value}), possibly empty)
+    """
+    raw = to_values(raw)
+    scores = score(stream, raw)
+    # Nan scores (missing values) are never anormal, as in clean.clean_column
+    following = {'time': str(sample_time), 'raw': raw,
+                 'anormal': {col: bool(abs(scores[col]) > clean.THRESHOLDS[col])
+                             for col in clean.CONVOL_COLS},
+                 'reference': None if reference is None
+                 else to_values(reference, clean.FORMATED_COLS),
+                 'other': {key: clean_state.to_json_value(value)
+                           for key, value in (other or {}).items()}}
+
+    stream['pending'].append(following)
+    emitted = []
+    while len(stream['pending']) > 0 and (resolvable(stream)
+                                          or len(stream['pending']) > max_pending):
+        first = stream['pending'][0]
+        adjusted = adjust(stream, first['time'], resolve(stream), first['reference'])
+        adjusted.update(first['other'])
+        emitted.append((first['time'], adjusted))
+        stream['pending'].pop(0)
+
+    stream['last_raw'] = raw
+    stream['last_time'] = str(sample_time)
+    return scores, emitted
+
+
+def json_values(values):
+    """
+    Convert the Nan values of a dict to None, so it can be written in json
+    :param values: dict {column: value}, or None
+    :return: the converted dict, or None
+    """
+    if values is None:
+        return None
+    return {col: clean_state.to_json_value(value) for col, value in values.items()}
+
+
+def float_values(values):
+    """
+    Convert back the None values of a dict written by json_values to Nan
+    :param values: dict {column: value}, or None
+    :return: the converted dict, or None
+    """
+    if values is None:
+        return None
+    return {col: np.nan if value is None else value for col, value in values.items()}
+
+
+def convert_stream(stream, convert):
+    """
+    Returns a copy of the stream with the values of the samples converted
+    :param stream: dict of the stream
+    :param convert: function converting a dict of values (json_values or
+                    float_values)
+    :return: dict of the converted stream
+    """
+    converted = dict(stream)
+    converted['last_raw'] = convert(stream['last_raw'])
+    converted['good'] = convert(stream['good'])
+    converted['pending'] = []
+    for sample in stream['pending']:
+        sample = dict(sample)
+        sample['raw'] = convert(sample['raw'])
+        sample['reference'] = convert(sample['reference'])
+        converted['pending'].append(sample)
+    return converted
+
+
+def load_stream(path=STATE_FILE, source=SOURCE):
+    """
+    Read the stream of the source from the state file
+    :param path: string, the path of the state file
+    :param source: string, the tag source in the influxdb
+    :return: (dict of the whole state, dict of the stream or None)
+    """
+    state = clean_state.load_state(path)
+    entry = state['sources'].get(source)
+    if entry is None:
+        return state, None
+
+    stream = entry['stream']
+    if not isinstance(stream['pending'], list):
+        # State written when a single sample was pending
+        stream['pending'] = [] if stream['pending'] is None else [stream['pending']]
+    return state, convert_stream(stream, float_values)
+
+
+def save_stream(state, stream, path=STATE_FILE, source=SOURCE):
+    """
+    Write atomically the stream of the source to the state file
+    :param state: dict of the whole state (see load_stream)
+    :param stream: dict of the stream
+    :param path: string, the path of the state file
+    :param source: string, the tag source in the influxdb
+    """
+    state['sources'][source] = {'stream': convert_stream(stream, json_values)}
+    clean_state.save_state(state, path)
+
+
+def state_path(source):
+    """
+    Path of the state file of the stream of the source, the default source
+    keeps the original file
+    :param source: string, the tag source in the influxdb
+    :return: string of the path
+    """
+    if source == SOURCE:
+        return STATE_FILE
+    root, extension = os.path.splitext(STATE_FILE)
+    return root + '_' + source + extension
+
+
+def start_stream(client, source=SOURCE):
+    """
+    Make the stream starting where clean.py stopped : from its local state
+    if it can be trusted, otherwise from the influxdb server. The running
+    calibration of clean.py is taken if there is one
+    :param client: the influxdb client to query to
+    :param source: string, the tag source in the influxdb
+    :return: dict of the stream
+    """
+    state = clean_state.load_state(clean.state_path(source))
+    calibrator = clean_state.get_calibration(state, source)
+    source_state = clean_state.get_source_state(state, source, clean.CONVOL_MEASUREMENT)
+    if source_state is not None:
+        last_time = source_state['last_cleaned']
+        previous_row = source_state['previous_row']
+        previous_clean_row = source_state['previous_clean_row']
+    else:
+        last_time, _ = clean.query_data_to_clean(client, source)
+        previous_row = clean.query_last_raw_values(last_time, client, source)
+        previous_clean_row = None
+
+    last_raw = None
+    if previous_row is not None and len(previous_row.index) > 0:
+        last_raw = previous_row.iloc[-1]
+    last_clean = None
+    if previous_clean_row is not None and len(previous_clean_row.index) > 0:
+        last_clean = previous_clean_row.iloc[0]
+    return new_stream(last_time, last_raw, last_clean, calibrator)
+
+
+def clean_rows(stream, df, df_ms, df_client, persist_convol=True, source=SOURCE):
+    """
+    Push the raw samples one by one and write the scores and the emitted
+    samples, tagged with the source
+    :param stream: dict of the stream, updated in place
+    :param df: pandas dataframe of the raw samples, sorted by time
+    :param df_ms: pandas dataframe of the meteo suisse data around them
+    :param df_client: the influxdb client to write to
+    :param persist_convol: boolean, False to not write the scores to convol_signals
+    :param source: string, the tag source in the influxdb
+    :return: list of the times of the emitted samples
+    """
+    with metrics.stage('clean'):
+        form_df = clean.prepare_ms_df(df_ms, df['time'])
+        references = [None] * len(df.index)
+        if form_df is not None:
+            references = form_df[clean.FORMATED_COLS].to_dict('records')
+
+        others = [col for col in df.columns
+                  if col not in ('time', 'source') and col not in clean.CONVOL_COLS]
+        tags = {'source': source}
+        convol_points = []
+        clean_points = []
+        for row, reference in zip(df.to_dict('records'), references):
+            sample_time = clean.to_rfc3339(row['time'])
+            scores, emitted = push(stream, sample_time, row, reference,
+                                   {col: row[col] for col in others})
+            convol_points.append(line_protocol.Point(clean.CONVOL_MEASUREMENT,
+                                                     scores, tags, sample_time))
+            clean_points.extend(line_protocol.Point(clean.CLEAN_MEASUREMENT,
+                                                    fields, tags, emitted_time)
+                                for emitted_time, fields in emitted)
+
+    if persist_convol:
+        with metrics.stage('write_convol'):
+            line_protocol.write_points(df_client, convol_points)
+    with metrics.stage('write_clean'):
+        line_protocol.write_points(df_client, clean_points)
+        metrics.count('points', len(clean_points))
+    return [point.time for point in clean_points]
+
+
+def clean_new_samples(stream, client, df_client, persist_convol=True, update_rollups=True,
+                      source=SOURCE, batch_rows=BATCH_ROWS):
+    """
+    Query the raw samples arrived since the last one of the stream, by batches
+    of batch_rows (e.g. after a long stop), and clean them (see clean_rows)
+    :param stream: dict of the stream, updated in place
+    :param client: the influxdb client to query to
+    :param df_client: the influxdb client to write to
+    :param persist_convol: boolean, False to not write the scores to convol_signals
+    :param update_rollups: boolean, True to compute again the rollups touched
+    :param source: string, the tag source in the influxdb
+    :param batch_rows: int, the maximum number of raw samples queried at once
+    :return: int, the number of samples emitted
+    """
+    times = []
+    while True:
+        with metrics.stage('query'):
+            df, df_ms = clean.query_batch(client, stream['last_time'],
+                                          limit=batch_rows, source=source)
+            metrics.count('rows', len(df.index))
+            metrics.count('ms_rows', len(df_ms.index))
+        if len(df.index) == 0:
+            break
+
+        times.extend(clean_rows(stream, df, df_ms, df_client, persist_convol, source))
+        if len(df.index) < batch_rows:
+            break
+
+    if update_rollups and len(times) > 0:
+        with metrics.stage('rollups'):
+            rollups.update_rollups(client, df_client, times[0], times[-1],
+                                   clean.CONVOL_COLS)
+    return len(times)
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def main(follow=None, persist_convol=True, update_rollups=True, reset=False,
+         path=None, source=SOURCE):
+    """
+    Clean the samples arrived since the last run, and with follow, keep
+    cleaning the new ones every follow seconds until SIGTERM / SIGINT
+    :param follow: float, the period between 2 queries of the new samples
+                   in seconds, or None to stop once they are cleaned
+    :param persist_convol: boolean, False to not write the convolution signals
+    :param update_rollups: boolean, True to update the rollups touched
+    :param reset: boolean, True to ignore the state of the stream and
+                  start again from the state of clean.py
+    :param path: string, the path of the state file of the stream, or None
+                 for the one of the source (see state_path)
+    :param source: string, the tag source in the influxdb
+    """
+    check_detectors()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    path = path or state_path(source)
+    client, df_client = influx_client.connect_pair()
+    try:
+        state, stream = load_stream(path, source)
+        if stream is None or reset:
+            stream = start_stream(client, source)
+
+        while not stopping:
+            metrics.start_run('stream_clean', {'source': source})
+            success = False
+            try:
+                clean_new_samples(stream, client, df_client, persist_convol,
+                                  update_rollups, source)
+                # The points are written, the next run starts from here
+                with metrics.stage('save_state'):
+                    save_stream(state, stream, path, source)
+                success = True
+            finally:
+                metrics.finish_run(client, success)
+
+            if follow is None:
+                break
+            # Sleep by steps, so a signal stops it without waiting
+            wake_up = time.monotonic() + follow
+            while not stopping and time.monotonic() < wake_up:
+                time.sleep(min(1.0, wake_up - time.monotonic()))
+    finally:
+        df_client.close()
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clean the raw sensehat data '
+                                     'point by point, as they arrive')
+    parser.add_argument('--follow', type=float, default=None,
+                        help='keep cleaning the new samples, querying them '
+                             'every that many seconds')
+    parser.add_argument('--no-convol', action='store_true',
+                        help='do not write the convolution signals to the db')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help='do not update the hourly, daily and monthly rollups')
+    parser.add_argument('--reset-state', action='store_true',
+                        help='start again from the state of clean.py')
+    parser.add_argument('--source', default=SOURCE,
+                        help='source (device) of the raw data to clean')
+    parser.add_argument('--state-file', default=None,
+                        help='json file of the state of the stream '
+                             '(default: ' + STATE_FILE + ' for ' + SOURCE + ')')
+    args = parser.parse_args()
+    main(follow=args.follow, persist_convol=not args.no_convol,
+         update_rollups=not args.no_rollups, reset=args.reset_state,
+         path=args.state_file, source=args.source)
@@ -0,0 +1,159 @@
+#!/bin/python3
+
+# This module :
+#   1) Generates synthetic weather series that look like the data queried from
+#      the influxdb server : SenseHat data every 30 min and MeteoSuisse data
+#      every 10 min, with daily and yearly temperature cycles, humidity
+#      following the temperature and pressure as a random walk
+#   2) Injects spikes (values the cleaning has to correct) and gaps (missing
+#      samples, e.g. during an outage) in them
+#   It is used by benchmark.py, so the benchmarks run without the db
+
+import json
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------------------------------------------------------
+# Constants
+TMP = 'temperature'
+TMP_H = 'temperature_humidity'
+TMP_P = 'temperature_pressure'
+HUM = 'humidity'
+PRES = 'pressure'
+
+# Amplitude of the injected spikes for each column, well above the
+# thresholds of clean.py
+SPIKES = {TMP: 20, HUM: 30, PRES: 10,
+          TMP_H: 20, TMP_P: 20}
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def make_times(n, freq, start='2020-01-01', gap_rate=0.0, rng=None):
+    """
+    Make n regular times (UTC) from start, with gaps : each sample starts a
+    gap of a few hours with probability gap_rate
+    :param n: int, the number of times
+    :param freq: string, the period between 2 times (e.g. '30min')
+    :param start: string, the first time
+    :param gap_rate: float, probability of a gap after each sample
+    :param rng: numpy random generator
+    :return: pandas DatetimeIndex of the n times
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    step = pd.Timedelta(freq).value
+    steps = np.ones(n, dtype=np.int64)
+    gaps = rng.random(n) < gap_rate
+    steps[gaps] += rng.integers(2, 24, gaps.sum())
+    steps[0] = 0
+    start = pd.Timestamp(start)
+    start = start.tz_localize('UTC') if start.tzinfo is None else start.tz_convert('UTC')
+    times = start.value + np.cumsum(steps) * step
+    return pd.DatetimeIndex(pd.to_datetime(times, utc=True))
+
+
+def true_temperature(times):
+    """
+    The "real" outside temperature at the given times : yearly and daily cycles
+    :param times: pandas DatetimeIndex
+    :return: numpy array of the temperatures
+    """
+    days = np.asarray((times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(days=1))
+    return (10 - 8 * np.cos(2 * np.pi * days / 365.25)
+            - 5 * np.cos(2 * np.pi * (days % 1)))
+
+
+def make_sensehat_frame(n, freq='30min', start='2020-01-01', spike_rate=0.01,
+                        gap_rate=0.001, seed=0):
+    """
+    Make a dataframe like the raw sensehat data queried by clean.py :
+    a 'time' column, a 'source' column and the 5 measured fields, which are
+    biased and noisy, with spikes and gaps
+    :param n: int, the number of rows
+    :param freq: string, the period between 2 samples
+    :param start: string, the first time
+    :param spike_rate: float, probability of a spike for each value
+    :param gap_rate: float, probability of a gap after each sample
+    :param seed: int, the seed of the random generator
+    :return: the pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    times = make_times(n, freq, start, gap_rate, rng)
+    temp = true_temperature(times)
+
+    df = pd.DataFrame({'time': times})
+    # The sensehat is heated by the raspberry, so it is biased
+    df[TMP] = temp + 8 + rng.normal(0, 0.3, n)
+    df[TMP_H] = temp + 8 + rng.normal(0, 0.3, n)
+    df[TMP_P] = temp + 7 + rng.normal(0, 0.3, n)
+    df[HUM] = np.clip(70 - 1.5 * temp + rng.normal(0, 2, n), 0, 100)
+    df[PRES] = 950 + np.cumsum(rng.normal(0, 0.05, n)).clip(-30, 30)
+    df['source'] = 'sensehat'
+
+    for col, amplitude in SPIKES.items():
+        spikes = rng.random(n) < spike_rate
+        df.loc[spikes, col] += amplitude * rng.choice([-1, 1], spikes.sum())
+    return df
+
+
+def make_meteosuisse_frame(start, end, freq='10min', gap_rate=0.001, seed=1):
+    """
+    Make a dataframe like the meteo suisse data queried by clean.py, covering
+    the time range from start to end : a 'time' column, the temperature
+    and the humidity
+    :param start: the first time
+    :param end: the last time
+    :param freq: string, the period between 2 samples
+    :param gap_rate: float, probability of a gap after each sample
+    :param seed: int, the seed of the random generator
+    :return: the pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    n = int((pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(freq)) + 1
+    times = make_times(n, freq, start, gap_rate, rng)
+    temp = true_temperature(times)
+
+    df = pd.DataFrame({'time': times})
+    df[TMP] = temp + rng.normal(0, 0.1, n)
+    df[HUM] = np.clip(75 - 1.5 * temp + rng.normal(0, 1, n), 0, 100)
+    return df
+
+
+def to_influx_times(df):
+    """
+    Returns a copy of the dataframe with the 'time' column as RFC3339 strings,
+    as returned by the influxdb client
+    :param df: the pandas dataframe with a datetime 'time' column
+    :return: the pandas dataframe with a string 'time' column
+    """
+    df = df.copy()
+    df['time'] = df['time'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return df
+
+
+def to_influx_answer(df, measurement='data', chunk_size=None):
+    """
+    Returns the json body of the answer of the influxdb server to a query of
+    the points of the dataframe. Without chunk_size, it is the whole answer
+    with RFC3339 times (as a default query), otherwise the lines of a chunked
+    answer with epoch nanosecond times (as influx_client.iter_columns)
+    :param df: the pandas dataframe with a datetime 'time' column
+    :param measurement: string, the name of the measurement
+    :param chunk_size: int, the number of points of each chunk, or None
+    :return: list of the bytes of the json lines
+    """
+    if chunk_size is None:
+        df = to_influx_times(df)
+        chunk_size = max(len(df.index), 1)
+    else:
+        df = df.copy()
+        df['time'] = df['time'].astype('datetime64[ns, UTC]').astype(np.int64)
+    columns = list(df.columns)
+    values = df.astype(object).where(df.notna(), None).values.tolist()
+    return [json.dumps({'results': [{'statement_id': 0, 'series': [
+        {'name': measurement, 'columns': columns,
+         'values': values[start:start + chunk_size]}]}]}).encode()
+            for start in range(0, max(len(values), 1), chunk_size)]
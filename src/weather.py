@@ -0,0 +1,261 @@
+#!/bin/python3
+
+# This script :
+#   1) Is the single entry point of the jobs of the project, one subcommand
+#      per job : python3 weather.py <command> [options of the command]
+#   2) Only the script of the command is imported, and only when the command
+#      runs, so pandas, numpy, influxdb and the SenseHat are loaded only by the
+#      commands that need them (e.g. upload loads none of them), and
+#      `python3 weather.py --help` starts at once. The command runs exactly as
+#      its script (same options, see python3 weather.py <command> --help),
+#      from the folder of the script, as the cron jobs
+#   3) `python3 weather.py import-times` measures the start of each command :
+#      the time to import its script in a new interpreter (best of the
+#      repeats) and the heavy libraries it loads. The results are appended to
+#      import_times.jsonl, tagged with the git revision, and compared with the
+#      previous revision measured : it exits with an error if a command starts
+#      slower by more than --max-regression, or loads a heavy library it did
+#      not load before, so the regressions of the startup are caught
+#
+# e.g. python3 weather.py clean --window 1d
+#      python3 weather.py import-times --repeat 5
+
+import os
+import sys
+import json
+import runpy
+import argparse
+import subprocess
+from datetime import datetime, timezone
+
+# ------------------------------------------------------------------------------
+# Constants
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Command -> (folder of the script, name of the script, help)
+COMMANDS = {
+    'collect': ('data_collection', 'collect',
+                'sample the SenseHat once and append it to the spool'),
+    'collect-daemon': ('data_collection', 'collect_daemon',
+                       'resident collector of the SenseHat'),
+    'serve': ('data_collection', 'ingest_service',
+              'resident service : collection, upload and open data'),
+    'upload': ('data_collection', 'transfer_db',
+               'send the spool to the influxdb server'),
+    'fetch': ('processing', 'fetch_open_data', 'fetch the MeteoSuisse open data'),
+    'clean': ('processing', 'clean', 'clean and adjust the new raw data'),
+    'stream-clean': ('processing', 'stream_clean',
+                     'clean the new raw data point by point'),
+    'backfill': ('processing', 'backfill',
+                 'clean a range of the history, in parallel'),
+    'export': ('database', 'export_parquet',
+               'export measurements to Parquet files'),
+}
+
+# The libraries that are slow to import on the Raspberry
+HEAVY_MODULES = ['pandas', 'numpy', 'influxdb', 'sense_hat', 'pyarrow']
+
+RESULTS_FILE = os.path.join(SRC_DIR, 'import_times.jsonl')
+
+REPEAT = 5
+
+# Relative slow down of the import of a script considered a regression, the
+# smaller differences (in seconds) are noise
+MAX_REGRESSION = 0.2
+MIN_REGRESSION_SECONDS = 0.05
+
+
+# ------------------------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------------------------
+
+def run_command(command, argv):
+    """
+    Run the script of the command as if it was run directly, from its folder
+    :param command: string, the name of the command (see COMMANDS)
+    :param argv: list of the arguments given to the script
+    """
+    folder, script, _ = COMMANDS[command]
+    directory = os.path.join(SRC_DIR, folder)
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    sys.argv = [os.path.join(directory, script + '.py')] + argv
+    # alter_sys : the script is the __main__ module while it runs, so the
+    # worker processes of backfill.py find its functions
+    runpy.run_module(script, run_name='__main__', alter_sys=True)
+
+
+def git_revision():
+    """
+    Returns the short hash of the current git revision, or 'unknown'
+    :return: string of the revision
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure_import(command):
+    """
+    Import the script of the command in a new interpreter
+    :param command: string, the name of the command (see COMMANDS)
+    :return: (float, the time of the import in seconds, list of the heavy
+             modules loaded), raises RuntimeError if the import failed
+    """
+    folder, script, _ = COMMANDS[command]
+    directory = os.path.join(SRC_DIR, folder)
+    code = ('import sys, time\n'
+            'sys.path.insert(0, {directory!r})\n'
+            'start = time.perf_counter()\n'
+            'import {script}\n'
+            'print(time.perf_counter() - start)\n'
+            'print(",".join(m for m in {modules!r} if m in sys.modules))\n'
+            ).format(directory=directory, script=script, modules=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=directory,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode().strip().splitlines()
+        raise RuntimeError(error[-1] if error else 'exit code ' + str(result.returncode))
+    seconds, modules = result.stdout.decode().splitlines()[-2:]
+    return float(seconds), [m for m in modules.split(',') if m]
+
+
+def load_results(path=RESULTS_FILE):
+    """
+    Load the results of the previous measures
+    :param path: string, the path of the results file
+    :return: list of the results (dict)
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_results(results, revision):
+    """
+    Returns the results of the last revision measured before the given one
+    :param results: list of the results of the previous measures
+    :param revision: string, the current revision
+    :return: dict {command: result}
+    """
+    previous = [r for r in results if r['revision'] != revision]
+    if len(previous) == 0:
+        return {}
+    last = previous[-1]['revision']
+    return {r['command']: r for r in previous if r['revision'] == last}
+
+
+def regressions(result, previous, max_regression=MAX_REGRESSION):
+    """
+    Compare the start of a command with the previous revision
+    :param result: dict, the result of the command
+    :param previous: dict, the result of the previous revision, or None
+    :param max_regression: float, the relative slow down allowed
+    :return: list of the descriptions of the regressions, empty if none
+    """
+    if previous is None:
+        return []
+    found = []
+    slower = result['seconds'] - previous['seconds']
+    if (slower > previous['seconds'] * max_regression
+            and slower > MIN_REGRESSION_SECONDS):
+        found.append('{:.3f} s instead of {:.3f} s'.format(result['seconds'],
+                                                           previous['seconds']))
+    loaded = [m for m in result['modules'] if m not in previous['modules']]
+    if len(loaded) > 0:
+        found.append('now loads ' + ', '.join(loaded))
+    return found
+
+
+def import_times(commands, repeat=REPEAT, max_regression=MAX_REGRESSION,
+                 path=RESULTS_FILE):
+    """
+    Measure the import of the scripts of the commands, save the results and
+    compare them with the previous revision
+    :param commands: list of the names of the commands
+    :param repeat: int, the number of imports of each script
+    :param max_regression: float, the relative slow down allowed
+    :param path: string, the path of the results file
+    :return: True if there is no regression
+    """
+    revision = git_revision()
+    date = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    previous = previous_results(load_results(path), revision)
+
+    results = []
+    success = True
+    for command in commands:
+        try:
+            measures = [measure_import(command) for _ in range(repeat)]
+        except RuntimeError as e:
+            print('{:<16} not importable here : {}'.format(command, e))
+            continue
+        result = {'revision': revision, 'date': date, 'command': command,
+                  'seconds': min(seconds for seconds, _ in measures),
+                  'modules': measures[0][1]}
+        results.append(result)
+
+        found = regressions(result, previous.get(command), max_regression)
+        success = success and len(found) == 0
+        print('{:<16} {:8.3f} s   {:<40} {}'.format(
+            command, result['seconds'], ', '.join(result['modules']) or '-',
+            'REGRESSION : ' + ', '.join(found) if found else ''))
+
+    with open(path, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    return success
+
+
+def make_parser():
+    """
+    Make the parser of the arguments, the arguments of the commands are
+    parsed by their scripts
+    :return: the ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='Jobs of the weather monitoring')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    for command, (_, script, text) in COMMANDS.items():
+        subparsers.add_parser(command, add_help=False, help=text + ' (' + script + '.py)')
+
+    times = subparsers.add_parser('import-times',
+                                  help='measure the start of the commands')
+    times.add_argument('--commands', default=','.join(COMMANDS),
+                       help='commands to measure, among ' + ', '.join(COMMANDS))
+    times.add_argument('--repeat', type=int, default=REPEAT,
+                       help='number of imports of each script')
+    times.add_argument('--max-regression', type=float, default=MAX_REGRESSION,
+                       help='relative slow down failing the measure')
+    times.add_argument('--results', default=RESULTS_FILE,
+                       help='json lines file of the results')
+    return parser
+
+
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+# Script
+# ------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        # Everything after the command is for its script, --help included
+        run_command(argv[0], argv[1:])
+        return
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'import-times':
+        success = import_times(args.commands.split(','), args.repeat,
+                               args.max_regression, args.results)
+        sys.exit(0 if success else 1)
+    parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# The scripts import their siblings and the shared modules by name, as when
+# they are run from their folder
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+for folder in ['common', 'processing', 'data_collection']:
+    sys.path.insert(0, os.path.join(SRC_DIR, folder))
+
+
+class RecordingClient:
+    """
+    Stands for the influxdb client of the writes, keeps the lines written
+    """
+    _database = 'db'
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data, params=None, protocol='line'):
+        self.lines.extend(data if isinstance(data, list) else [data])
+        return True
+
+    def measurements(self):
+        return [line.split(',')[0].split(' ')[0] for line in self.lines]
+
+
+@pytest.fixture
+def writer():
+    return RecordingClient()
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture
+def sample_csv():
+    with open(os.path.join(DATA_DIR, 'VQHA80.csv'), 'rb') as f:
+        return f.read()
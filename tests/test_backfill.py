@@ -0,0 +1,114 @@
+import pandas as pd
+
+import backfill
+import calibration
+import clean
+
+
+def day_statistics(day, diff):
+    times = pd.date_range(day, periods=24, freq='h', tz='UTC')
+    return calibration.statistics(times, {col: [diff] * 24 for col in clean.FORMATED_COLS})
+
+
+def test_serial_failure_does_not_stop_the_other_partitions(monkeypatch, tmp_path,
+                                                           capsys):
+    start = pd.Timestamp('2020-03-18', tz='UTC')
+    failing = start + pd.Timedelta(days=1)
+
+    def clean_partition(begin, end, **options):
+        if begin == failing:
+            raise RuntimeError('query timed out')
+        return {'rows': 10, 'avg_diffs': {'temperature': 0.5}, 'done': True}
+
+    monkeypatch.setattr(backfill, 'clean_partition', clean_partition)
+    progress_file = str(tmp_path / 'progress.json')
+    done = backfill.backfill(start, start + pd.Timedelta(days=3), workers=1,
+                             progress_file=progress_file, update_rollups=False,
+                             running_calibration=False)
+
+    assert not done
+    assert 'Partition 2020-03-19T00:00:00.000000Z failed : query timed out' \
+        in capsys.readouterr().out
+    progress = backfill.load_progress(progress_file, 'day', 'batch')
+    assert sorted(progress['partitions']) == ['2020-03-18T00:00:00.000000Z',
+                                              '2020-03-20T00:00:00.000000Z']
+
+
+def test_running_calibrations_are_built_in_time_order():
+    partitions = backfill.make_partitions(pd.Timestamp('2020-03-18', tz='UTC'),
+                                          pd.Timestamp('2020-03-22', tz='UTC'),
+                                          backfill.PARTITIONS['day'])
+    stats = [None, day_statistics('2020-03-19', 1.0), None, day_statistics('2020-03-21', 3.0)]
+    progress = {'partitions': {clean.to_rfc3339(start): {'stats': batch}
+                               for (start, _), batch in zip(partitions, stats)}}
+    calibrations = backfill.running_calibrations(progress, partitions)
+
+    # Each partition starts from the calibration of the end of the previous
+    # one, the ones before the first meteo suisse data from the first one
+    expected = calibration.new_calibration(clean.FORMATED_COLS)
+    calibration.add(expected, stats[1])
+    for i in [0, 1, 2, 3]:
+        assert calibrations[i] == expected
+    calibration.add(expected, stats[3])
+    assert calibrations[3] != expected
+    assert calibrations[0] is not calibrations[1]
+
+
+def test_partitions_get_the_running_calibration(monkeypatch, tmp_path):
+    start = pd.Timestamp('2020-03-18', tz='UTC')
+    received = {}
+
+    def partition_statistics(begin, end, **options):
+        return {'rows': 24, 'stats': day_statistics(begin, 2.0)}
+
+    def clean_partition(begin, end, calibrator=None, **options):
+        received[begin] = calibrator
+        return {'rows': 24, 'avg_diffs': None, 'done': True}
+
+    monkeypatch.setattr(backfill, 'partition_statistics', partition_statistics)
+    monkeypatch.setattr(backfill, 'clean_partition', clean_partition)
+    progress_file = str(tmp_path / 'progress.json')
+    assert backfill.backfill(start, start + pd.Timedelta(days=2), workers=1,
+                             progress_file=progress_file, update_rollups=False)
+
+    first = calibration.new_calibration(clean.FORMATED_COLS)
+    calibration.add(first, day_statistics(start, 2.0))
+    assert received[start] == first
+    assert received[start + pd.Timedelta(days=1)] == first
+
+    # The statistics are kept, a backfill with the other scheme starts over
+    progress = backfill.load_progress(progress_file, 'day')
+    assert all(entry['done'] and entry['stats'] is not None
+               for entry in progress['partitions'].values())
+    assert backfill.load_progress(progress_file, 'day', 'batch')['partitions'] == {}
+
+
+def test_anomalies_at_the_end_of_a_partition_go_to_the_next(monkeypatch):
+    times = pd.date_range('2020-03-18 20:00', periods=12, freq='h', tz='UTC')
+    values = [10.0] * 12
+    values[3] = values[10] = 30.0
+    raw = pd.DataFrame({'time': times, 'source': clean.SOURCE,
+                        **{col: values for col in clean.CONVOL_COLS}})
+    start = pd.Timestamp('2020-03-19', tz='UTC')
+    end = start + pd.Timedelta(hours=7)
+
+    def query_batch(client, begin, end=None, **options):
+        df = raw[(raw['time'] > pd.Timestamp(begin)) & (raw['time'] < pd.Timestamp(end))]
+        return df.reset_index(drop=True), pd.DataFrame()
+
+    def query_previous_rows(client, before, n=1, source=clean.SOURCE):
+        df = raw[raw['time'] < pd.Timestamp(before)].iloc[-n:].reset_index(drop=True)
+        # As query_to_points, the times are strings
+        df['time'] = df['time'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return df
+
+    monkeypatch.setattr(clean, 'query_batch', query_batch)
+    monkeypatch.setattr(clean, 'query_previous_rows', query_previous_rows)
+    monkeypatch.setattr(clean, 'query_next_time', lambda client, source, after: after)
+    df, _, previous_row, previous_clean_row = backfill.query_partition(None, start, end)
+
+    # The spike of 23:00 is cleaned with this partition, the one of 06:00
+    # (and the drop after it) with the next one
+    assert list(df['time']) == list(times[3:10])
+    assert previous_row['time'].iloc[-1] == '2020-03-18T22:00:00Z'
+    assert previous_clean_row['temperature'].iloc[0] == 10.0
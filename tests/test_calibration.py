@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+import calibration
+
+
+def times(periods):
+    return pd.date_range('2020-03-18', periods=periods, freq='h', tz='UTC')
+
+
+def test_empty_calibration_has_no_offsets():
+    calibrator = calibration.new_calibration(['temperature', 'humidity'])
+    assert calibration.offsets(calibrator, times(4)) is None
+
+
+def test_column_without_differences_is_not_adjusted():
+    calibrator = calibration.new_calibration(['temperature', 'humidity'])
+    calibration.update(calibrator, times(4),
+                       {'temperature': np.full(4, 2.0),
+                        'humidity': np.full(4, np.nan)})
+    result = calibration.offsets(calibrator, times(4))
+    assert np.allclose(result['temperature'], 2.0)
+    assert np.array_equal(result['humidity'], np.zeros(4))
+
+
+def test_hour_with_enough_weight_uses_its_own_mean():
+    calibrator = calibration.new_calibration(['temperature'])
+    day = times(48)
+    diffs = np.where(day.hour == 12, 5.0, 1.0)
+    calibration.update(calibrator, day, {'temperature': diffs})
+    result = calibration.offsets(calibrator, day, min_weight=2)
+    assert np.allclose(result['temperature'], diffs)
+
+
+def test_statistics_added_in_order_equal_the_updates():
+    rng = np.random.default_rng(0)
+    batches = [(times(30) + pd.Timedelta(days=3 * i),
+                {'temperature': rng.normal(2, 1, 30)}) for i in range(3)]
+    running = calibration.new_calibration(['temperature'])
+    added = calibration.new_calibration(['temperature'])
+    stats = [calibration.statistics(day, diffs) for day, diffs in batches]
+    for day, diffs in batches:
+        calibration.update(running, day, diffs)
+    for batch in stats:
+        calibration.add(added, batch)
+
+    assert added['updated'] == running['updated']
+    for key in ['weight', 'mean', 'm2']:
+        assert np.allclose(added['columns']['temperature'][key],
+                           running['columns']['temperature'][key])
+
+
+def test_empty():
+    calibrator = calibration.new_calibration(['temperature'])
+    calibration.add(calibrator, calibration.statistics(times(0), {'temperature': []}))
+    assert calibration.empty(calibrator)
+    calibration.update(calibrator, times(2), {'temperature': np.full(2, np.nan)})
+    assert calibration.empty(calibrator)
+    calibration.update(calibrator, times(2), {'temperature': np.ones(2)})
+    assert not calibration.empty(calibrator)
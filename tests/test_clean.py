@@ -0,0 +1,270 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import clean
+import clean_state
+
+
+def meteosuisse(start, periods, freq):
+    times = pd.date_range(start, periods=periods, freq=freq, tz='UTC')
+    return pd.DataFrame({'time': times,
+                         'temperature': np.arange(periods, dtype=float),
+                         'humidity': 50 + np.arange(periods, dtype=float)})
+
+
+def test_prepare_ms_df_interpolates_the_fetch_cadence():
+    # One meteo suisse point per fetch, every 2 hours, sensehat every 30 min
+    df_ms = meteosuisse('2020-03-18T00:09', 6, '2h')
+    times = pd.Series(pd.date_range('2020-03-18T00:30', '2020-03-18T09:30',
+                                    freq='30min', tz='UTC'))
+    form = clean.prepare_ms_df(df_ms, times)
+    assert not form[clean.FORMATED_COLS].isna().any().any()
+    # Linear between the 2-hourly points : 00:30 is 21 minutes after 00:09
+    assert np.isclose(form['temperature'].iloc[0], 21 / 120)
+    assert np.isclose(form['humidity'].iloc[0], 50 + 21 / 120)
+
+
+def test_prepare_ms_df_does_not_bridge_an_outage():
+    df_ms = meteosuisse('2020-03-18T00:00', 2, '2h')
+    df_ms = pd.concat([df_ms, meteosuisse('2020-03-18T08:00', 2, '2h')],
+                      ignore_index=True)
+    times = pd.Series(pd.to_datetime(['2020-03-18T01:00', '2020-03-18T05:00',
+                                      '2020-03-18T09:00'], utc=True))
+    form = clean.prepare_ms_df(df_ms, times)
+    assert not np.isnan(form['temperature'].iloc[0])
+    # 6 hours between the points around 05:00, more than MS_MAX_GAP
+    assert np.isnan(form['temperature'].iloc[1])
+    assert not np.isnan(form['temperature'].iloc[2])
+
+
+def sensehat(periods):
+    times = pd.date_range('2020-03-18', periods=periods, freq='30min', tz='UTC')
+    values = 10 + np.arange(periods, dtype=float) / 10
+    return pd.DataFrame({'time': times.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                         'humidity': values + 50, 'pressure': values + 900,
+                         'source': 'sensehat', 'temperature': values,
+                         'temperature_humidity': values,
+                         'temperature_pressure': values})
+
+
+def test_clean_batch_without_calibration_writes_no_clean_data(writer):
+    calibrator = clean.calibration.new_calibration(clean.FORMATED_COLS)
+    clean.clean_batch(sensehat(10), pd.DataFrame(), None, None, None, writer,
+                      calibrator=calibrator)
+    assert clean.CONVOL_MEASUREMENT in writer.measurements()
+    assert clean.CLEAN_MEASUREMENT not in writer.measurements()
+
+
+def test_clean_batch_with_calibration_writes_clean_data(writer):
+    avg_diffs = {col: 1.0 for col in clean.ADJUSTED_COLS}
+    clean.clean_batch(sensehat(10), pd.DataFrame(), None, None, avg_diffs, writer)
+    assert writer.measurements().count(clean.CLEAN_MEASUREMENT) == 10
+
+
+def test_prepare_ms_df_without_a_column():
+    # The missing values of the open data are left out of the points
+    df_ms = meteosuisse('2020-03-18T00:00', 3, '2h').drop(columns='humidity')
+    times = pd.Series(pd.to_datetime(['2020-03-18T01:00'], utc=True))
+    form = clean.prepare_ms_df(df_ms, times)
+    assert list(form.columns) == ['time'] + clean.FORMATED_COLS
+    assert np.isclose(form['temperature'].iloc[0], 0.5)
+    assert np.isnan(form['humidity'].iloc[0])
+
+
+def loop_average(values, anormal_index, previous_row, col):
+    """
+    The per-element loop of the 'average' mode of clean_column before it was
+    vectorized, kept as the reference of interpolate_anomalies
+    """
+    for i in anormal_index:
+        if 0 < i < values.shape[0] - 1:
+            values[i] = (values[i - 1] + values[i + 1]) / 2.0
+        elif i > 0:
+            values[i] = values[i - 1]
+        else:
+            if previous_row is None:
+                values[i] = values[i + 1]
+            else:
+                values[i] = (previous_row[col].to_numpy()[0] + values[i + 1]) / 2.0
+
+
+def column_batch(values, anormal):
+    df = pd.DataFrame({'humidity': values})
+    convol = pd.DataFrame({'humidity': np.where(anormal, 10.0 * clean.THRESHOLDS['humidity'],
+                                                0.0)})
+    return df, convol
+
+
+@pytest.mark.parametrize('previous', [None, 45.0], ids=['first_batch', 'previous_row'])
+def test_clean_column_matches_the_loop_on_isolated_anomalies(previous):
+    rng = np.random.default_rng(2)
+    previous_row = None if previous is None else pd.DataFrame({'humidity': [previous]})
+    for _ in range(50):
+        values = rng.normal(50, 5, 40)
+        # Isolated anomalies, with the first and the last rows of the batch
+        anormal = np.zeros(40, dtype=bool)
+        anormal[[0, 39]] = True
+        anormal[rng.choice(np.arange(2, 38, 2), 6, replace=False)] = True
+
+        expected = values.copy()
+        loop_average(expected, np.flatnonzero(anormal), previous_row, 'humidity')
+        df, convol = column_batch(values, anormal)
+        clean.clean_column(df, convol, 'humidity', previous_row)
+        assert np.allclose(df['humidity'], expected)
+
+
+def test_clean_column_interpolates_the_runs_of_anomalies():
+    values = np.array([40.0, 99.0, 99.0, 99.0, 48.0, 99.0, 99.0])
+    anormal = values == 99.0
+    df, convol = column_batch(values, anormal)
+    clean.clean_column(df, convol, 'humidity', None)
+    # Linear over the run, the run at the end copies the last good value
+    assert np.allclose(df['humidity'], [40.0, 42.0, 44.0, 46.0, 48.0, 48.0, 48.0])
+
+    # The loop averaged the first value of a run with the next anomaly
+    expected = values.copy()
+    loop_average(expected, np.flatnonzero(anormal), None, 'humidity')
+    assert expected[1] == (40.0 + 99.0) / 2
+
+
+def test_clean_column_run_at_the_start_of_the_batch():
+    values = np.array([99.0, 99.0, 46.0, 47.0])
+    df, convol = column_batch(values, values == 99.0)
+    clean.clean_column(df, convol, 'humidity', pd.DataFrame({'humidity': [40.0]}))
+    # The last value of the previous batch is the neighbor before the run
+    assert np.allclose(df['humidity'], [42.0, 44.0, 46.0, 47.0])
+
+    df, convol = column_batch(values, values == 99.0)
+    clean.clean_column(df, convol, 'humidity', None)
+    assert np.allclose(df['humidity'], [46.0, 46.0, 46.0, 47.0])
+
+
+def test_chunks_to_frame():
+    times = np.array([1584489600000000000, 1584491400000000000], dtype=np.int64)
+    chunks = [{'time': times, 'temperature': np.array([10, 11]),
+               'source': np.array(['sensehat', 'sensehat'], dtype=object)},
+              {'time': np.array([], dtype=np.int64)},
+              {'time': times + 3600 * 10**9, 'temperature': np.array([12.5, 13.0]),
+               'humidity': np.array([50.0, 51.0])}]
+    df = clean.chunks_to_frame(iter(chunks))
+    assert list(df.columns) == ['time', 'temperature', 'source', 'humidity']
+    assert str(df['time'].dt.tz) == 'UTC'
+    assert df['time'].iloc[0] == pd.Timestamp('2020-03-18', tz='UTC')
+    # The whole values of a chunk are floats, a column missing in a chunk is Nan there
+    assert df['temperature'].dtype == np.float64
+    assert np.allclose(df['humidity'], [np.nan, np.nan, 50.0, 51.0], equal_nan=True)
+    assert len(clean.chunks_to_frame(iter([]))) == 0
+
+
+def raw_data(spikes):
+    """
+    Sensehat samples every 30 min on 3 days, on a ramp so that a spike is
+    corrected to its exact value, and the meteo suisse points every 2 hours 1
+    degree below them : the calibration is the same for any batch
+    """
+    times = pd.date_range('2020-03-18', '2020-03-20 23:30', freq='30min', tz='UTC')
+    ramp = 10 + np.arange(len(times), dtype=float) / 100
+    df = pd.DataFrame({'time': times, 'humidity': ramp + 40, 'pressure': ramp + 900,
+                       'source': clean.SOURCE, 'temperature': ramp,
+                       'temperature_humidity': ramp,
+                       'temperature_pressure': ramp + 0.5})
+    for i in spikes:
+        df.loc[i, clean.CONVOL_COLS] += 20
+    ms_times = pd.date_range('2020-03-17 18:00', '2020-03-21 06:00', freq='2h', tz='UTC')
+    hours = (ms_times - times[0]) / pd.Timedelta(minutes=30)
+    df_ms = pd.DataFrame({'time': ms_times, 'source': clean.MS_SOURCE,
+                          'temperature': 9 + hours.to_numpy() / 100,
+                          'humidity': 49 + hours.to_numpy() / 100})
+    return df, df_ms
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path, writer):
+    """
+    Stands for the influxdb server of clean_source, the raw data are set with
+    database.load and the points written are in database.lines
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(clean.metrics.INFLUX_ENV, '0')
+    monkeypatch.setattr(clean.influx_client, 'connect_pair', lambda: (writer, writer))
+    monkeypatch.setattr(writer, 'close', lambda: None, raising=False)
+    monkeypatch.setattr(clean, 'query_data_to_clean',
+                        lambda client, source, **kwargs: ('0', None))
+    tables = {}
+
+    def after(df, start):
+        return df if start == '0' else df[df['time'] > pd.Timestamp(start)]
+
+    def query_next_time(client, source, start):
+        df = after(tables['data'], start)
+        return None if len(df.index) == 0 else clean.to_rfc3339(df['time'].iloc[0])
+
+    def query_batch(client, start, end=None, limit=None, reference_station=None,
+                    source=clean.SOURCE):
+        df = after(tables['data'], start)
+        if end is not None:
+            df = df[df['time'] < pd.Timestamp(end)]
+        df = df.iloc[:limit].reset_index(drop=True)
+        if len(df.index) == 0:
+            return df, df
+        df_ms = tables['ms']
+        df_ms = df_ms[(df_ms['time'] > df['time'].iloc[0] - clean.MS_MARGIN)
+                      & (df_ms['time'] < df['time'].iloc[-1] + clean.MS_MARGIN)]
+        return df, df_ms.reset_index(drop=True)
+
+    monkeypatch.setattr(clean, 'query_next_time', query_next_time)
+    monkeypatch.setattr(clean, 'query_batch', query_batch)
+
+    def load(df, df_ms):
+        tables['data'], tables['ms'] = df, df_ms
+        writer.lines.clear()
+
+    def points(measurement):
+        return sorted(line for line in writer.lines
+                      if line.startswith(measurement + ',') or line.startswith(measurement + ' '))
+
+    writer.load = load
+    writer.points = points
+    return writer
+
+
+def run_clean(database, data, **options):
+    database.load(*data)
+    clean.clean_source(update_rollups=False, **options)
+    return database.points(clean.CONVOL_MEASUREMENT), database.points(clean.CLEAN_MEASUREMENT)
+
+
+@pytest.mark.parametrize('running_calibration', [True, False], ids=['running', 'batch'])
+def test_windows_give_the_same_output_as_a_single_run(database, running_calibration):
+    # Spikes on the last rows of the first windows of 30 rows (29) and of
+    # 1 day (47), and on the first row of the third day (96)
+    data = raw_data([29, 47, 72, 96, 120])
+    convol, cleaned = run_clean(database, data, running_calibration=running_calibration)
+    assert len(cleaned) == 144
+    for options in [{'window': pd.Timedelta(days=1)}, {'window_rows': 30}]:
+        os.remove(clean_state.STATE_FILE)
+        assert run_clean(database, data, running_calibration=running_calibration,
+                         **options) == (convol, cleaned)
+
+
+def test_no_convol_writes_the_same_clean_rows_without_requery(database, monkeypatch):
+    queries = []
+
+    def query(query, client):
+        queries.append(query)
+        return iter([])
+
+    monkeypatch.setattr(clean, 'query_to_points', query)
+    monkeypatch.setattr(clean, 'query_frame', query)
+    data = raw_data([20, 47, 96])
+    convol, cleaned = run_clean(database, data)
+    os.remove(clean_state.STATE_FILE)
+    assert run_clean(database, data, persist_convol=False) == ([], cleaned)
+    os.remove(clean_state.STATE_FILE)
+    assert run_clean(database, data, persist_convol=False,
+                     window=pd.Timedelta(days=1)) == ([], cleaned)
+    # The convolution signals are never read back
+    assert not any(clean.CONVOL_MEASUREMENT in query for query in queries)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import clean_state
+import detectors
+
+
+def signal(n, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.cumsum(rng.normal(0, 0.3, (n, 2)), axis=0)
+    values[[17, 41], 0] += 6
+    return values
+
+
+def test_history_rows_uses_defaults_and_params():
+    assert detectors.history_rows([('finite_difference', {})]) == 1
+    assert detectors.history_rows([('hampel', {})]) == 3
+    assert detectors.history_rows([('rolling_median', {'window': 11}),
+                                   ('mad_zscore', {})]) == 12
+
+
+@pytest.mark.parametrize('name,params', [('finite_difference', {}),
+                                         ('rolling_median', {'window': 5}),
+                                         ('hampel', {}),
+                                         ('mad_zscore', {'window': 8})])
+def test_two_batches_score_as_one(name, params):
+    values = signal(60)
+    config = [(name, params)] * 2
+    rows = detectors.history_rows(config)
+    whole = detectors.score(values, None, config)
+
+    first, second = values[:30], values[30:]
+    scores = detectors.score(second, first[-rows:], config)
+
+    # The centered windows of the last values of the first batch lack the
+    # next values, the first values of the second batch do not
+    assert np.allclose(scores, whole[30:], equal_nan=True)
+
+
+def test_state_keeps_all_the_history_rows():
+    rows = pd.DataFrame({'time': pd.date_range('2020-03-18', periods=3,
+                                               freq='h', tz='UTC'),
+                         'temperature': [1.0, np.nan, 3.0]})
+    back = clean_state.dict_to_row(clean_state.rows_to_list(rows))
+    assert len(back.index) == 3
+    assert np.allclose(back['temperature'], [1.0, np.nan, 3.0], equal_nan=True)
+
+
+def test_state_reads_a_single_previous_row():
+    back = clean_state.dict_to_row({'temperature': 2.0, 'humidity': None})
+    assert len(back.index) == 1
+    assert np.isnan(back['humidity'].iloc[0])
@@ -0,0 +1,146 @@
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import fetch_open_data
+
+ETAG = '"vqha80-1"'
+
+
+def send(monkeypatch, writer, tmp_path, sample_csv, changed=True, all_stations=False):
+    monkeypatch.setattr(fetch_open_data, 'fetch_csv',
+                        lambda url, cache_dir: (sample_csv.decode('latin-1'), changed))
+    return fetch_open_data.send_open_data(lambda: writer, cache_dir=str(tmp_path),
+                                          all_stations=all_stations)
+
+
+def test_station_point_is_sent_to_data(monkeypatch, writer, tmp_path, sample_csv):
+    send(monkeypatch, writer, tmp_path, sample_csv)
+    assert writer.measurements() == ['data']
+    assert writer.lines[0].startswith('data,source=meteosuisse ')
+    assert 'temperature=9.8' in writer.lines[0]
+
+
+def test_all_stations_still_sends_the_station_point(monkeypatch, writer, tmp_path,
+                                                    sample_csv):
+    send(monkeypatch, writer, tmp_path, sample_csv, all_stations=True)
+    measurements = writer.measurements()
+    assert measurements.count('data') == 1
+    # SMA has no value at all
+    assert measurements.count(fetch_open_data.STATIONS_MEASUREMENT) == 3
+
+
+def test_unchanged_csv_is_not_sent_again(monkeypatch, writer, tmp_path, sample_csv):
+    send(monkeypatch, writer, tmp_path, sample_csv, all_stations=True)
+    sent = len(writer.lines)
+    assert not send(monkeypatch, writer, tmp_path, sample_csv, changed=False,
+                    all_stations=True)
+    assert len(writer.lines) == sent
+
+
+def test_main_connects_only_to_write(monkeypatch, writer, tmp_path, sample_csv):
+    monkeypatch.delenv(fetch_open_data.metrics.TEXTFILE_DIR_ENV, raising=False)
+    connections = []
+
+    def connect_writer():
+        connections.append(writer)
+        return writer
+
+    monkeypatch.setattr(fetch_open_data.influx_client, 'connect_writer', connect_writer)
+    monkeypatch.setattr(writer, 'close', lambda: None, raising=False)
+    changed = [True]
+    monkeypatch.setattr(fetch_open_data, 'fetch_csv',
+                        lambda url, cache_dir: (sample_csv.decode('latin-1'),
+                                                changed[0]))
+
+    fetch_open_data.main(cache_dir=str(tmp_path))
+    assert len(connections) == 1
+    assert writer.measurements().count('data') == 1
+    assert fetch_open_data.metrics.MEASUREMENT in writer.measurements()
+
+    # Nothing new : no client and no metrics written to the server
+    changed[0] = False
+    sent = len(writer.lines)
+    fetch_open_data.main(cache_dir=str(tmp_path))
+    assert len(connections) == 1
+    assert len(writer.lines) == sent
+
+
+def test_failed_connection_does_not_hide_the_error(monkeypatch, tmp_path, capsys):
+    monkeypatch.delenv(fetch_open_data.metrics.TEXTFILE_DIR_ENV, raising=False)
+
+    def fetch_csv(url, cache_dir):
+        raise ValueError('invalid csv')
+
+    def connect_writer():
+        raise OSError('no credentials')
+
+    monkeypatch.setattr(fetch_open_data, 'fetch_csv', fetch_csv)
+    monkeypatch.setattr(fetch_open_data.influx_client, 'connect_writer', connect_writer)
+    with pytest.raises(ValueError, match='invalid csv'):
+        fetch_open_data.main(cache_dir=str(tmp_path))
+    assert 'Failed to connect to write the metrics of the run : no credentials' \
+        in capsys.readouterr().out
+    assert fetch_open_data.metrics.RUN is None
+
+
+@pytest.fixture
+def csv_server(sample_csv):
+    """
+    Serves the sample csv file (gzip encoded) with an ETag, answers 304 when
+    the request has the same ETag. Yields (url, list of the requests headers)
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(dict(self.headers))
+            if self.headers.get('If-None-Match') == ETAG:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = gzip.compress(sample_csv)
+            self.send_response(200)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/VQHA80.csv' % server.server_port, requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_csv_downloads_then_skips_unchanged(csv_server, tmp_path, sample_csv):
+    url, requests = csv_server
+    cache_dir = str(tmp_path)
+
+    text, changed = fetch_open_data.fetch_csv(url, cache_dir)
+    assert changed
+    assert text == sample_csv.decode('latin-1')
+    assert 'If-None-Match' not in requests[0]
+    meta = fetch_open_data.read_cache_meta(cache_dir)
+    assert meta['etag'] == ETAG and meta['sent'] is False
+    assert os.path.exists(os.path.join(cache_dir, 'VQHA80.csv'))
+
+    text, changed = fetch_open_data.fetch_csv(url, cache_dir)
+    assert not changed
+    assert requests[1]['If-None-Match'] == ETAG
+    # The cached version is given back
+    assert text == sample_csv.decode('latin-1')
+
+    row = fetch_open_data.parse_station(text)
+    assert row == {'time': '202003181200', 'tre200s0': '9.8', 'ure200s0': '61.4'}
+    assert fetch_open_data.parse_station(text, station='XXX') is None
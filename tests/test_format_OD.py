@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import format_OD
+import resample
+
+COLUMNS = ['temperature', 'humidity']
+
+
+def source_frame():
+    times = pd.date_range('2020-03-18 00:05', '2020-03-19 05:55', freq='10min',
+                          tz='UTC')
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({'time': times,
+                         'temperature': rng.normal(10, 2, len(times)),
+                         'humidity': rng.normal(50, 5, len(times))})
+
+
+def hourly_frame(start, end):
+    return pd.DataFrame({'time': pd.date_range(start, end, freq='h', tz='UTC'),
+                         'temperature': np.nan, 'humidity': np.nan})
+
+
+def as_strings(df):
+    df = df.copy()
+    df['time'] = df['time'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return df
+
+
+def linear(src, dst):
+    return resample.resample_frame(src, dst['time'], {col: 'linear' for col in COLUMNS})
+
+
+@pytest.mark.parametrize('convert', [lambda df: df, as_strings],
+                         ids=['datetimes', 'strings'])
+def test_resample_matches_the_loop(convert):
+    """
+    The linear interpolation of resample.py gives the same values as the loop
+    of make_formated_column, as long as the samples
+    interpolated are less than a day apart : get_delta_time only handles 2
+    times on the same day or on consecutive days (see the test below)
+    """
+    # Starts before and ends after the source, on 2 days
+    dst = convert(hourly_frame('2020-03-17 22:00', '2020-03-19 08:00'))
+    src = convert(source_frame())
+    expected = dst.copy()
+    format_OD.format_dataframe(expected, src, COLUMNS)
+    result = linear(src, dst)
+
+    assert np.allclose(result[COLUMNS], expected[COLUMNS], equal_nan=True)
+    # Nan outside of the source range only
+    outside = [0, 1, 2] + list(range(len(dst.index) - 3, len(dst.index)))
+    assert result[COLUMNS].iloc[outside].isna().all().all()
+    assert result[COLUMNS].drop(index=outside).notna().all().all()
+
+
+def test_exact_times_take_the_source_value():
+    src = source_frame()
+    dst = hourly_frame('2020-03-18 03:05', '2020-03-18 06:05')
+    result = linear(src, dst)
+    expected = src.set_index('time').loc[dst['time'], COLUMNS]
+    assert np.allclose(result[COLUMNS], expected)
+
+
+def test_empty_source_gives_nan():
+    src = source_frame().iloc[:0]
+    dst = hourly_frame('2020-03-18 00:00', '2020-03-18 03:00')
+    assert linear(src, dst)[COLUMNS].isna().all().all()
+
+
+def test_gap_longer_than_a_day():
+    # The loop counts the 2 days between the samples as one day, and gives
+    # the value of the second sample at the middle of the gap
+    src = pd.DataFrame({'time': pd.to_datetime(['2020-03-18 12:00', '2020-03-20 12:00'],
+                                               utc=True),
+                        'temperature': [10.0, 20.0], 'humidity': [40.0, 60.0]})
+    dst = hourly_frame('2020-03-19 12:00', '2020-03-19 12:00')
+    assert np.allclose(linear(src, dst)[COLUMNS].iloc[0], [15.0, 50.0])
+
+    legacy = hourly_frame('2020-03-19 12:00', '2020-03-19 12:00')
+    format_OD.format_dataframe(legacy, src, COLUMNS)
+    assert np.allclose(legacy[COLUMNS].iloc[0], [20.0, 60.0])
@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+
+import influx_client
+
+
+def column(*values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def test_integers_stay_int64():
+    result = influx_client.column_array(column(3, 12, 2 ** 40))
+    assert result.dtype == np.int64
+    assert result.tolist() == [3, 12, 2 ** 40]
+
+
+def test_numbers_with_floats_or_missing_values_are_float64():
+    assert influx_client.column_array(column(3, 1.5)).dtype == np.float64
+    result = influx_client.column_array(column(None, 3, 4))
+    assert result.dtype == np.float64
+    assert np.isnan(result[0])
+
+
+def test_strings_and_booleans_stay_objects():
+    assert influx_client.column_array(column(None, 'sensehat')).dtype == object
+    assert influx_client.column_array(column(True, False)).dtype == object
+
+
+def test_decode_chunk_keeps_the_integer_fields():
+    chunk = {'results': [{'series': [{
+        'name': 'pipeline_metrics',
+        'columns': ['time', 'rows', 'seconds'],
+        'values': [[1584489600000000000, 10, 0.5],
+                   [1584493200000000000, 12, 1.25]]}]}]}
+    (name, arrays), = influx_client.decode_chunk(json.dumps(chunk).encode())
+    assert name == 'pipeline_metrics'
+    assert arrays['rows'].dtype == np.int64
+    assert arrays['seconds'].dtype == np.float64
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+import time
+
+import pytest
+
+import collect_daemon
+import ingest_service
+import spool
+
+
+class Sensor:
+    """
+    Stands for the SenseHat, keeps the threads reading it
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.threads = set()
+
+    def read(self, value):
+        self.threads.add(threading.get_ident())
+        if self.fail:
+            raise OSError('I2C error')
+        return value
+
+    def get_temperature(self):
+        return self.read(20.0)
+
+    def get_temperature_from_pressure(self):
+        return self.read(19.0)
+
+    def get_temperature_from_humidity(self):
+        return self.read(21.0)
+
+    def get_humidity(self):
+        return self.read(50.0)
+
+    def get_pressure(self):
+        return self.read(950.0)
+
+
+class Points(list):
+    """
+    The points appended to the spool, and the threads appending them
+    """
+    threads = None
+
+
+@pytest.fixture
+def spooled(monkeypatch):
+    points = Points()
+    points.threads = set()
+
+    def append(records, *args, **kwargs):
+        points.threads.add(threading.get_ident())
+        points.extend(records)
+
+    monkeypatch.setattr(spool, 'append', append)
+    return points
+
+
+async def stop_after(stopping, delay):
+    await asyncio.sleep(delay)
+    stopping.set()
+
+
+def test_next_slot():
+    # **05 and **35
+    assert ingest_service.next_slot(3600 + 10 * 60, 1800, 300) == 3600 + 35 * 60
+    assert ingest_service.next_slot(3600 + 35 * 60, 1800, 300) == 7200 + 5 * 60
+
+
+def test_end_interval():
+    buffer = collect_daemon.make_buffer(5, 1800)
+    buffer.extend([(1.0,) * 5, (3.0,) * 5])
+    assert collect_daemon.end_interval(buffer, 1800, 3599, 1800) == ([], 1800)
+    points, start = collect_daemon.end_interval(buffer, 1800, 3700, 1800)
+    assert start == 3600 and len(buffer) == 0
+    assert points[0]['fields']['temperature'] == 2.0
+    assert points[1]['fields']['count'] == 2
+
+
+def test_collect_reads_and_appends_in_the_executor(spooled):
+    sensor = Sensor()
+
+    async def main():
+        stopping = asyncio.Event()
+        await asyncio.gather(ingest_service.collect(sensor, stopping, 0.01, 1800),
+                             stop_after(stopping, 0.2))
+
+    asyncio.run(main())
+    # The interval not finished is appended on the shutdown
+    data, stats = spooled[-2:]
+    assert data['measurement'] == 'data'
+    assert data['fields']['pressure'] == 950.0
+    assert stats['fields']['count'] >= 2
+    assert threading.get_ident() not in sensor.threads | spooled.threads
+
+
+def test_collect_logs_the_failed_reads(spooled, caplog):
+    async def main():
+        stopping = asyncio.Event()
+        await asyncio.gather(ingest_service.collect(Sensor(fail=True), stopping, 0.01),
+                             stop_after(stopping, 0.05))
+
+    with caplog.at_level(logging.WARNING, logger='data_collection'):
+        asyncio.run(main())
+    assert 'Failed to read the sensor : I2C error' in caplog.text
+    assert spooled == []
+
+
+def run_schedule(job, period, duration):
+    async def main():
+        stopping = asyncio.Event()
+        executor = ingest_service.ThreadPoolExecutor(max_workers=1)
+        try:
+            await asyncio.gather(ingest_service.schedule('job', job, period, 0,
+                                                         executor, stopping),
+                                 stop_after(stopping, duration))
+        finally:
+            executor.shutdown(wait=True)
+
+    begin = time.monotonic()
+    asyncio.run(main())
+    return time.monotonic() - begin
+
+
+def test_schedule_runs_at_each_slot_and_survives_failures(caplog):
+    runs = []
+
+    def job():
+        runs.append(time.time())
+        raise RuntimeError('server down')
+
+    with caplog.at_level(logging.ERROR, logger='data_collection'):
+        run_schedule(job, 0.1, 0.45)
+    assert 3 <= len(runs) <= 5
+    assert "Job job failed : RuntimeError('server down')" in caplog.text
+
+
+def test_schedule_skips_the_slots_of_a_long_job(caplog):
+    runs = []
+
+    def job():
+        runs.append(time.time())
+        time.sleep(0.25)
+
+    with caplog.at_level(logging.WARNING, logger='data_collection'):
+        run_schedule(job, 0.1, 0.4)
+    # The slots passed while the job runs are not caught up
+    assert len(runs) <= 2
+    assert 'run(s) skipped' in caplog.text
+
+
+def test_schedule_stops_without_waiting_for_the_next_slot():
+    runs = []
+    assert run_schedule(lambda: runs.append(1), 3600, 0.05) < 1
+    assert runs == []
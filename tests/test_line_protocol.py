@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from line_protocol import Point, column_strings, encode_frame, encode_point, \
+    tag_strings, write_frame
+
+TIME = datetime(2020, 3, 18, tzinfo=timezone.utc)
+NS = 1584489600 * 10**9
+
+
+def test_escaping():
+    line = encode_point('clean sh,data', {'temp rature,=': 'say "hi" \\ bye'},
+                        {'so urce,=': 'sense hat,=2'}, TIME)
+    assert line == ('clean\\ sh\\,data,so\\ urce\\,\\==sense\\ hat\\,\\=2 '
+                    'temp\\ rature\\,\\=="say \\"hi\\" \\\\ bye" ' + str(NS))
+
+
+def test_field_types():
+    line = encode_point('data', {'count': 3, 'numpy': np.int64(4), 'ok': True,
+                                 'off': np.bool_(False), 'value': 1.5}, time=TIME)
+    assert line == 'data count=3i,numpy=4i,ok=true,off=false,value=1.5 ' + str(NS)
+
+
+def test_missing_fields_and_tags_are_left_out():
+    line = encode_point('data', {'nan': float('nan'), 'inf': float('inf'), 'none': None,
+                                 'value': 2.0}, {'empty': '', 'none': None, 'source': 'a'})
+    assert line == 'data,source=a value=2.0'
+    assert encode_point('data', {'nan': float('nan')}) is None
+
+
+def test_precision():
+    assert encode_point('data', {'v': 1.0}, time=TIME, precision='s') \
+        == 'data v=1.0 1584489600'
+    assert encode_point('data', {'v': 1.0}, time='2020-03-18T00:00:00Z', precision='ms') \
+        == 'data v=1.0 1584489600000'
+    # An int is already in the precision
+    assert encode_point('data', {'v': 1.0}, time=12, precision='h') == 'data v=1.0 12'
+
+
+def test_column_strings():
+    strings, valid = column_strings(np.array([1.5, np.nan, -np.inf, 0.1]))
+    assert strings[0] == '1.5' and strings[3] == '0.1'
+    assert valid.tolist() == [True, False, False, True]
+    assert column_strings(np.array([1, 2]))[0] == ['1i', '2i']
+    assert column_strings(np.array([True, False]))[0] == ['true', 'false']
+    strings, valid = column_strings(np.array(['a b', None, 'a"b'], dtype=object))
+    assert strings == ['"a b"', None, '"a\\"b"']
+    assert valid.tolist() == [True, False, True]
+
+
+def test_tag_strings():
+    values = np.array(['sense hat', None, np.nan, '', 'a=b'], dtype=object)
+    assert tag_strings('so,urce', values) == [',so\\,urce=sense\\ hat', '', '', '',
+                                              ',so\\,urce=a\\=b']
+
+
+def test_encode_frame():
+    df = pd.DataFrame({'temperature': [20.5, np.nan, np.nan],
+                       'humidity': [40.0, 50.0, np.nan],
+                       'source': ['sensehat', 'sensehat', None]},
+                      index=pd.to_datetime(['2020-03-18 00:00:00', '2020-03-18 00:00:01',
+                                            '2020-03-18 00:00:02']))
+    lines = encode_frame(df, 'clean_sh_data', ['source'])
+    # The row without any field is left out
+    assert lines == ['clean_sh_data,source=sensehat temperature=20.5,humidity=40.0 ' + str(NS),
+                     'clean_sh_data,source=sensehat humidity=50.0 ' + str(NS + 10**9)]
+    assert encode_frame(df.iloc[:0], 'clean_sh_data') == []
+
+
+def test_encode_frame_times_in_utc():
+    naive = pd.DataFrame({'v': [1.0]}, index=pd.to_datetime(['2020-03-18 00:00']))
+    aware = pd.DataFrame({'v': [1.0]},
+                         index=pd.to_datetime(['2020-03-18 01:00']).tz_localize('Europe/Zurich'))
+    assert encode_frame(naive, 'data') == encode_frame(aware, 'data') == ['data v=1.0 ' + str(NS)]
+    assert encode_frame(naive, 'data', precision='s') == ['data v=1.0 1584489600']
+
+
+def test_encode_frame_equals_the_points():
+    index = pd.date_range('2020-03-18', periods=5, freq='min', tz='UTC')
+    df = pd.DataFrame({'a': [1.0, np.nan, 3.25, 1e-7, 2.0], 'b': [1, 2, 3, 4, 5]},
+                      index=index)
+    points = [encode_point('m', {'a': row.a, 'b': int(row.b)}, time=time.to_pydatetime())
+              for time, row in df.iterrows()]
+    assert encode_frame(df, 'm') == points
+
+
+def test_point_round_trip():
+    point = {'measurement': 'data', 'fields': {'temperature': 21.5},
+             'tags': {'source': 'sensehat'}, 'time': '2020-03-18T00:00:00Z'}
+    assert Point.from_dict(point).to_dict() == point
+    assert Point.from_dict({'measurement': 'data', 'fields': {'v': 1}}).to_dict() \
+        == {'measurement': 'data', 'fields': {'v': 1}}
+    assert Point.from_dict(point).to_line() \
+        == 'data,source=sensehat temperature=21.5 ' + str(NS)
+
+
+def test_write_frame_by_batches(writer):
+    df = pd.DataFrame({'v': np.arange(5.0)},
+                      index=pd.date_range('2020-03-18', periods=5, freq='s', tz='UTC'))
+    write_frame(writer, df, 'data', batch_size=2)
+    assert len(writer.lines) == 5
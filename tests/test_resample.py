@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import resample
+
+
+def source(times, temperature, humidity=None, tz='UTC'):
+    df = pd.DataFrame({'time': pd.to_datetime(times)})
+    if tz is not None:
+        df['time'] = df['time'].dt.tz_localize(tz)
+    df['temperature'] = temperature
+    df['humidity'] = humidity if humidity is not None else np.zeros(len(times))
+    return df
+
+
+def targets(*times):
+    return pd.to_datetime(list(times), utc=True)
+
+
+def test_linear_interpolates_between_the_samples():
+    df = source(['2020-03-18 00:00', '2020-03-18 01:00'], [10.0, 16.0], [50.0, 40.0])
+    result = resample.resample_frame(df, targets('2020-03-17 23:00', '2020-03-18 00:00',
+                                                 '2020-03-18 00:20', '2020-03-18 02:00'))
+    assert list(result.columns) == ['time', 'temperature', 'humidity']
+    assert np.allclose(result['temperature'], [np.nan, 10.0, 12.0, np.nan], equal_nan=True)
+    assert np.allclose(result['humidity'], [np.nan, 50.0, 50 - 10 / 3, np.nan],
+                       equal_nan=True)
+
+
+def test_nan_values_are_not_samples_of_their_column():
+    df = source(['2020-03-18 00:00', '2020-03-18 01:00', '2020-03-18 02:00'],
+                [10.0, np.nan, 14.0], [1.0, 2.0, 3.0])
+    result = resample.resample_frame(df, targets('2020-03-18 01:00'))
+    assert result['temperature'].iloc[0] == pytest.approx(12.0)
+    assert result['humidity'].iloc[0] == pytest.approx(2.0)
+
+
+def test_previous_takes_the_last_sample():
+    df = source(['2020-03-18 00:00', '2020-03-18 01:00'], [10.0, 16.0])
+    result = resample.resample_frame(df, targets('2020-03-17 23:59', '2020-03-18 00:59',
+                                                 '2020-03-18 01:00', '2020-03-18 05:00'),
+                                     {'temperature': 'previous'})
+    assert list(result.columns) == ['time', 'temperature']
+    assert np.allclose(result['temperature'], [np.nan, 10.0, 16.0, 16.0], equal_nan=True)
+
+
+def test_mean_of_the_bins():
+    df = source(['2020-03-18 00:00', '2020-03-18 00:30', '2020-03-18 01:10',
+                 '2020-03-18 03:00'], [1.0, 3.0, 7.0, 9.0])
+    result = resample.resample_frame(df, targets('2020-03-18 00:00', '2020-03-18 01:00',
+                                                 '2020-03-18 02:00'),
+                                     {'temperature': 'mean'}, step='1h')
+    # The sample of 03:00 is after the last bin, the empty bins are Nan
+    assert np.allclose(result['temperature'], [2.0, 7.0, np.nan], equal_nan=True)
+
+
+def test_mean_needs_the_step():
+    df = source(['2020-03-18 00:00'], [1.0])
+    with pytest.raises(ValueError):
+        resample.resample_frame(df, targets('2020-03-18 00:00'), {'temperature': 'mean'})
+
+
+def test_unknown_method():
+    df = source(['2020-03-18 00:00'], [1.0])
+    with pytest.raises(ValueError):
+        resample.resample_frame(df, targets('2020-03-18 00:00'), {'temperature': 'cubic'})
+
+
+def test_max_gap_leaves_the_outages_empty():
+    df = source(['2020-03-18 00:00', '2020-03-18 02:00', '2020-03-18 06:00'],
+                [10.0, 12.0, 20.0])
+    times = targets('2020-03-18 01:00', '2020-03-18 04:00', '2020-03-18 06:00')
+    linear = resample.resample_frame(df, times, {'temperature': 'linear'}, max_gap='3h')
+    # The time of a sample keeps its value, even next to an outage
+    assert np.allclose(linear['temperature'], [11.0, np.nan, 20.0], equal_nan=True)
+    # A gap of exactly max_gap is still interpolated
+    linear = resample.resample_frame(df, times, {'temperature': 'linear'}, max_gap='4h')
+    assert np.allclose(linear['temperature'], [11.0, 16.0, 20.0])
+
+    previous = resample.resample_frame(df, times, {'temperature': 'previous'},
+                                       max_gap='1h')
+    assert np.allclose(previous['temperature'], [10.0, np.nan, 20.0], equal_nan=True)
+
+
+def test_naive_times_are_utc_and_aware_times_converted():
+    naive = source(['2020-03-18 00:00', '2020-03-18 02:00'], [10.0, 12.0], tz=None)
+    zurich = source(['2020-03-18 01:00', '2020-03-18 03:00'], [10.0, 12.0],
+                    tz='Europe/Zurich')
+    times = targets('2020-03-18 01:00')
+    assert resample.resample_frame(naive, times)['temperature'].iloc[0] == 11.0
+    # 01:00 in Zurich (UTC+1) is 00:00 UTC
+    assert resample.resample_frame(zurich, times)['temperature'].iloc[0] == 11.0
+    # The targets can be naive or aware too
+    local = pd.to_datetime(['2020-03-18 02:00']).tz_localize('Europe/Zurich')
+    assert resample.resample_frame(naive, local)['temperature'].iloc[0] == 11.0
+    result = resample.resample_frame(naive, pd.to_datetime(['2020-03-18 01:00']))
+    assert str(result['time'].dt.tz) == 'UTC'
+
+
+def test_align_sources_on_a_common_grid():
+    sensehat = source(['2020-03-18 00:05', '2020-03-18 00:25', '2020-03-18 00:45'],
+                      [10.0, 12.0, 14.0])
+    meteosuisse = source(['2020-03-18 00:00', '2020-03-18 01:00'], [9.0, 15.0])
+    aligned = resample.align_sources({'sensehat': sensehat, 'meteosuisse': meteosuisse},
+                                     '20min',
+                                     methods={'sensehat': {'temperature': 'mean'}})
+    grid = pd.to_datetime(['2020-03-18 00:00', '2020-03-18 00:20', '2020-03-18 00:40',
+                           '2020-03-18 01:00'], utc=True)
+    assert list(aligned['sensehat']['time']) == list(grid)
+    assert list(aligned['meteosuisse']['time']) == list(grid)
+    assert np.allclose(aligned['sensehat']['temperature'], [10.0, 12.0, 14.0, np.nan],
+                       equal_nan=True)
+    assert np.allclose(aligned['meteosuisse']['temperature'], [9.0, 11.0, 13.0, 15.0])
+
+
+def test_align_sources_without_samples():
+    empty = source([], [])
+    aligned = resample.align_sources({'sensehat': empty}, '1h')
+    assert len(aligned['sensehat'].index) == 0
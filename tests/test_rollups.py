@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+import rollups
+
+
+def answer(times, sources_field, sources_tag, values):
+    return {'time': np.array(times, dtype='datetime64[ns]').view(np.int64),
+            'source': np.array(sources_field, dtype=object),
+            'source_1': np.array(sources_tag, dtype=object),
+            'temperature': np.array(values, dtype=np.float64)}
+
+
+def test_source_field_and_tag_are_merged(monkeypatch):
+    # Old points : source field, new points : source tag
+    columns = answer(['2020-03-18T00:00', '2020-03-18T00:30', '2020-03-18T01:00',
+                      '2020-03-18T01:30'],
+                     ['sensehat', 'sensehat', None, None],
+                     [None, None, 'sensehat', 'sensehat_2'],
+                     [1.0, 2.0, 3.0, 4.0])
+    monkeypatch.setattr(rollups.influx_client, 'query_columns', lambda client, query: columns)
+    df = rollups.query_frame(None, rollups.CLEAN_MEASUREMENT,
+                             pd.Timestamp('2020-03-18', tz='UTC'))
+    assert 'source_1' not in df.columns
+    assert list(df['source']) == ['sensehat', 'sensehat', 'sensehat', 'sensehat_2']
+
+    hourly = rollups.aggregate(df, 'h', ['temperature'])
+    assert list(hourly['temperature_count']) == [2, 1, 1]
+    assert list(hourly['source']) == ['sensehat', 'sensehat', 'sensehat_2']
+
+
+def test_point_cleaned_again_is_counted_once(monkeypatch):
+    columns = answer(['2020-03-18T00:00', '2020-03-18T00:00'],
+                     ['sensehat', None], [None, 'sensehat'], [1.0, 5.0])
+    monkeypatch.setattr(rollups.influx_client, 'query_columns', lambda client, query: columns)
+    df = rollups.query_frame(None, rollups.CLEAN_MEASUREMENT,
+                             pd.Timestamp('2020-03-18', tz='UTC'))
+    assert len(df.index) == 1
+    assert df['temperature'].iloc[0] == 5.0
+
+
+def test_whole_values_read_back_are_merged_as_floats():
+    daily = pd.DataFrame({'temperature_min': np.array([3, 4], dtype=np.int64),
+                          'temperature_max': np.array([9, 12], dtype=np.int64),
+                          'temperature_mean': [6.0, 8.0],
+                          'temperature_count': np.array([24, 24], dtype=np.int64)},
+                         index=pd.DatetimeIndex(['2020-03-18', '2020-03-19'], tz='UTC'))
+    monthly = rollups.merge(daily, 'MS', ['temperature'])
+    assert monthly['temperature_min'].dtype == np.float64
+    assert monthly['temperature_max'].dtype == np.float64
+    assert monthly['temperature_count'].iloc[0] == 48
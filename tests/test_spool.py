@@ -0,0 +1,17 @@
+import logging
+
+import spool
+
+
+def test_invalid_record_is_logged_and_skipped(tmp_path, caplog):
+    spool_dir = str(tmp_path)
+    spool.append([{'time': 1}], spool_dir)
+    (path, _, _), = spool.iter_batches(spool_dir)
+    with open(path, 'ab') as f:
+        f.write(b'{"time": \n')
+    spool.append([{'time': 2}], spool_dir)
+
+    with caplog.at_level(logging.WARNING, logger='data_collection'):
+        records, offset = spool.read_records(path)
+    assert [record['time'] for record in records] == [1, 2]
+    assert 'Skipping invalid record in ' + path in caplog.text
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+import clean
+import stream_clean
+
+
+def raw_series(periods=60, seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2020-03-18', periods=periods, freq='30min', tz='UTC')
+    base = 10 + rng.normal(0, 0.2, periods).cumsum()
+    df = pd.DataFrame({'time': times.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                       'humidity': 60 + rng.normal(0, 0.5, periods),
+                       'pressure': 950 + rng.normal(0, 0.05, periods),
+                       'temperature': base + 8,
+                       'temperature_humidity': base + 8,
+                       'temperature_pressure': base + 7})
+    # Isolated spikes (a jump up and a drop back, both anormal), a step and
+    # a run of anomalies
+    for col in ['temperature', 'temperature_humidity', 'humidity']:
+        df.loc[10, col] += 30
+    df.loc[20, 'pressure'] += 5
+    df.loc[30:33, 'temperature_pressure'] += [20, 40, 60, 80]
+    df.loc[45, 'humidity'] -= 25
+    return df
+
+
+def batch_clean(df):
+    df = df.copy()
+    df_convol = pd.DataFrame(index=df.index)
+    clean.convolve_dataframe(df, df_convol, None)
+    clean.clean_data(df, df_convol, None)
+    return df
+
+
+def stream_clean_rows(df, max_pending=stream_clean.MAX_PENDING):
+    stream = stream_clean.new_stream()
+    emitted = []
+    for row in df.to_dict('records'):
+        _, samples = stream_clean.push(stream, row['time'], row, max_pending=max_pending)
+        emitted.extend(samples)
+    return stream, emitted
+
+
+def test_stream_matches_the_batch():
+    df = raw_series()
+    expected = batch_clean(df)
+    for col in clean.CONVOL_COLS:
+        assert not np.allclose(expected[col], df[col]), col
+    stream, emitted = stream_clean_rows(df)
+    # The last sample is good, nothing is left pending
+    assert len(stream['pending']) == 0
+    assert [time for time, _ in emitted] == list(df['time'])
+    result = pd.DataFrame([values for _, values in emitted])
+    for col in clean.CONVOL_COLS:
+        assert np.allclose(result[col], expected[col]), col
+
+
+def test_anomaly_is_held_until_a_good_value():
+    df = raw_series()
+    _, emitted = stream_clean_rows(df.iloc[:11])
+    # The spike at 10 is pending, its end is not known yet
+    assert [time for time, _ in emitted] == list(df['time'].iloc[:10])
+
+
+def test_pending_samples_are_bounded():
+    df = raw_series()
+    df.loc[5:, 'humidity'] = 60 + 10 * np.arange(len(df.index) - 5)
+    stream, emitted = stream_clean_rows(df, max_pending=4)
+    assert len(stream['pending']) == 4
+    assert len(emitted) == len(df.index) - 4
+
+
+def test_state_roundtrip():
+    df = raw_series()
+    stream, _ = stream_clean_rows(df.iloc[:11])
+    json_stream = stream_clean.convert_stream(stream, stream_clean.json_values)
+    back = stream_clean.convert_stream(json_stream, stream_clean.float_values)
+    assert back['pending'][0]['time'] == stream['pending'][0]['time']
+    assert back['pending'][0]['raw'] == stream['pending'][0]['raw']
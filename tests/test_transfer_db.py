@@ -0,0 +1,52 @@
+import json
+import logging
+
+import spool
+import transfer_db
+
+
+class FailingClient:
+    _database = 'db'
+
+    def write(self, data, params=None, protocol='line'):
+        raise ConnectionError('link down')
+
+
+def make_samples(volume, names, broken=()):
+    for name in names:
+        sample = volume / name
+        sample.mkdir()
+        point = {'measurement': 'data', 'tags': {'source': 'sensehat'},
+                 'time': '2020-03-18T00:00:00Z', 'fields': {'temperature': 10.0}}
+        (sample / 'data.json').write_text('{' if name in broken else json.dumps(point))
+
+
+def test_unreadable_sample_is_logged_and_kept(tmp_path, caplog):
+    make_samples(tmp_path, ['202003180000', '202003180030'], broken=['202003180000'])
+    with caplog.at_level(logging.WARNING, logger='data_collection'):
+        points, read_dirs = transfer_db.read_samples(transfer_db.list_samples(str(tmp_path)))
+    assert len(points) == 1
+    assert read_dirs == [str(tmp_path / '202003180030')]
+    assert 'Skipping sample ' + str(tmp_path / '202003180000') in caplog.text
+
+
+def test_missing_volume_has_no_sample(tmp_path):
+    assert transfer_db.list_samples(str(tmp_path / 'volume')) == []
+
+
+def test_failed_batch_is_logged_and_kept(tmp_path, caplog):
+    make_samples(tmp_path, ['202003180000'])
+    with caplog.at_level(logging.ERROR, logger='data_collection'):
+        assert not transfer_db.upload_samples(FailingClient(), str(tmp_path), pace=0)
+    assert 'link down' in caplog.text
+    assert (tmp_path / '202003180000').exists()
+
+
+def test_failed_spool_batch_is_logged_and_not_acknowledged(tmp_path, caplog):
+    spool_dir = str(tmp_path)
+    spool.append([{'measurement': 'data', 'time': '2020-03-18T00:00:00Z',
+                   'fields': {'temperature': 10.0}}], spool_dir)
+    with caplog.at_level(logging.ERROR, logger='data_collection'):
+        assert not transfer_db.upload_spool(FailingClient(), spool_dir, pace=0)
+    assert 'Failed to send a batch of ' in caplog.text
+    assert len(list(spool.iter_batches(spool_dir))) == 1